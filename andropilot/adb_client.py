@@ -0,0 +1,372 @@
+import logging
+import os
+import socket
+import stat
+import struct
+import threading
+import time
+
+logger = logging.getLogger('adb_client')
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = int(os.environ.get('ANDROID_ADB_SERVER_PORT', 5037))
+
+# maximum size of a sync DATA chunk accepted by adbd
+SYNC_DATA_MAX = 64 * 1024
+# how many idle sync connections are kept for each device
+SYNC_POOL_SIZE = 2
+
+DEFAULT_FILE_MODE = 0o644
+TEMP_INSTALL_DIR = '/data/local/tmp'
+
+
+class AdbError(Exception):
+    pass
+
+
+class AdbConnection(object):
+
+    """
+    A socket connected to the adb server, speaking the smart-socket
+    protocol: each request is prefixed by its length as 4 hex digits
+    and is answered by OKAY or FAIL (followed by a length-prefixed
+    error message).
+    """
+
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, timeout=None):
+        self.socket = socket.create_connection((host, port), timeout)
+
+    def close(self):
+        try:
+            self.socket.close()
+        except socket.error:
+            pass
+
+    def send_request(self, request):
+        self.socket.sendall('%04x%s' % (len(request), request))
+        self.read_status(request)
+
+    def read_status(self, request=''):
+        status = self.read_exactly(4)
+        if status == 'OKAY':
+            return
+        if status == 'FAIL':
+            raise AdbError('%s: %s' % (request, self.read_string()))
+        raise AdbError('%s: unexpected reply %r' % (request, status))
+
+    def read_string(self):
+        length = int(self.read_exactly(4), 16)
+        return self.read_exactly(length)
+
+    def read_exactly(self, size):
+        chunks = []
+        while size > 0:
+            data = self.socket.recv(size)
+            if not data:
+                raise AdbError('Connection closed by the adb server')
+            chunks.append(data)
+            size -= len(data)
+        return ''.join(chunks)
+
+    def read_all(self, stream=None):
+        """
+        Read until the server closes the connection; data is written to
+        stream if given, otherwise it is returned.
+        """
+        chunks = []
+        while True:
+            data = self.socket.recv(SYNC_DATA_MAX)
+            if not data:
+                break
+            if stream is not None:
+                stream.write(data)
+            else:
+                chunks.append(data)
+        return ''.join(chunks)
+
+
+class SyncConnection(object):
+
+    """
+    A connection switched to the file sync service of a device.
+    It can transfer any number of files until it is closed.
+    """
+
+    def __init__(self, connection, serial):
+        self.connection = connection
+        self.serial = serial
+
+    def _send(self, command, data=''):
+        self.connection.socket.sendall(
+            command + struct.pack('<I', len(data)) + data)
+
+    def _read_header(self):
+        header = self.connection.read_exactly(8)
+        return header[:4], struct.unpack('<I', header[4:])[0]
+
+    def _read_fail(self, length):
+        return self.connection.read_exactly(length)
+
+    def stat(self, path):
+        """
+        Return the (mode, size, mtime) of a remote path, mode is 0 if the
+        path does not exist.
+        """
+        self._send('STAT', path)
+        reply = self.connection.read_exactly(16)
+        if reply[:4] != 'STAT':
+            raise AdbError('STAT %s: unexpected reply %r' % (path, reply[:4]))
+        return struct.unpack('<III', reply[4:])
+
+    def push(self, src, dst, mode=None, mtime=None):
+        if mode is None:
+            mode = stat.S_IMODE(os.stat(src).st_mode) or DEFAULT_FILE_MODE
+        if mtime is None:
+            mtime = int(os.path.getmtime(src))
+        with open(src, 'rb') as f:
+            self.push_stream(f, dst, mode, mtime)
+
+    def push_stream(self, stream, dst, mode=DEFAULT_FILE_MODE, mtime=None):
+        if mtime is None:
+            mtime = int(time.time())
+        self._send('SEND', '%s,%d' % (dst, stat.S_IFREG | mode))
+        while True:
+            data = stream.read(SYNC_DATA_MAX)
+            if not data:
+                break
+            self._send('DATA', data)
+        self.connection.socket.sendall('DONE' + struct.pack('<I', mtime))
+
+        reply, length = self._read_header()
+        if reply == 'FAIL':
+            raise AdbError('push %s: %s' % (dst, self._read_fail(length)))
+        if reply != 'OKAY':
+            raise AdbError('push %s: unexpected reply %r' % (dst, reply))
+
+    def pull(self, src, dst):
+        with open(dst, 'wb') as f:
+            self.pull_stream(src, f)
+
+    def pull_stream(self, src, stream):
+        self._send('RECV', src)
+        while True:
+            reply, length = self._read_header()
+            if reply == 'DATA':
+                stream.write(self.connection.read_exactly(length))
+            elif reply == 'DONE':
+                return
+            elif reply == 'FAIL':
+                raise AdbError('pull %s: %s' % (src, self._read_fail(length)))
+            else:
+                raise AdbError('pull %s: unexpected reply %r' % (src, reply))
+
+    def close(self):
+        try:
+            self._send('QUIT')
+        except socket.error:
+            pass
+        self.connection.close()
+
+
+class AdbClient(object):
+
+    """
+    In-process client of the adb server (the one listening on
+    localhost:5037), to avoid forking an adb process for every operation.
+
+    Shell connections are consumed by the command they run (the server
+    closes them when the command ends), while sync connections are kept
+    in a per-device pool and reused across push/pull calls.
+    """
+
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, timeout=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.sync_pool = {}
+        self.pool_lock = threading.Lock()
+
+    def connect(self):
+        return AdbConnection(self.host, self.port, self.timeout)
+
+    def host_command(self, request, has_reply=True):
+        """
+        Run a host service (e.g. host:version, host:devices) and return
+        its length-prefixed reply.
+        """
+        connection = self.connect()
+        try:
+            connection.send_request(request)
+            if has_reply:
+                return connection.read_string()
+        finally:
+            connection.close()
+
+    def version(self):
+        return int(self.host_command('host:version'), 16)
+
+    def devices(self):
+        """
+        Return the list of (serial, state) pairs of the connected devices.
+        """
+        data = self.host_command('host:devices')
+        return [tuple(line.split('\t', 1)) for line in data.splitlines()
+                if '\t' in line]
+
+    def transport(self, serial):
+        """
+        Open a connection switched to the transport of the given device.
+        """
+        connection = self.connect()
+        try:
+            connection.send_request('host:transport:%s' % serial)
+        except:
+            connection.close()
+            raise
+        return connection
+
+    def open_service(self, serial, service):
+        connection = self.transport(serial)
+        try:
+            connection.send_request(service)
+        except:
+            connection.close()
+            raise
+        return connection
+
+    def shell(self, serial, command, stream=None):
+        """
+        Run a shell command on the device and return its output (or write
+        it to stream).
+        """
+        if isinstance(command, (list, tuple)):
+            command = ' '.join(command)
+        connection = self.open_service(serial, 'shell:%s' % command)
+        try:
+            return connection.read_all(stream)
+        finally:
+            connection.close()
+
+    def exec_out(self, serial, command, stream=None):
+        """
+        Like shell, but the output is not mangled by a pty (binary safe).
+        Requires Android 5.0.
+        """
+        if isinstance(command, (list, tuple)):
+            command = ' '.join(command)
+        connection = self.open_service(serial, 'exec:%s' % command)
+        try:
+            return connection.read_all(stream)
+        finally:
+            connection.close()
+
+    def forward(self, serial, local, remote):
+        connection = self.connect()
+        try:
+            connection.send_request(
+                'host-serial:%s:forward:%s;%s' % (serial, local, remote))
+            # the forward result is notified with a second status
+            connection.read_status('forward %s %s' % (local, remote))
+        finally:
+            connection.close()
+
+    def acquire_sync(self, serial):
+        with self.pool_lock:
+            pool = self.sync_pool.get(serial)
+            if pool:
+                return pool.pop()
+        return SyncConnection(self.open_service(serial, 'sync:'), serial)
+
+    def release_sync(self, sync_connection):
+        with self.pool_lock:
+            pool = self.sync_pool.setdefault(sync_connection.serial, [])
+            if len(pool) < SYNC_POOL_SIZE:
+                pool.append(sync_connection)
+                return
+        sync_connection.close()
+
+    def sync(self, serial, operation, *args):
+        """
+        Run operation (a SyncConnection method name) on a pooled sync
+        connection.
+        """
+        sync_connection = self.acquire_sync(serial)
+        try:
+            result = getattr(sync_connection, operation)(*args)
+        except:
+            # adbd may drop the connection after a failure, never reuse it
+            sync_connection.close()
+            raise
+        self.release_sync(sync_connection)
+        return result
+
+    def push(self, serial, src, dst):
+        if dst.endswith('/') or \
+                stat.S_ISDIR(self.sync(serial, 'stat', dst)[0]):
+            dst = dst.rstrip('/') + '/' + os.path.basename(src)
+        self.sync(serial, 'push', src, dst)
+
+    def pull(self, serial, src, dst):
+        if os.path.isdir(dst):
+            dst = os.path.join(dst, os.path.basename(src))
+        self.sync(serial, 'pull', src, dst)
+
+    def install(self, serial, apk_path, options=('-r',)):
+        """
+        Install an APK by pushing it to a temporary location and running
+        the package manager on it.
+        """
+        remote_path = '%s/%s' % (TEMP_INSTALL_DIR, os.path.basename(apk_path))
+        self.sync(serial, 'push', apk_path, remote_path)
+        try:
+            output = self.shell(
+                serial, ['pm', 'install'] + list(options) + [remote_path])
+        finally:
+            self.shell(serial, ['rm', remote_path])
+        if 'Success' not in output:
+            raise AdbError('install %s: %s' % (apk_path, output.strip()))
+        return output
+
+    def close(self):
+        with self.pool_lock:
+            pools, self.sync_pool = self.sync_pool, {}
+        for pool in pools.values():
+            for sync_connection in pool:
+                sync_connection.close()
+
+    def run(self, serial, args, stdout=None):
+        """
+        Execute the adb command line arguments args (as given to the adb
+        executable after '-s serial') and return a (return code, output)
+        pair, with output written to stdout if given.
+        Return None when the command is not supported in process, so that
+        the caller can fall back to the adb executable.
+        """
+        if not args:
+            return None
+        command, params = args[0], list(args[1:])
+
+        try:
+            if command == 'shell' and params:
+                return 0, self.shell(serial, params, stdout)
+            elif command == 'exec-out' and params:
+                return 0, self.exec_out(serial, params, stdout)
+            elif command == 'push' and len(params) == 2:
+                self.push(serial, params[0], params[1])
+            elif command == 'pull' and len(params) == 2:
+                self.pull(serial, params[0], params[1])
+            elif command == 'forward' and len(params) == 2:
+                self.forward(serial, params[0], params[1])
+            elif command == 'install' and params and \
+                    not params[-1].startswith('-'):
+                output = self.install(serial, params[-1], params[:-1])
+                if stdout is not None:
+                    stdout.write(output)
+                return 0, output
+            else:
+                return None
+        except AdbError as e:
+            logger.warning("adb %s failed: %s", command, e)
+            return 1, str(e)
+        return 0, ''
+
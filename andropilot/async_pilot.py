@@ -0,0 +1,450 @@
+"""
+Non-blocking API over AndroPilot sessions: one EventLoop drives many
+devices with a few threads.
+
+The device operations (refresh, taps, shell commands...) are blocking
+calls: they run on a pool of worker threads shared by all the devices,
+one at a time and in submission order for each device. The pool grows
+with the devices up to max_workers (DEFAULT_MAX_WORKERS unless given,
+None for no cap), so at most min(devices, max_workers) operations run at
+once: a slow open() delays the other devices only when all the workers
+are busy.
+The waits, where the blocking API spends most of its time sleeping, do
+not hold any thread: every poll is scheduled on the loop timer, and the
+operations return Future objects.
+"""
+import collections
+import heapq
+import itertools
+import logging
+import Queue
+import threading
+
+import wait
+
+logger = logging.getLogger('andropilot')
+
+# one worker thread for each device, up to this many: pass max_workers to
+# EventLoop for another cap, or None for one worker for each device
+DEFAULT_MAX_WORKERS = 32
+
+
+class AsyncPilotException(Exception):
+    pass
+
+
+class Future(object):
+
+    """
+    The result of an operation that completes later: result() blocks until
+    it is available, add_done_callback() registers a function called with
+    the future once done (from the thread completing it).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+        self.callbacks = []
+
+    def done(self):
+        return self.event.is_set()
+
+    def result(self, timeout=None):
+        if not self.event.wait(timeout):
+            raise AsyncPilotException('Operation not completed')
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+    def exception(self, timeout=None):
+        if not self.event.wait(timeout):
+            raise AsyncPilotException('Operation not completed')
+        return self.error
+
+    def add_done_callback(self, callback):
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def set_result(self, value):
+        self.__complete(value, None)
+
+    def set_exception(self, error):
+        self.__complete(None, error)
+
+    def __complete(self, value, error):
+        with self.lock:
+            if self.event.is_set():
+                raise AsyncPilotException('Future already completed')
+            self.value = value
+            self.error = error
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                logger.exception("Future callback failed")
+
+
+def gather(futures):
+    """
+    Return a Future of the list of the results of futures, failing with the
+    first exception.
+    """
+    futures = list(futures)
+    gathered = Future()
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def _done(future):
+        with lock:
+            if gathered.done():
+                return
+            if future.error is not None:
+                gathered.set_exception(future.error)
+                return
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        gathered.set_result([f.value for f in futures])
+
+    if not futures:
+        gathered.set_result([])
+    for future in futures:
+        future.add_done_callback(_done)
+    return gathered
+
+
+class EventLoop(object):
+
+    """
+    A timer thread running the scheduled calls and a pool of threads
+    running the blocking device operations: one for each device (see
+    add_device) up to max_workers, unless it is None.
+    """
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS):
+        self.max_workers = max_workers
+        self.devices = 0
+        self.workers = 0
+        self.started = False
+        # heap of [when, sequence, function, args], function is set to
+        # None by cancel()
+        self.timers = []
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.tasks = Queue.Queue()
+        self.threads = []
+        self.closed = False
+
+    def start(self):
+        self.__start_thread(self.__run_timers, 'async-pilot-timer')
+        with self.condition:
+            self.started = True
+            self.__add_workers()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+            workers, self.workers = self.workers, 0
+        for _ in range(workers):
+            self.tasks.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def add_device(self):
+        """
+        Account for one more device, adding a worker unless max_workers
+        are running already.
+        """
+        with self.condition:
+            self.devices += 1
+            if self.started and not self.closed:
+                self.__add_workers()
+
+    def __add_workers(self):
+        wanted = self.devices
+        if self.max_workers is not None:
+            wanted = min(wanted, self.max_workers)
+        while self.workers < wanted:
+            self.__start_thread(self.__work,
+                                'async-pilot-worker-%d' % self.workers)
+            self.workers += 1
+
+    def __start_thread(self, target, name):
+        thread = threading.Thread(target=target, name=name)
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def call_later(self, delay, function, *args):
+        """
+        Call function(*args) on the timer thread after delay seconds, it
+        must not block. Returns a handle for cancel().
+        """
+        timer = [wait.monotonic() + delay, next(self.sequence), function,
+                 args]
+        with self.condition:
+            heapq.heappush(self.timers, timer)
+            if self.timers[0] is timer:
+                self.condition.notify()
+        return timer
+
+    def cancel(self, timer):
+        timer[2] = None
+
+    def submit(self, function, *args):
+        """
+        Run function(*args) on a worker thread.
+        """
+        self.tasks.put((function, args))
+
+    def __run_timers(self):
+        while True:
+            with self.condition:
+                while not self.closed:
+                    if self.timers:
+                        delay = self.timers[0][0] - wait.monotonic()
+                        if delay <= 0:
+                            break
+                        self.condition.wait(delay)
+                    else:
+                        self.condition.wait()
+                if self.closed:
+                    return
+                _, _, function, args = heapq.heappop(self.timers)
+            if function is None:
+                continue
+            try:
+                function(*args)
+            except Exception:
+                logger.exception("Scheduled call failed")
+
+    def __work(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            function, args = task
+            try:
+                function(*args)
+            except Exception:
+                logger.exception("Worker task failed")
+
+
+class _Strand(object):
+
+    """
+    Runs the operations submitted for a device on the loop workers, one at
+    a time and in order.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.pending = collections.deque()
+        self.running = False
+        self.lock = threading.Lock()
+
+    def submit(self, function, *args, **kwargs):
+        future = Future()
+        with self.lock:
+            self.pending.append((future, function, args, kwargs))
+            if self.running:
+                return future
+            self.running = True
+        self.loop.submit(self.__run_next)
+        return future
+
+    def __run_next(self):
+        with self.lock:
+            future, function, args, kwargs = self.pending.popleft()
+        try:
+            value = function(*args, **kwargs)
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            future.set_result(value)
+        with self.lock:
+            if not self.pending:
+                self.running = False
+                return
+        self.loop.submit(self.__run_next)
+
+
+class _Wait(object):
+
+    """
+    A wait.poll() whose polls are scheduled on the loop timer instead of
+    sleeping, with the same backoff and the same WaitResult.
+    """
+
+    def __init__(self, async_pilot, conditions, timeout, require_all,
+                 refresh, interval, max_interval, backoff, name):
+        self.async_pilot = async_pilot
+        self.conditions = [c if isinstance(c, wait.Condition)
+                           else wait.Condition(c) for c in conditions]
+        self.require_all = require_all
+        self.needs_refresh = refresh is not None and \
+            any(c.refresh for c in self.conditions)
+        self.refresh = refresh
+        self.interval = interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.name = name or ', '.join(c.name for c in self.conditions)
+        self.polls = 0
+        self.future = Future()
+        self.start_time = wait.monotonic()
+        self.deadline = self.start_time + timeout
+
+    def start(self):
+        self.__poll()
+        return self.future
+
+    def __poll(self):
+        self.async_pilot.strand.submit(self.__check).add_done_callback(
+            self.__checked)
+
+    def __check(self):
+        if self.needs_refresh:
+            self.refresh()
+        return [c.check() or None for c in self.conditions]
+
+    def __checked(self, check):
+        self.polls += 1
+        if check.error is not None:
+            self.future.set_exception(check.error)
+            return
+        values = check.value
+        met = [v is not None for v in values]
+        now = wait.monotonic()
+        if all(met) if self.require_all else any(met):
+            self.__finish(True, values, now)
+        elif now >= self.deadline:
+            self.__finish(False, values, now)
+        else:
+            self.async_pilot.loop.call_later(
+                min(self.interval, self.deadline - now), self.__poll)
+            self.interval = min(self.interval * self.backoff,
+                                self.max_interval)
+
+    def __finish(self, satisfied, values, now):
+        result = wait.WaitResult(self.name, satisfied, values, self.polls,
+                                 now - self.start_time)
+        logger.debug("Wait %r", result)
+        self.async_pilot.pilot.last_wait = result
+        self.future.set_result(result)
+
+
+class AsyncPilot(object):
+
+    """
+    The non-blocking counterpart of an AndroPilot: every method returns a
+    Future. The operations of a device are executed in the order they are
+    called, the waits poll without holding a thread. open() holds a
+    worker while the device services start (a few seconds), which only
+    delays the other devices when the loop has fewer workers than
+    devices (see EventLoop).
+    """
+
+    def __init__(self, pilot, loop):
+        self.pilot = pilot
+        self.loop = loop
+        self.strand = _Strand(loop)
+        loop.add_device()
+
+    def call(self, method, *args, **kwargs):
+        """
+        Run the AndroPilot method with the given name.
+        """
+        return self.strand.submit(getattr(self.pilot, method), *args,
+                                  **kwargs)
+
+    def open(self):
+        return self.call('open')
+
+    def close(self):
+        return self.call('close')
+
+    def refresh(self):
+        return self.call('refresh')
+
+    def get_focus_activity(self):
+        return self.call('get_focus_activity')
+
+    def tap_on_coordinates(self, x, y):
+        return self.call('tap_on_coordinates', x, y)
+
+    def click_view_by_id(self, ident):
+        return self.call('click_view_by_id', ident)
+
+    def click_view_by_text(self, text, partial_matching=True):
+        return self.call('click_view_by_text', text, partial_matching)
+
+    def press_back(self):
+        return self.call('press_back')
+
+    def press_home(self):
+        return self.call('press_home')
+
+    def type(self, text):
+        return self.call('type', text)
+
+    def start_activity(self, package_name, activity_name):
+        return self.call('start_activity', package_name, activity_name)
+
+    def shell(self, cmd, timeout=None):
+        return self.call('shell', cmd, timeout)
+
+    def capture_screen(self):
+        return self.call('capture_screen')
+
+    def poll(self, conditions, timeout, require_all=False, refresh=None,
+             interval=wait.DEFAULT_INTERVAL,
+             max_interval=wait.DEFAULT_MAX_INTERVAL,
+             backoff=wait.DEFAULT_BACKOFF, name=None):
+        """
+        Future of the wait.WaitResult of polling the conditions, see
+        wait.poll(). refresh defaults to the pilot refresh.
+        """
+        if refresh is None:
+            refresh = self.pilot.refresh
+        return _Wait(self, conditions, timeout, require_all, refresh,
+                     interval, max_interval, backoff, name).start()
+
+    def wait_for(self, condition, timeout, **options):
+        return self.poll([condition], timeout, **options)
+
+    def wait_any(self, conditions, timeout, **options):
+        return self.poll(conditions, timeout, require_all=False, **options)
+
+    def wait_all(self, conditions, timeout, **options):
+        return self.poll(conditions, timeout, require_all=True, **options)
+
+    def wait_for_text(self, text, timeout, partial_matching=True):
+        return self.wait_for(wait.Condition(
+            lambda: self.pilot.get_view_by_text(text, partial_matching),
+            refresh=True, name='text %s' % text), timeout)
+
+    def wait_for_view_by_id(self, ident, timeout):
+        return self.wait_for(wait.Condition(
+            lambda: self.pilot.get_view_by_id(ident), refresh=True,
+            name='view %s' % ident), timeout)
+
+    def wait_for_activity(self, activity_name, timeout):
+        return self.wait_for(wait.Condition(
+            lambda: self.pilot.get_focus_activity() == activity_name,
+            name='activity %s' % activity_name), timeout)
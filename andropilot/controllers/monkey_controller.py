@@ -1,12 +1,25 @@
+import collections
 import re
 import subprocess
 import socket
 import logging
+import threading
 
 import time
 
 logger = logging.getLogger('monkey_controller')
 
+# seconds of inactivity after which the connection is probed
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_TIMEOUT = 5
+# cheapest command we can send, monkey has no real no-op
+KEEPALIVE_COMMAND = "getvar build.version.sdk"
+# how many reconnect/restart latencies are kept for the statistics
+LATENCIES_HISTORY_SIZE = 100
+# seconds to wait for the monkey process to start and then to listen
+SERVICE_START_DELAY = 1
+SERVICE_LISTEN_DELAY = 3
+
 
 class MonkeyException(Exception):
     pass
@@ -16,10 +29,29 @@ class MonkeyController:
 
     '''
     This class can send events to monkey server in device
+
+    The pilot passes in its monotonic clock, used for the keepalive and
+    the recovery latencies.
     '''
 
-    def __init__(self, pilot):
+    def __init__(self, pilot, keepalive_interval=KEEPALIVE_INTERVAL,
+                 clock=time.time):
         self.pilot = pilot
+        self.keepalive_interval = keepalive_interval
+        self.clock = clock
+        # the socket is shared between the callers and the keepalive thread
+        self.socket_lock = threading.RLock()
+        self.keepalive_stop = None
+        self.last_activity = 0
+
+        # connection supervisor statistics
+        self.reconnect_count = 0
+        self.restart_count = 0
+        self.keepalive_failures = 0
+        self.reconnect_latencies = collections.deque(
+            maxlen=LATENCIES_HISTORY_SIZE)
+        self.restart_latencies = collections.deque(
+            maxlen=LATENCIES_HISTORY_SIZE)
 
     def open(self):
         """
@@ -29,9 +61,11 @@ class MonkeyController:
         """
         self.__start_service()
         # sleep some time waiting for the monkey service to start
-        time.sleep(3)
+        time.sleep(SERVICE_LISTEN_DELAY)
         self.__forward_port()
         self.monkey_socket = self.__open_socket_connection()
+        self.last_activity = self.clock()
+        self.__start_keepalive()
 
     def __start_service(self):
         """
@@ -46,7 +80,7 @@ class MonkeyController:
 
         # best we can do sleep 1 second as the sdk monkey runner... that SUCKS!
         # https://android.googlesource.com/platform/sdk/+/fd836ebcd985b08baa85caad03f9ad86eb40ef83/monkeyrunner/src/com/android/monkeyrunner/adb/AdbMonkeyDevice.java
-        time.sleep(1)
+        time.sleep(SERVICE_START_DELAY)
         if self.monkey_binder_process.poll() is not None:
             raise MonkeyException('Unable to start monkey server')
 
@@ -84,29 +118,71 @@ class MonkeyController:
         Args:
             command (str): the string command to be sent.
         """
-
-        MAX_ATTEMPTS = 3
         logger.debug("Sending command '%s' via socket %s:%s",
                      command, self.pilot.device_address,
                      self.pilot.monkey_server_port)
 
-        # try sending the command twice (restart monkey connection if it
-        #    does not work the first time)
+        return self.__communicate([command])[0] + "\n"
+
+    def send_batch(self, commands):
+        """
+        Send several commands in a single round trip (pipelined) and
+        return their replies.
+        """
+        if not commands:
+            return []
+        logger.debug("Sending %d commands via socket %s:%s", len(commands),
+                     self.pilot.device_address, self.pilot.monkey_server_port)
+        replies = self.__communicate(commands)
+        for command, reply in zip(commands, replies):
+            if reply.startswith('ERROR'):
+                raise MonkeyException('Command %s failed: %s' % (command,
+                                                                 reply))
+        return replies
+
+    def __communicate(self, commands):
+        """
+        Send the commands (pipelined) and read back one reply line for
+        each of them.
+        On socket errors the connection is recovered and only the commands
+        that got no reply are sent again: the replied ones have already
+        been executed by the device.
+        """
+        MAX_ATTEMPTS = 3
+        replies = []
+
         attempts = 0
-        while attempts < MAX_ATTEMPTS:
+        while True:
+            pending = commands[len(replies):]
             try:
-                self.monkey_socket.sendall(command + "\n")
-                res = self.monkey_socket.recv(1024)
-                break
+                with self.socket_lock, \
+                        self.pilot.probe('monkey_round_trip', 'monkey',
+                                         commands=len(pending)):
+                    self.monkey_socket.sendall(
+                        ''.join(c + "\n" for c in pending))
+                    self.__read_replies(len(commands), replies)
+                    self.last_activity = self.clock()
+                return replies
             except socket.error:
-                logger.exception(
-                    'Exception while sending command %s' % command)
-                self.restart()
+                logger.exception('Exception while sending command %s',
+                                 commands[len(replies)])
                 attempts = attempts + 1
                 if attempts >= MAX_ATTEMPTS:
                     raise
+                self.recover()
 
-        return res
+    def __read_replies(self, count, replies):
+        """
+        Read reply lines into replies until it holds count of them.
+        """
+        data = ''
+        while len(replies) < count:
+            chunk = self.monkey_socket.recv(1024)
+            if not chunk:
+                raise socket.error('Connection closed by monkey')
+            lines = (data + chunk).split("\n")
+            data = lines.pop()
+            replies.extend(lines[:count - len(replies)])
 
     def get_property_by_socket(self, property_name):
         """
@@ -129,7 +205,38 @@ class MonkeyController:
                             res.rstrip("\n"))
             raise MonkeyException('Bad data')
 
-        return res.rstrip("\n").lstrip("OK:")
+        res = res.rstrip("\n")
+        return res[3:] if res.startswith('OK:') else ''
+
+    def get_properties_by_socket(self, property_names):
+        """
+        Get several property values with a single round trip: all the
+        getvar commands are pipelined on the socket and the replies
+        (one line each, in order) are read back afterwards.
+
+        Args:
+            property_names (list): the names of the properties to retrieve.
+        Returns:
+            a dictionary mapping each property name to its value
+            (None if monkey replied with an error)
+        """
+        logger.debug(
+            "Getting properties %s via socket %s:%s",
+            ', '.join(property_names), self.pilot.device_address,
+            self.pilot.monkey_server_port)
+
+        lines = self.__communicate(
+            ["getvar %s" % p for p in property_names])
+
+        values = {}
+        for name, line in zip(property_names, lines):
+            if line.startswith('OK'):
+                values[name] = line[3:] if line.startswith('OK:') else ''
+            else:
+                logger.warning('Error in data returned by monkey for %s (%s)',
+                               name, line)
+                values[name] = None
+        return values
 
     def get_display_width(self):
         res = self.get_property_by_socket("display.width")
@@ -152,13 +259,136 @@ class MonkeyController:
         else:
             return None
 
+    def is_process_alive(self):
+        """
+        Check whether the process running the monkey service is still alive.
+        """
+        try:
+            return self.monkey_binder_process.poll() is None
+        except AttributeError:
+            return False
+
+    def recover(self):
+        """
+        Restore the connection after a socket error.
+        When the monkey process is still running only the TCP connection is
+        re-established (milliseconds), otherwise the monkey service is
+        restarted (seconds).
+        """
+        with self.socket_lock:
+            if self.is_process_alive():
+                try:
+                    self.reconnect()
+                    return
+                except (socket.error, MonkeyException):
+                    logger.warning("Unable to reconnect to monkey")
+            self.restart()
+
+    def reconnect(self):
+        """
+        Open a new socket connection to the still running monkey service.
+        """
+        start_time = self.clock()
+        with self.socket_lock:
+            try:
+                self.monkey_socket.close()
+            except:
+                pass
+            try:
+                self.monkey_socket = self.__open_socket_connection()
+            except socket.error:
+                # the port forwarding may have been lost
+                # (e.g. the adb server has been restarted)
+                self.__forward_port()
+                self.monkey_socket = self.__open_socket_connection()
+            self.__ping()
+
+        latency = self.clock() - start_time
+        self.reconnect_count += 1
+        self.reconnect_latencies.append(latency)
+        logger.info("Reconnected to monkey in %.3f seconds", latency)
+
     def restart(self):
         logger.info("Restarting monkey service...")
-        self.close()
-        self.open()
+        start_time = self.clock()
+        with self.socket_lock:
+            self.close()
+            self.open()
+
+        self.restart_count += 1
+        self.restart_latencies.append(self.clock() - start_time)
+
+    def get_connection_stats(self):
+        """
+        Return the counters and the latencies (in seconds) of the
+        connection recoveries.
+        """
+        def _summary(latencies):
+            if not latencies:
+                return {'last': None, 'mean': None, 'max': None}
+            return {'last': latencies[-1],
+                    'mean': sum(latencies) / len(latencies),
+                    'max': max(latencies)}
+
+        return {
+            'reconnect_count': self.reconnect_count,
+            'restart_count': self.restart_count,
+            'keepalive_failures': self.keepalive_failures,
+            'reconnect_latency': _summary(self.reconnect_latencies),
+            'restart_latency': _summary(self.restart_latencies),
+        }
+
+    def __ping(self):
+        """
+        Send the keepalive command, failing fast if monkey does not reply.
+        """
+        self.monkey_socket.settimeout(KEEPALIVE_TIMEOUT)
+        try:
+            self.monkey_socket.sendall(KEEPALIVE_COMMAND + "\n")
+            self.__read_replies(1, [])
+        finally:
+            self.monkey_socket.settimeout(None)
+        self.last_activity = self.clock()
+
+    def __start_keepalive(self):
+        if not self.keepalive_interval:
+            return
+        # each keepalive thread gets its own stop event, so that a restart
+        # triggered by the thread itself does not stop the new one
+        self.keepalive_stop = threading.Event()
+        keepalive_thread = threading.Thread(
+            target=self.__keepalive_loop, args=(self.keepalive_stop,),
+            name='monkey-keepalive-%s' % self.pilot.device_name)
+        keepalive_thread.daemon = True
+        keepalive_thread.start()
+
+    def __keepalive_loop(self, stop):
+        while not stop.wait(self.keepalive_interval):
+            if self.clock() - self.last_activity < \
+                    self.keepalive_interval:
+                # the connection has been used recently, no need to probe it
+                continue
+            # never delay a caller: if the socket is busy it is alive
+            if not self.socket_lock.acquire(False):
+                continue
+            try:
+                if stop.is_set():
+                    break
+                self.__ping()
+            except socket.error:
+                self.keepalive_failures += 1
+                logger.warning("Monkey keepalive failed, recovering...")
+                try:
+                    self.recover()
+                except Exception:
+                    logger.exception("Unable to recover monkey connection")
+            finally:
+                self.socket_lock.release()
 
     def close(self):
         logger.info("Closing monkey service...")
+        if self.keepalive_stop is not None:
+            self.keepalive_stop.set()
         try:
             self.monkey_socket.sendall("quit\n")
         except:
@@ -265,13 +495,21 @@ class MonkeyController:
 #         command = "key up %s" % name
 #         return self.send_by_socket(command)
 
-    def type(self, text):
+    def type_commands(self, text):
+        """
+        Return the monkey commands typing text.
+        """
         words = re.split('(\s+)', text)
         words = [62 if w == ' ' else w for w in words]
 
+        commands = []
         for w in words:
             if isinstance(w, (int, long)):
-                cmd = "key down %s" % w
+                commands.append("key down %s" % w)
             else:
-                cmd = "type %s" % w
+                commands.append("type %s" % w)
+        return commands
+
+    def type(self, text):
+        for cmd in self.type_commands(text):
             self.send_by_socket(cmd)
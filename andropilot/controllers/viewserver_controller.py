@@ -1,16 +1,76 @@
 import socket
+import threading
 import time
 import logging
+import zlib
 
 import viewserver_parser as vs_parser
 
 logger = logging.getLogger('viewserver')
 
+# port the ViewServer listens to on the device, every device has its own
+# so only the local (forwarded) port must be unique on the host
+DEVICE_PORT = 4939
+
+WATCHER_CONNECT_TIMEOUT = 5
+WATCHER_POLL_TIMEOUT = 1.0
+# the AUTOLIST connection is not reopened after this many failures
+WATCHER_MAX_STARTS = 3
+
 
 class ViewServerException(Exception):
     pass
 
 
+class WindowListWatcher(threading.Thread):
+
+    """
+    Keeps an AUTOLIST connection to the ViewServer open and counts the
+    window list changes it notifies ("LIST UPDATE").
+    """
+
+    def __init__(self, address, port):
+        threading.Thread.__init__(self, name='viewserver-autolist')
+        self.daemon = True
+        self.address = address
+        self.port = port
+        self.version = 0
+        self.connected = False
+        self.stop_event = threading.Event()
+
+    def run(self):
+        s = None
+        try:
+            s = socket.create_connection((self.address, self.port),
+                                         WATCHER_CONNECT_TIMEOUT)
+            s.sendall(ViewServerController.autolist_cmd + '\n')
+            s.settimeout(WATCHER_POLL_TIMEOUT)
+            self.connected = True
+            pending = ''
+            while not self.stop_event.is_set():
+                try:
+                    data = s.recv(1024)
+                except socket.timeout:
+                    continue
+                if not data:
+                    break
+                pending += data
+                lines = pending.split('\n')
+                pending = lines.pop()
+                for line in lines:
+                    if line.startswith('LIST UPDATE'):
+                        self.version += 1
+        except socket.error:
+            logger.debug("AUTOLIST connection failed", exc_info=True)
+        finally:
+            self.connected = False
+            if s is not None:
+                s.close()
+
+    def stop(self):
+        self.stop_event.set()
+
+
 class ViewServerController:
     DUMP_ALL_CMD = "DUMP -1"
     GET_FOCUS_CMD = "GET_FOCUS"
@@ -28,6 +88,8 @@ class ViewServerController:
 
     def __init__(self, pilot):
         self.pilot = pilot
+        self.window_watcher = None
+        self.watcher_starts = 0
 
     def open(self):
         self.__stop_service()
@@ -35,14 +97,39 @@ class ViewServerController:
         self.__forward_port()
 
     def close(self):
+        self.__stop_watcher()
         self.__stop_service()
 
+    def get_window_list_version(self):
+        """
+        Return a number that changes whenever the window list changes, or
+        None if the changes cannot be followed (the window list must then
+        be considered changed).
+        """
+        watcher = self.window_watcher
+        if watcher is None or not watcher.is_alive():
+            if self.watcher_starts >= WATCHER_MAX_STARTS:
+                return None
+            self.watcher_starts += 1
+            self.window_watcher = WindowListWatcher(
+                self.pilot.device_address, self.pilot.view_server_port)
+            self.window_watcher.start()
+            return None
+        if not watcher.connected:
+            return None
+        return watcher.version
+
+    def __stop_watcher(self):
+        if self.window_watcher is not None:
+            self.window_watcher.stop()
+            self.window_watcher = None
+
     def __start_service(self):
         logger.info("Starting ViewServer service...")
-        start_cmd = ['shell', 'service', 'call', 'window',
-                     '1', 'i32', '4939']
+        start_cmd = ['service', 'call', 'window', '1', 'i32',
+                     str(DEVICE_PORT)]
 
-        self.pilot.adb_command(start_cmd)
+        self.pilot.shell(start_cmd)
         time.sleep(0.5)
         # the output of starting/stopping viewserver can be:
         # "Result: Parcel(00000000 00000001   '........')"
@@ -50,19 +137,26 @@ class ViewServerController:
         # "Result: Parcel(00000000 00000000   '........')""
 
     def __stop_service(self):
-        stop_cmd = ['shell', 'service', 'call', 'window', '2']
-        self.pilot.adb_command(stop_cmd)
+        stop_cmd = ['service', 'call', 'window', '2']
+        self.pilot.shell(stop_cmd)
         time.sleep(0.5)
 
     def __forward_port(self):
         forward_cmd = ['forward', 'tcp:%s' % self.pilot.view_server_port,
-                       'tcp:4939']
+                       'tcp:%s' % DEVICE_PORT]
 
         res = self.pilot.adb_command(forward_cmd, blocking=True)
         if res != 0:
             raise ViewServerException('Could not forward port %s', forward_cmd)
 
     def get_data_by_socket(self, command):
+        with self.pilot.probe('viewserver_transfer', 'viewserver',
+                              {'command': command.split(' ', 1)[0]}) as probe:
+            data = self.__get_data_by_socket(command)
+            probe.set(bytes=len(data))
+        return data
+
+    def __get_data_by_socket(self, command):
         s = socket.socket()
         s.connect((self.pilot.device_address, self.pilot.view_server_port))
         # s.setblocking(0)
@@ -109,8 +203,43 @@ class ViewServerController:
         activity_list_pairs = [tuple(a.split(' ')) for a in activity_list]
         return activity_list_pairs
 
+    def get_tree_fingerprint(self):
+        """
+        Return a checksum of the raw view tree dump, without parsing it:
+        two equal fingerprints mean that nothing changed on the screen.
+        """
+        return zlib.crc32(self.__dump_all()) & 0xffffffff
+
+    def get_window_fingerprint(self, include_windows=True):
+        """
+        Return a cheap fingerprint of the focused window (and of the window
+        list if include_windows is set), without dumping the view tree.
+        The window list version is used when available, otherwise the
+        window list is fetched with LIST.
+        """
+        fingerprint = zlib.crc32(self.get_data_by_socket(self.GET_FOCUS_CMD))
+        if include_windows:
+            version = self.get_window_list_version()
+            if version is None:
+                fingerprint = zlib.crc32(
+                    self.get_data_by_socket(self.LIST_VIEW_CMD), fingerprint)
+            else:
+                fingerprint = (version, fingerprint)
+        return fingerprint
+
     def refresh_view(self):
         # dump the displayed views
         data = self.__dump_all()
         # rebuild the tree using the dumped data
-        self.tree_nodes_list = vs_parser.build_tree(data)
+        self.tree_nodes_list = self.build_tree(data)
+
+    def build_tree(self, data):
+        """
+        Parse a view tree dump (see viewserver_parser.build_tree), timing
+        the parsing.
+        """
+        with self.pilot.probe('build_tree', 'parser') as probe:
+            tree_nodes_list = vs_parser.build_tree(data)
+            probe.set(nodes=len(tree_nodes_list), bytes=len(data))
+            probe.set_payload(data)
+        return tree_nodes_list
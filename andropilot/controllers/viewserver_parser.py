@@ -1,7 +1,14 @@
+import hashlib
 import logging
 
 logger = logging.getLogger('viewserver')
 
+# the node properties covered by the structural hash (the hashcode is left
+# out, it changes every time the view is created)
+HASHED_PROPERTIES = ('mClassName', 'mId', 'mText', 'mLeft', 'mTop', 'width',
+                     'height', 'mScrollX', 'mScrollY', 'mVisible',
+                     'isClickable', 'isEnabled', 'hasFocus')
+
 
 class Rect:
     mLeft = 0
@@ -89,6 +96,9 @@ class VSNode(object):
     mScrollX = 0
     mScrollY = 0
     mClickable = False
+    # hash of the node own properties and of the whole subtree
+    mPropertiesHash = None
+    mHash = None
 
     def get_all_children(self):
         children = self.mChildNodes
@@ -133,6 +143,23 @@ class VSNode(object):
     def __str__(self):
         return self.mId + ' ' + self.mClassName
 
+    def _set_hash(self):
+        """
+        Set the node hashes, its children hashes must be already set.
+        """
+        values = []
+        for name in HASHED_PROPERTIES:
+            value = getattr(self, name, None)
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            values.append(str(value))
+        self.mPropertiesHash = hashlib.sha1('\x00'.join(values)).hexdigest()
+
+        subtree_hash = hashlib.sha1(self.mPropertiesHash)
+        for c in self.mChildNodes:
+            subtree_hash.update(c.mHash)
+        self.mHash = subtree_hash.hexdigest()
+
     @classmethod
     def _create_node_from_data(cls, data=''):
         # create a new node to be filled with the parsed data
@@ -244,6 +271,8 @@ def build_tree(dump_data):
     # elements_indents_list is a list of pairs,
     # i.e. [(element_indentation, element) ...]
     tree_nodes_list = []
+    # nodes whose subtree has not been completely visited yet
+    open_nodes = []
 
     for idx, (depth, el) in enumerate(elements_indents_list):
         # the depth of the node is given by its indentation
@@ -254,6 +283,12 @@ def build_tree(dump_data):
         node.mDepth = depth
         node.mChildNodes = []
 
+        # the subtrees of the open nodes at the same or deeper level are
+        # complete: hash them (children before parents)
+        while open_nodes and open_nodes[-1].mDepth >= depth:
+            open_nodes.pop()._set_hash()
+        open_nodes.append(node)
+
         if depth == 0:
             # it is a root node, no parent node
             node.mParentNode = None
@@ -292,10 +327,55 @@ def build_tree(dump_data):
 
         tree_nodes_list.append(node)
 
+    while open_nodes:
+        open_nodes.pop()._set_hash()
+
     # return the built tree as a list of VSNode
     return tree_nodes_list
 
 
+def get_tree_hash(tree_nodes_list):
+    """
+    Return the hash of a whole view tree: two screens with the same
+    hash show the same views, with the same properties.
+    """
+    roots = [n for n in tree_nodes_list if n.mParentNode is None]
+    if len(roots) == 1:
+        return roots[0].mHash
+    tree_hash = hashlib.sha1()
+    for root in roots:
+        tree_hash.update(root.mHash)
+    return tree_hash.hexdigest()
+
+
+def find_changed_nodes(old_tree_nodes_list, new_tree_nodes_list):
+    """
+    Return the nodes of the new tree where the changes from the old tree
+    are located: the subtrees whose hash is found in the old tree are
+    skipped, and of the others only the nodes whose own properties changed
+    (or whose children were added or removed) are returned.
+    """
+    old_hashes = set(n.mHash for n in old_tree_nodes_list)
+    old_properties_hashes = set(n.mPropertiesHash
+                                for n in old_tree_nodes_list)
+
+    changed = []
+    stack = [n for n in reversed(new_tree_nodes_list)
+             if n.mParentNode is None]
+    while stack:
+        node = stack.pop()
+        if node.mHash in old_hashes:
+            # the whole subtree is unchanged
+            continue
+        new_children = [c for c in node.mChildNodes
+                        if c.mHash not in old_hashes]
+        if node.mPropertiesHash not in old_properties_hashes or \
+                not new_children:
+            changed.append(node)
+        stack.extend(reversed(new_children))
+    return changed
+
+
 # EXPERIMENTAL #
 def get_dot_graph(tree_nodes_list):
     dot_graph = ""
@@ -0,0 +1,183 @@
+import json
+import logging
+import math
+import os
+import tempfile
+import threading
+
+logger = logging.getLogger('andropilot')
+
+DEFAULT_CACHE_PATH = os.path.join(
+    os.path.expanduser('~'), '.andropilot', 'device_profiles.json')
+
+FINGERPRINT_PROPERTY = 'build.fingerprint'
+
+# monkey variables fetched (in a single batch) to build a device profile
+PROFILE_PROPERTIES = [
+    FINGERPRINT_PROPERTY,
+    'build.version.sdk',
+    'build.version.release',
+    'build.model',
+    'build.product',
+    'display.width',
+    'display.height',
+    'display.density',
+]
+
+# status bar height in dp, it changed from 25dp to 24dp with Marshmallow
+STATUSBAR_HEIGHT_DP = 25
+STATUSBAR_HEIGHT_DP_23 = 24
+
+# the caches of a process sharing a file share its lock
+_path_locks = {}
+_path_locks_lock = threading.Lock()
+
+
+def _path_lock(path):
+    if path is None:
+        return threading.Lock()
+    with _path_locks_lock:
+        return _path_locks.setdefault(os.path.abspath(path),
+                                      threading.Lock())
+
+
+class DeviceProfile(object):
+
+    """
+    The static facts about a device (API level, display size...) built
+    from the values of the monkey variables in PROFILE_PROPERTIES.
+    """
+
+    def __init__(self, serial, properties):
+        self.serial = serial
+        self.properties = dict(properties)
+
+        self.fingerprint = self.properties.get(FINGERPRINT_PROPERTY)
+        self.api_level = self._get_int('build.version.sdk')
+        self.display_width = self._get_int('display.width')
+        self.display_height = self._get_int('display.height')
+
+        try:
+            self.density = float(self.properties.get('display.density'))
+        except (TypeError, ValueError):
+            self.density = 1.0
+
+        if self.api_level is not None and self.api_level >= 23:
+            statusbar_dp = STATUSBAR_HEIGHT_DP_23
+        else:
+            statusbar_dp = STATUSBAR_HEIGHT_DP
+        self.statusbar_height = int(math.ceil(statusbar_dp * self.density))
+
+    def _get_int(self, name):
+        try:
+            return int(self.properties.get(name))
+        except (TypeError, ValueError):
+            return None
+
+    @classmethod
+    def fetch(cls, monkey_controller, serial):
+        """
+        Build the profile of the device by querying all the
+        PROFILE_PROPERTIES with one monkey round trip.
+        """
+        properties = monkey_controller.get_properties_by_socket(
+            PROFILE_PROPERTIES)
+        return cls(serial, properties)
+
+
+class DeviceProfileCache(object):
+
+    """
+    On-disk cache of the device profiles, keyed by device serial and
+    build fingerprint.
+    A path set to None keeps the cache in memory only.
+    Saving merges the entries written to the file in the meantime by
+    other caches, so concurrent writers do not drop each other's
+    profiles.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH):
+        self.path = path
+        self.lock = _path_lock(path)
+        self.entries = None
+
+    def _key(self, serial, fingerprint):
+        return '%s|%s' % (serial, fingerprint)
+
+    def _read(self):
+        if self.path is None or not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            logger.warning("Unable to read device profile cache %s",
+                           self.path)
+            return {}
+
+    def _load(self):
+        if self.entries is None:
+            self.entries = self._read()
+
+    def _save(self):
+        if self.path is None:
+            return
+        entries = self._read()
+        entries.update(self.entries)
+        self.entries = entries
+        tmp_path = None
+        try:
+            directory = os.path.dirname(os.path.abspath(self.path))
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            # write to a temporary file of the same directory first, so
+            # that concurrent readers never see a partially written cache
+            fd, tmp_path = tempfile.mkstemp(
+                prefix=os.path.basename(self.path) + '.', suffix='.tmp',
+                dir=directory)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entries, f, indent=1, sort_keys=True)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError):
+            logger.warning("Unable to write device profile cache %s",
+                           self.path)
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def get(self, serial, fingerprint):
+        with self.lock:
+            self._load()
+            properties = self.entries.get(self._key(serial, fingerprint))
+        if properties is None:
+            return None
+        return DeviceProfile(serial, properties)
+
+    def put(self, profile):
+        with self.lock:
+            self._load()
+            self.entries[self._key(profile.serial, profile.fingerprint)] = \
+                profile.properties
+            self._save()
+
+
+def load_profile(monkey_controller, serial, cache=None):
+    """
+    Return the DeviceProfile of the device.
+    When a cache is given, only the build fingerprint is queried: on a hit
+    the cached profile is returned, otherwise the full profile is fetched
+    and stored.
+    """
+    if cache is None:
+        return DeviceProfile.fetch(monkey_controller, serial)
+
+    fingerprint = monkey_controller.get_property_by_socket(
+        FINGERPRINT_PROPERTY)
+    profile = cache.get(serial, fingerprint)
+    if profile is not None:
+        logger.debug("Device profile for %s loaded from cache", serial)
+        return profile
+
+    profile = DeviceProfile.fetch(monkey_controller, serial)
+    if profile.fingerprint:
+        cache.put(profile)
+    return profile
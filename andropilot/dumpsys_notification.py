@@ -0,0 +1,188 @@
+import collections
+import logging
+import re
+
+from notification import NotificationWaits
+
+TIMEOUT = 120
+
+logger = logging.getLogger(__name__)
+
+DUMPSYS_CMD = 'dumpsys notification'
+# since API level 26 the texts are redacted unless --noredact is given
+NOREDACT_API_LEVEL = 26
+NOREDACT_CMD = DUMPSYS_CMD + ' --noredact'
+
+RECORD_MARKER_RE = re.compile(r'NotificationRecord[({]')
+PACKAGE_RE = re.compile(r'\bpkg=(\S+)')
+ID_RE = re.compile(r'\bid=(-?\d+)')
+TAG_RE = re.compile(r'\btag=(\S+?)(?=[\s)}]|$)')
+KEY_RE = re.compile(r'\bkey=(\S+?):?(?=\s|$)')
+FLAGS_RE = re.compile(r'\bflags=(0x[0-9a-fA-F]+)')
+# extras values look like "String (text)" (or just "text" on some levels)
+EXTRA_RE = re.compile(r'^\s*android\.(title|text|bigText|subText)=(.*)$')
+TYPED_VALUE_RE = re.compile(r'^\w+ \((.*)\)$')
+# a redacted text shows only its type
+REDACTED_VALUE_RE = re.compile(
+    r'^(String|SpannableString|SpannedString|SpannableStringBuilder)$')
+TICKER_RE = re.compile(r'^\s*tickerText=(.*)$')
+
+NotificationRecord = collections.namedtuple(
+    'NotificationRecord', 'key package id tag title text ticker flags')
+
+
+def _value(value):
+    value = value.strip()
+    if REDACTED_VALUE_RE.match(value):
+        return None
+    match = TYPED_VALUE_RE.match(value)
+    if match is not None:
+        value = match.group(1)
+    return None if value == 'null' else value
+
+
+def _indentation(line):
+    return len(line) - len(line.lstrip(' '))
+
+
+def _make_record(header, body):
+    package = PACKAGE_RE.search(header)
+    ident = ID_RE.search(header)
+    if package is None or ident is None:
+        return None
+    tag = TAG_RE.search(header)
+    tag = tag.group(1) if tag and tag.group(1) != 'null' else None
+    key = KEY_RE.search(header)
+    flags = FLAGS_RE.search(header) or FLAGS_RE.search('\n'.join(body))
+
+    fields = {}
+    ticker = None
+    for line in body:
+        match = EXTRA_RE.match(line)
+        if match is not None:
+            fields.setdefault(match.group(1), _value(match.group(2)))
+            continue
+        match = TICKER_RE.match(line)
+        if match is not None:
+            ticker = _value(match.group(1))
+
+    package = package.group(1)
+    ident = int(ident.group(1))
+    return NotificationRecord(
+        key.group(1) if key else '%s|%d|%s' % (package, ident, tag),
+        package, ident, tag, fields.get('title'),
+        fields.get('text') or fields.get('bigText'), ticker,
+        int(flags.group(1), 16) if flags else 0)
+
+
+def dumpsys_command(api_level):
+    """
+    Return the dumpsys command listing the notifications with their texts.
+    """
+    if api_level is not None and api_level >= NOREDACT_API_LEVEL:
+        return NOREDACT_CMD
+    return DUMPSYS_CMD
+
+
+def parse_notifications(output):
+    """
+    Parse the output of dumpsys notification into NotificationRecord
+    tuples, the ones of the "Notification List" section only (if there
+    is one).
+    """
+    lines = output.splitlines()
+    section = next((i for i, l in enumerate(lines)
+                    if l.strip() == 'Notification List:'), None)
+    if section is not None:
+        section_indentation = _indentation(lines[section])
+        end = next((i for i in xrange(section + 1, len(lines))
+                    if lines[i].strip() and
+                    _indentation(lines[i]) <= section_indentation),
+                   len(lines))
+        lines = lines[section + 1:end]
+
+    records = []
+    header = None
+    body = []
+    for line in lines:
+        if RECORD_MARKER_RE.search(line):
+            if header is not None:
+                records.append(_make_record(header, body))
+            header = line
+            body = []
+        elif header is not None:
+            body.append(line)
+    if header is not None:
+        records.append(_make_record(header, body))
+    return [r for r in records if r is not None]
+
+
+class DumpsysNotificationManager(NotificationWaits):
+
+    """
+    Notifications read from dumpsys notification with one shell command,
+    with no UI interaction: it works on any API level, without opening
+    the notification bar. Same queries and waits as NotificationManager,
+    returning NotificationRecord tuples.
+    """
+
+    def __init__(self, pilot):
+        self.pilot = pilot
+        self.records = []
+        self.records_by_key = {}
+        self.records_by_package = {}
+        # the changes of the last refresh
+        self.added_records = []
+        self.removed_records = []
+        self.updated_records = []
+        self.last_output = None
+
+    def refresh(self):
+        """
+        Update the records, returns True if they changed.
+        """
+        output, _ = self.pilot.shell(dumpsys_command(
+            getattr(self.pilot, 'device_api_level', None)))
+        if output == self.last_output:
+            self.added_records = []
+            self.removed_records = []
+            self.updated_records = []
+            return False
+        self.last_output = output
+
+        previous = self.records_by_key
+        self.records = parse_notifications(output)
+        self.records_by_key = dict((r.key, r) for r in self.records)
+        self.records_by_package = {}
+        for r in self.records:
+            self.records_by_package.setdefault(r.package, []).append(r)
+
+        self.added_records = [r for r in self.records
+                              if r.key not in previous]
+        self.updated_records = [r for r in self.records
+                                if r.key in previous and
+                                previous[r.key] != r]
+        self.removed_records = [r for key, r in previous.items()
+                                if key not in self.records_by_key]
+        return bool(self.added_records or self.updated_records or
+                    self.removed_records)
+
+    def __find(self, field, text, partial_matching):
+        if partial_matching:
+            return [r for r in self.records
+                    if text in (getattr(r, field) or '')]
+        return [r for r in self.records if getattr(r, field) == text]
+
+    def get_notifications_by_title(self, text, partial_matching=True):
+        return self.__find('title', text, partial_matching)
+
+    def get_notifications_by_message(self, text, partial_matching=True):
+        return self.__find('text', text, partial_matching)
+
+    def get_notifications_by_package(self, package):
+        return list(self.records_by_package.get(package, []))
+
+    def wait_for_notification_by_package(self, package, timeout=TIMEOUT):
+        return self._wait_for_notification(
+            lambda: self.get_notifications_by_package(package),
+            timeout, 'notification of %s' % package)
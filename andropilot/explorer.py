@@ -0,0 +1,235 @@
+import collections
+import hashlib
+import logging
+import re
+
+import wait
+
+logger = logging.getLogger('andropilot')
+
+DEFAULT_TIME_BUDGET = 300  # seconds
+SETTLE_QUIET_PERIOD = 0.3
+SETTLE_TIMEOUT = 5
+
+# clickable texts are compared up to this length, with digits masked
+MAX_TEXT_LENGTH = 40
+DIGITS_RE = re.compile(r'\d+')
+
+BACK_KEY = 'back'
+
+
+# an action of a screen: the key identifies the same clickable view across
+# visits, x and y are the screen coordinates to tap (None for back)
+Target = collections.namedtuple('Target', 'key x y description')
+
+BACK = Target(BACK_KEY, None, None, 'back')
+
+
+def normalize_text(text):
+    """
+    Mask the volatile parts of a text (clocks, counters) so that it
+    identifies the same view across visits.
+    """
+    if not text:
+        return u''
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'replace')
+    return DIGITS_RE.sub(u'#', text.strip())[:MAX_TEXT_LENGTH]
+
+
+def _is_clickable(node):
+    return node.isShown and getattr(node, 'isClickable', False) and \
+        getattr(node, 'isEnabled', True)
+
+
+def state_fingerprint(activity, tree_nodes_list):
+    """
+    Fingerprint of a screen: its activity and the structure of its shown
+    views (class, id, depth), with the normalized text of the clickable
+    ones only. The texts of the other views and the positions are left
+    out, so that content updates do not make a new state.
+    """
+    fingerprint = hashlib.sha1(activity or '')
+    for node in tree_nodes_list:
+        if not node.isShown:
+            continue
+        text = normalize_text(node.mText) if _is_clickable(node) else u''
+        fingerprint.update('%d\x00%s\x00%s\x00%s\n' % (
+            node.mDepth, node.mClassName, node.mId, text.encode('utf-8')))
+    return fingerprint.hexdigest()
+
+
+def clickable_targets(tree_nodes_list, y_offset=0):
+    """
+    Return a Target for every shown, enabled and clickable view, in tree
+    order. y_offset is added to the window coordinates (the status bar).
+    """
+    targets = []
+    occurrences = {}
+    for node in tree_nodes_list:
+        if not _is_clickable(node):
+            continue
+        left, top, right, bottom = node.get_absolute_rect()
+        if right <= left or bottom <= top:
+            continue
+        base = (node.mClassName, node.mId, normalize_text(node.mText))
+        index = occurrences.get(base, 0)
+        occurrences[base] = index + 1
+        key = u'%s|%s|%s|%d' % (base + (index,))
+        targets.append(Target(key, (left + right) // 2,
+                              (top + bottom) // 2 + y_offset,
+                              node.mId or node.mText or node.mClassName))
+    return targets
+
+
+class ScreenState(object):
+
+    def __init__(self, fingerprint, activity, targets):
+        self.fingerprint = fingerprint
+        self.activity = activity
+        self.targets = targets
+        self.visits = 0
+
+
+class Explorer(object):
+
+    """
+    Explores the UI of the app in the foreground by tapping its clickable
+    views and pressing back, under a time budget.
+
+    Screens are deduplicated by fingerprint (see state_fingerprint) into a
+    graph of the observed transitions. Untried actions of the current
+    screen come first, preferring the views never tapped on any screen;
+    when the screen is exhausted, the explorer moves along the graph
+    towards the nearest screen with untried actions.
+    """
+
+    def __init__(self, pilot, time_budget=DEFAULT_TIME_BUDGET,
+                 max_actions=None, quiet_period=SETTLE_QUIET_PERIOD,
+                 settle_timeout=SETTLE_TIMEOUT):
+        self.pilot = pilot
+        self.time_budget = time_budget
+        self.max_actions = max_actions
+        self.quiet_period = quiet_period
+        self.settle_timeout = settle_timeout
+
+        # fingerprint -> ScreenState
+        self.states = collections.OrderedDict()
+        # fingerprint -> {action key: fingerprint reached}
+        self.transitions = {}
+        # the (fingerprint, action key) pairs already tried
+        self.tried = set()
+        # action key -> times it has been tried, on any screen
+        self.key_counts = collections.Counter()
+        self.actions_count = 0
+        self.elapsed = 0
+
+    def observe(self):
+        """
+        Refresh the view tree and return the state of the screen.
+        """
+        self.pilot.refresh()
+        activity = self.pilot.get_focus_activity()
+        tree_nodes_list = self.pilot.viewserver_controller.tree_nodes_list
+        fingerprint = state_fingerprint(activity, tree_nodes_list)
+        state = self.states.get(fingerprint)
+        if state is None:
+            state = ScreenState(fingerprint, activity, clickable_targets(
+                tree_nodes_list, self.pilot.statusbar_height))
+            self.states[fingerprint] = state
+            logger.info("New screen %s (%s), %d clickable views",
+                        fingerprint[:8], activity, len(state.targets))
+        state.visits += 1
+        return state
+
+    def untried_targets(self, state):
+        return [t for t in state.targets
+                if (state.fingerprint, t.key) not in self.tried]
+
+    def __has_untried(self, fingerprint):
+        return bool(self.untried_targets(self.states[fingerprint]))
+
+    def __first_step_to_unexplored(self, state):
+        """
+        Return the first action of the shortest known path to a screen
+        with untried actions, None if there is none.
+        """
+        first_steps = {state.fingerprint: None}
+        queue = collections.deque([state.fingerprint])
+        while queue:
+            fingerprint = queue.popleft()
+            for key, reached in self.transitions.get(fingerprint,
+                                                     {}).items():
+                if reached in first_steps:
+                    continue
+                first_steps[reached] = first_steps[fingerprint] or key
+                if self.__has_untried(reached):
+                    return first_steps[reached]
+                queue.append(reached)
+        return None
+
+    def next_action(self, state):
+        """
+        Return the Target to act on, None if the exploration is over.
+        """
+        untried = self.untried_targets(state)
+        if untried:
+            # min() keeps the tree order among the equally tried views
+            return min(untried, key=lambda t: self.key_counts[t.key])
+
+        key = self.__first_step_to_unexplored(state)
+        if key is not None:
+            return next((t for t in state.targets + [BACK] if t.key == key),
+                        BACK)
+        if not any(self.__has_untried(f) for f in self.states):
+            return None
+        if self.transitions.get(state.fingerprint, {}).get(BACK_KEY) == \
+                state.fingerprint:
+            # stuck: back does not leave this screen
+            return None
+        return BACK
+
+    def perform(self, target):
+        if target.key == BACK_KEY:
+            self.pilot.press_back()
+        else:
+            self.pilot.tap_on_coordinates(target.x, target.y)
+        self.pilot.wait_for_idle(quiet_period=self.quiet_period,
+                                 timeout=self.settle_timeout)
+
+    def explore(self):
+        """
+        Explore until the time budget (or max_actions) is exhausted or no
+        reachable screen has untried actions. Returns get_stats().
+        """
+        start_time = wait.monotonic()
+        deadline = start_time + self.time_budget
+        state = self.observe()
+        while wait.monotonic() < deadline and (
+                self.max_actions is None or
+                self.actions_count < self.max_actions):
+            target = self.next_action(state)
+            if target is None:
+                break
+            self.tried.add((state.fingerprint, target.key))
+            self.key_counts[target.key] += 1
+            self.actions_count += 1
+            logger.debug("Screen %s: %s", state.fingerprint[:8],
+                         target.description)
+            self.perform(target)
+
+            reached = self.observe()
+            self.transitions.setdefault(state.fingerprint, {})[
+                target.key] = reached.fingerprint
+            state = reached
+        self.elapsed += wait.monotonic() - start_time
+        return self.get_stats()
+
+    def get_stats(self):
+        minutes = self.elapsed / 60.0
+        return {'states': len(self.states),
+                'actions': self.actions_count,
+                'transitions': sum(len(t) for t in self.transitions.values()),
+                'elapsed': self.elapsed,
+                'states_per_minute': len(self.states) / minutes
+                if minutes else 0.0}
@@ -0,0 +1,430 @@
+import collections
+import logging
+import multiprocessing
+import Queue
+import socket
+import subprocess
+import threading
+import traceback
+
+from pilot import AndroPilot
+
+logger = logging.getLogger('farm')
+
+THREAD_WORKERS = 'thread'
+PROCESS_WORKERS = 'process'
+
+FIRST_LOCAL_PORT = 20000
+LAST_LOCAL_PORT = 30000
+
+# consecutive job failures after which a device session is reopened
+MAX_CONSECUTIVE_FAILURES = 3
+# failed reopen attempts after which a device is excluded from the pool
+MAX_REOPEN_FAILURES = 2
+
+DEFAULT_GROUP = 'default'
+
+
+class FarmException(Exception):
+    pass
+
+
+def discover_devices(adb_client=None):
+    """
+    Return the serials of the devices (and emulators) that are online.
+    """
+    if adb_client is not None:
+        devices = adb_client.devices()
+    else:
+        output = subprocess.check_output(['adb', 'devices'])
+        devices = [tuple(line.split('\t', 1))
+                   for line in output.splitlines() if '\t' in line]
+    return [serial for serial, state in devices if state.strip() == 'device']
+
+
+class PortAllocator(object):
+
+    """
+    Hands out local TCP ports that are free on the host and not allocated
+    yet, so that the forwarded ports of different devices do not collide.
+    Released ports are handed out again before new ones.
+    """
+
+    def __init__(self, first_port=FIRST_LOCAL_PORT, last_port=LAST_LOCAL_PORT):
+        self.next_port = first_port
+        self.last_port = last_port
+        self.allocated = set()
+        self.released = collections.deque()
+        self.lock = threading.Lock()
+
+    def _is_free(self, port):
+        s = socket.socket()
+        try:
+            s.bind(('127.0.0.1', port))
+            return True
+        except socket.error:
+            return False
+        finally:
+            s.close()
+
+    def allocate(self):
+        with self.lock:
+            while self.released:
+                port = self.released.popleft()
+                if self._is_free(port):
+                    self.allocated.add(port)
+                    return port
+            while self.next_port <= self.last_port:
+                port = self.next_port
+                self.next_port += 1
+                if port not in self.allocated and self._is_free(port):
+                    self.allocated.add(port)
+                    return port
+        raise FarmException('No free local port left')
+
+    def release(self, port):
+        with self.lock:
+            if port in self.allocated:
+                self.allocated.remove(port)
+                self.released.append(port)
+
+
+class Job(object):
+
+    """
+    A unit of work submitted to the pool: function(pilot, *args, **kwargs)
+    is run on the first available device.
+    """
+
+    def __init__(self, function, args, kwargs, group):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.group = group
+        self.serial = None
+        self.value = None
+        self.error = None
+        self.done = threading.Event()
+
+    def set_result(self, value, error=None):
+        self.value = value
+        self.error = error
+        self.done.set()
+
+    def result(self, timeout=None):
+        """
+        Wait for the job to complete and return its result, raising the
+        exception raised by the job (if any).
+        """
+        if not self.done.wait(timeout):
+            raise FarmException('Job not completed')
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class FairQueue(object):
+
+    """
+    Job queue serving the submission groups in round robin, so that a
+    group submitting many jobs cannot starve the others.
+    """
+
+    def __init__(self):
+        self.queues = collections.OrderedDict()
+        self.condition = threading.Condition()
+        self.closed = False
+
+    def put(self, job):
+        with self.condition:
+            self.queues.setdefault(job.group, collections.deque()).append(job)
+            self.condition.notify()
+
+    def get(self):
+        """
+        Return the next job, or None once the queue is closed.
+        """
+        with self.condition:
+            while not self.queues and not self.closed:
+                self.condition.wait()
+            if not self.queues:
+                return None
+            group, queue = self.queues.popitem(last=False)
+            job = queue.popleft()
+            if queue:
+                # the group goes back at the end of the round
+                self.queues[group] = queue
+            return job
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def __len__(self):
+        with self.condition:
+            return sum(len(q) for q in self.queues.values())
+
+
+def _process_worker(pilot_options, tasks, results):
+    """
+    Body of the process owning the session of a device in process mode.
+    """
+    pilot = AndroPilot(**pilot_options)
+    try:
+        pilot.open()
+    except Exception:
+        results.put((False, traceback.format_exc()))
+        return
+    results.put((True, None))
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            function, args, kwargs = task
+            try:
+                results.put((True, function(pilot, *args, **kwargs)))
+            except Exception:
+                results.put((False, traceback.format_exc()))
+    finally:
+        pilot.close()
+
+
+class DeviceSlot(object):
+
+    """
+    A device of the pool: its session (or the process owning it), its
+    ports and its health.
+    """
+
+    def __init__(self, serial, pilot_options, workers):
+        self.serial = serial
+        self.pilot_options = pilot_options
+        self.workers = workers
+        self.pilot = None
+        self.process = None
+        self.healthy = False
+        self.busy = False
+        self.jobs_done = 0
+        self.jobs_failed = 0
+        self.consecutive_failures = 0
+        self.reopen_failures = 0
+
+    def open(self):
+        if self.workers == PROCESS_WORKERS:
+            self.tasks = multiprocessing.Queue()
+            self.results = multiprocessing.Queue()
+            self.process = multiprocessing.Process(
+                target=_process_worker,
+                args=(self.pilot_options, self.tasks, self.results),
+                name='farm-%s' % self.serial)
+            self.process.daemon = True
+            self.process.start()
+            ok, error = self.__get_result()
+            if not ok:
+                self.process.join()
+                raise FarmException('Unable to open %s: %s' % (
+                    self.serial, error))
+        else:
+            self.pilot = AndroPilot(**self.pilot_options)
+            self.pilot.open()
+        self.healthy = True
+
+    def close(self):
+        if self.process is not None:
+            self.tasks.put(None)
+            self.process.join(10)
+            if self.process.is_alive():
+                self.process.terminate()
+            self.process = None
+        elif self.pilot is not None:
+            self.pilot.close()
+            self.pilot = None
+
+    def run(self, job):
+        if self.process is not None:
+            self.tasks.put((job.function, job.args, job.kwargs))
+            ok, value = self.__get_result()
+            if not ok:
+                raise FarmException('Job failed on %s:\n%s' % (
+                    self.serial, value))
+            return value
+        return job.function(self.pilot, *job.args, **job.kwargs)
+
+    def __get_result(self):
+        while True:
+            try:
+                return self.results.get(timeout=1)
+            except Queue.Empty:
+                if not self.process.is_alive():
+                    return False, 'worker process died'
+
+    def get_health(self):
+        return {'healthy': self.healthy, 'busy': self.busy,
+                'jobs_done': self.jobs_done, 'jobs_failed': self.jobs_failed,
+                'consecutive_failures': self.consecutive_failures}
+
+
+class DevicePool(object):
+
+    """
+    A pool of opened AndroPilot sessions, one for each device, running the
+    submitted jobs in parallel.
+
+    Every device gets its own local ports and a worker (a thread, or a
+    thread driving a dedicated process) pulling jobs from a fair queue.
+    A device whose jobs keep failing is reopened, and excluded from the
+    pool if it cannot be reopened.
+
+    With PROCESS_WORKERS the jobs are pickled to the device processes:
+    their functions must be defined at module level (no lambdas, nested
+    functions or bound methods), and their arguments and results must be
+    picklable.
+    """
+
+    def __init__(self, serials=None, workers=THREAD_WORKERS,
+                 pilot_options=None, port_allocator=None):
+        if workers not in (THREAD_WORKERS, PROCESS_WORKERS):
+            raise FarmException('Unknown workers type %s' % workers)
+        self.serials = serials
+        self.workers = workers
+        self.pilot_options = pilot_options or {}
+        self.port_allocator = port_allocator or PortAllocator()
+        self.queue = FairQueue()
+        self.slots = []
+        self.threads = []
+        self.lock = threading.Lock()
+        self.active_workers = 0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+    def start(self):
+        serials = self.serials
+        if serials is None:
+            serials = discover_devices()
+        if not serials:
+            raise FarmException('No device available')
+
+        for serial in serials:
+            options = dict(self.pilot_options)
+            options.update({
+                'device_name': serial,
+                'device_address': '127.0.0.1',
+                'view_server_port': self.port_allocator.allocate(),
+                'monkey_server_port': self.port_allocator.allocate(),
+            })
+            self.slots.append(DeviceSlot(serial, options, self.workers))
+
+        # the sessions are opened in parallel by the worker threads
+        self.active_workers = len(self.slots)
+        for slot in self.slots:
+            thread = threading.Thread(target=self.__work, args=(slot,),
+                                      name='farm-%s' % slot.serial)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        self.queue.close()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        for slot in self.slots:
+            self.port_allocator.release(slot.pilot_options['view_server_port'])
+            self.port_allocator.release(
+                slot.pilot_options['monkey_server_port'])
+        self.slots = []
+
+    def submit(self, function, *args, **kwargs):
+        """
+        Queue function(pilot, *args, **kwargs) for execution on a device.
+        The group keyword argument sets the fair queuing group of the job.
+        In process mode function must be picklable (module level).
+        """
+        group = kwargs.pop('group', DEFAULT_GROUP)
+        job = Job(function, args, kwargs, group)
+        # under the lock: a job is either queued before the last worker
+        # fails the queued jobs, or failed here
+        with self.lock:
+            if self.slots and not self.active_workers:
+                job.set_result(None, FarmException('No healthy device left'))
+            else:
+                self.queue.put(job)
+        return job
+
+    def map(self, function, items, group=DEFAULT_GROUP):
+        """
+        Run function(pilot, item) for every item and return the results
+        in order.
+        """
+        jobs = [self.submit(function, item, group=group) for item in items]
+        return [job.result() for job in jobs]
+
+    def get_health(self):
+        return dict((slot.serial, slot.get_health()) for slot in self.slots)
+
+    def __open_slot(self, slot):
+        while slot.reopen_failures < MAX_REOPEN_FAILURES:
+            try:
+                slot.open()
+                slot.consecutive_failures = 0
+                return True
+            except Exception:
+                slot.reopen_failures += 1
+                logger.exception("Unable to open device %s", slot.serial)
+                slot.close()
+        slot.healthy = False
+        logger.error("Device %s excluded from the pool", slot.serial)
+        return False
+
+    def __work(self, slot):
+        if self.__open_slot(slot):
+            try:
+                while True:
+                    job = self.queue.get()
+                    if job is None:
+                        return
+                    self.__run(slot, job)
+                    if slot.consecutive_failures >= MAX_CONSECUTIVE_FAILURES:
+                        logger.warning("Reopening device %s", slot.serial)
+                        slot.close()
+                        if not self.__open_slot(slot):
+                            break
+            finally:
+                slot.close()
+
+        # the device has been excluded from the pool
+        with self.lock:
+            self.active_workers -= 1
+            if self.active_workers:
+                return
+        logger.error("No healthy device left, failing the queued jobs")
+        self.queue.close()
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            job.set_result(None, FarmException('No healthy device left'))
+
+    def __run(self, slot, job):
+        job.serial = slot.serial
+        slot.busy = True
+        try:
+            value = slot.run(job)
+        except Exception as e:
+            slot.jobs_failed += 1
+            slot.consecutive_failures += 1
+            logger.exception("Job failed on device %s", slot.serial)
+            job.set_result(None, e)
+        else:
+            slot.jobs_done += 1
+            slot.consecutive_failures = 0
+            job.set_result(value)
+        finally:
+            slot.busy = False
@@ -0,0 +1,178 @@
+import hashlib
+import logging
+import os
+import pipes
+import posixpath
+import threading
+
+logger = logging.getLogger('andropilot')
+
+# files hashed on the device by one shell command
+BATCH_SIZE = 64
+# keep the shell command line well below the limits of old devices
+MAX_COMMAND_LENGTH = 4000
+# md5sum of an empty file, the output of the md5sum probe
+EMPTY_MD5 = 'd41d8cd98f00b204e9800998ecf8427e'
+
+# host path -> (size, mtime, md5)
+_host_hashes = {}
+_host_hashes_lock = threading.Lock()
+
+
+class FileSyncException(Exception):
+    pass
+
+
+def host_md5(path):
+    """
+    MD5 of a host file, cached as long as its size and mtime do not change.
+    """
+    stat = os.stat(path)
+    with _host_hashes_lock:
+        cached = _host_hashes.get(path)
+    if cached is not None and cached[:2] == (stat.st_size, stat.st_mtime):
+        return cached[2]
+
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), ''):
+            md5.update(chunk)
+    digest = md5.hexdigest()
+    with _host_hashes_lock:
+        _host_hashes[path] = (stat.st_size, stat.st_mtime, digest)
+    return digest
+
+
+def list_files(src_dir):
+    """
+    Return the paths, relative to src_dir and '/' separated, of the files
+    in the tree.
+    """
+    files = []
+    for root, dirs, names in os.walk(src_dir):
+        dirs.sort()
+        for name in sorted(names):
+            relative = os.path.relpath(os.path.join(root, name), src_dir)
+            files.append(relative.replace(os.sep, '/'))
+    return files
+
+
+def _batches(paths):
+    batch = []
+    length = 0
+    for path in paths:
+        quoted = pipes.quote(path)
+        if batch and (len(batch) >= BATCH_SIZE or
+                      length + len(quoted) + 1 > MAX_COMMAND_LENGTH):
+            yield batch
+            batch = []
+            length = 0
+        batch.append(path)
+        length += len(quoted) + 1
+    if batch:
+        yield batch
+
+
+def device_has_md5sum(pilot):
+    """
+    Return True if the device has an md5sum command (Android 6.0 and
+    later). The output is checked rather than the exit code, which is
+    not available when pilot.shell falls back to adb shell.
+    """
+    output, _ = pilot.shell('md5sum /dev/null')
+    return EMPTY_MD5 in output
+
+
+def device_md5sums(pilot, paths):
+    """
+    Return a dictionary with the MD5 of the device files that exist,
+    running one md5sum command for each batch of paths, or None if the
+    device has no md5sum (before Android 6.0).
+    """
+    if not device_has_md5sum(pilot):
+        return None
+    hashes = {}
+    for batch in _batches(paths):
+        output, _ = pilot.shell(
+            'md5sum %s 2>/dev/null' % ' '.join(pipes.quote(p) for p in batch))
+        for line in output.splitlines():
+            fields = line.strip().split(None, 1)
+            if len(fields) == 2 and len(fields[0]) == 32:
+                hashes[fields[1]] = fields[0]
+    return hashes
+
+
+def _device_stats(sync_connection, paths):
+    """
+    Return the (size, mtime) of the device files that exist.
+    """
+    stats = {}
+    for path in paths:
+        mode, size, mtime = sync_connection.stat(path)
+        if mode:
+            stats[path] = (size, mtime)
+    return stats
+
+
+def find_changed(pilot, src_dir, dst_dir, files, sync_connection=None):
+    """
+    Return the files (relative paths) of src_dir whose copy in dst_dir is
+    missing or different.
+    Files are compared by hash when the device can compute it, otherwise
+    by size and mtime (that a push preserves) through sync_connection.
+    """
+    remote = dict((posixpath.join(dst_dir, f), f) for f in files)
+    device_hashes = device_md5sums(pilot, sorted(remote))
+    if device_hashes is not None:
+        return [f for path, f in sorted(remote.items())
+                if device_hashes.get(path) !=
+                host_md5(os.path.join(src_dir, f))]
+
+    if sync_connection is None:
+        logger.debug("Unable to compare the files, pushing all of them")
+        return list(files)
+    device_stats = _device_stats(sync_connection, sorted(remote))
+    changed = []
+    for path, f in sorted(remote.items()):
+        stat = os.stat(os.path.join(src_dir, f))
+        if device_stats.get(path) != (stat.st_size, int(stat.st_mtime)):
+            changed.append(f)
+    return changed
+
+
+def push_tree(pilot, src_dir, dst_dir):
+    """
+    Make dst_dir on the device a copy of the src_dir host tree, pushing
+    only the files that are missing or changed.
+    With the in-process adb client all the files go through a single sync
+    connection, otherwise each one is pushed by an adb process.
+    Returns the list of pushed files (relative paths).
+    """
+    if not os.path.isdir(src_dir):
+        raise FileSyncException('%s is not a directory' % src_dir)
+    dst_dir = dst_dir.rstrip('/') or '/'
+    files = list_files(src_dir)
+
+    adb_client = pilot.adb_client
+    if adb_client is None:
+        changed = find_changed(pilot, src_dir, dst_dir, files)
+        for f in changed:
+            pilot.push_file(os.path.join(src_dir, f),
+                            posixpath.join(dst_dir, f))
+    else:
+        sync_connection = adb_client.acquire_sync(pilot.device_name)
+        try:
+            changed = find_changed(pilot, src_dir, dst_dir, files,
+                                   sync_connection)
+            for f in changed:
+                # adbd creates the missing parent directories
+                sync_connection.push(os.path.join(src_dir, f),
+                                     posixpath.join(dst_dir, f))
+        except:
+            sync_connection.close()
+            raise
+        adb_client.release_sync(sync_connection)
+
+    logger.info("Pushed %d of %d files to %s", len(changed), len(files),
+                dst_dir)
+    return changed
@@ -0,0 +1,159 @@
+import cProfile
+import fnmatch
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+
+logger = logging.getLogger('andropilot')
+
+DEFAULT_DUMP_DIRECTORY = os.path.join(os.path.expanduser('~'), '.andropilot',
+                                      'profiles')
+
+
+class Hook(object):
+
+    """
+    Callbacks run before and after the operations whose name matches any
+    of names (shell-style patterns, e.g. 'AndroPilot.*'), or all of them
+    if names is None. Both are called with the tracing.Probe of the
+    operation, which after it carries its duration, error and values.
+    """
+
+    def __init__(self, before=None, after=None, names=None):
+        self.before = before
+        self.after = after
+        self.names = names
+
+    def matches(self, name):
+        return self.names is None or \
+            any(fnmatch.fnmatchcase(name, n) for n in self.names)
+
+
+class HookRegistry(object):
+
+    """
+    The hooks of a pilot session. Operations are the instrumented calls
+    (adb_command, monkey_round_trip, viewserver_transfer, build_tree,
+    wait) and the public methods of AndroPilot, MonkeyController and
+    ViewServerController (e.g. 'ViewServerController.refresh_view').
+    A failing hook is logged and never breaks the operation.
+    """
+
+    def __init__(self):
+        self.hooks = []
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.hooks)
+
+    def add(self, hook):
+        with self.lock:
+            self.hooks = self.hooks + [hook]
+        return hook
+
+    def remove(self, hook):
+        with self.lock:
+            self.hooks = [h for h in self.hooks if h is not hook]
+
+    def __run(self, callback_name, probe):
+        for hook in self.hooks:
+            callback = getattr(hook, callback_name)
+            if callback is None or not hook.matches(probe.name):
+                continue
+            try:
+                callback(probe)
+            except Exception:
+                logger.exception("Hook %r failed on %s", hook, probe.name)
+
+    def before(self, probe):
+        self.__run('before', probe)
+
+    def after(self, probe):
+        self.__run('after', probe)
+
+
+_dump_counter = itertools.count()
+
+
+def _dump_filename(directory, prefix, extension):
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    return os.path.join(directory, '%s-%s-%d-%d.%s' % (
+        prefix, time.strftime('%Y%m%d-%H%M%S'), os.getpid(),
+        next(_dump_counter), extension))
+
+
+class SlowRefreshProfiler(Hook):
+
+    """
+    Profiles a sample of the view tree refreshes with cProfile, saving the
+    statistics (readable by pstats) of those slower than threshold
+    seconds.
+    """
+
+    def __init__(self, threshold=1.0, sample_rate=0.1,
+                 directory=DEFAULT_DUMP_DIRECTORY,
+                 names=('AndroPilot.refresh',)):
+        super(SlowRefreshProfiler, self).__init__(
+            self._start, self._stop, names)
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.directory = directory
+        self.profiles = threading.local()
+        # filenames of the saved statistics
+        self.saved = []
+
+    def _start(self, probe):
+        if getattr(self.profiles, 'current', None) is not None or \
+                random.random() >= self.sample_rate:
+            return
+        profile = cProfile.Profile()
+        self.profiles.current = (probe, profile)
+        profile.enable()
+
+    def _stop(self, probe):
+        current = getattr(self.profiles, 'current', None)
+        if current is None or current[0] is not probe:
+            return
+        profile = current[1]
+        profile.disable()
+        self.profiles.current = None
+        if probe.duration < self.threshold:
+            return
+        filename = _dump_filename(self.directory, 'refresh', 'prof')
+        profile.dump_stats(filename)
+        self.saved.append(filename)
+        logger.info("Refresh took %.3fs, profile saved to %s",
+                    probe.duration, filename)
+
+
+class SlowParseDumper(Hook):
+
+    """
+    Saves the raw ViewServer dumps whose parsing took more than threshold
+    seconds, at most max_dumps of them.
+    """
+
+    def __init__(self, threshold=0.5, directory=DEFAULT_DUMP_DIRECTORY,
+                 max_dumps=10):
+        super(SlowParseDumper, self).__init__(
+            after=self._dump, names=('build_tree',))
+        self.threshold = threshold
+        self.directory = directory
+        self.max_dumps = max_dumps
+        # filenames of the saved dumps
+        self.saved = []
+
+    def _dump(self, probe):
+        if probe.duration < self.threshold or probe.payload is None or \
+                len(self.saved) >= self.max_dumps:
+            return
+        filename = _dump_filename(self.directory, 'parse', 'txt')
+        with open(filename, 'wb') as f:
+            f.write(probe.payload)
+        self.saved.append(filename)
+        logger.info("Parsing took %.3fs (%s nodes), dump saved to %s",
+                    probe.duration, probe.values.get('nodes'), filename)
@@ -0,0 +1,190 @@
+import hashlib
+import logging
+import os
+import re
+import subprocess
+import threading
+import Queue
+
+logger = logging.getLogger('andropilot')
+
+# where the hashes of the installed APKs are recorded on the device
+MARKER_DIR = '/data/local/tmp/andropilot_apks'
+
+DEFAULT_MAX_PARALLEL = 4
+
+LAST_UPDATE_TIME_RE = re.compile(r'lastUpdateTime=([^\r\n]+)')
+VERSION_CODE_RE = re.compile(r'versionCode=(\d+)')
+AAPT_PACKAGE_RE = re.compile(r"package: name='([^']+)'")
+
+MARKER_SEPARATOR = '--andropilot--'
+
+
+class InstallException(Exception):
+    pass
+
+
+def get_package_name(apk_path):
+    """
+    Read the package name of an APK with aapt (if available on the host).
+    """
+    try:
+        output = subprocess.check_output(
+            ['aapt', 'dump', 'badging', apk_path], stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    match = AAPT_PACKAGE_RE.search(output)
+    return match.group(1) if match else None
+
+
+class InstallManager(object):
+
+    """
+    Installs APKs only when needed.
+
+    APKs are identified by the SHA-256 of their content (which covers the
+    signature too). After an install the hash is recorded on the device
+    together with the package lastUpdateTime, so that a single shell query
+    tells if the very same APK is still installed: a different APK, an
+    uninstall or a reinstall by someone else all invalidate the record.
+    """
+
+    def __init__(self, max_parallel=DEFAULT_MAX_PARALLEL):
+        self.max_parallel = max_parallel
+        # path -> (size, mtime, sha256)
+        self.hashes = {}
+        self.package_names = {}
+        self.lock = threading.Lock()
+
+    def get_apk_hash(self, apk_path):
+        stat = os.stat(apk_path)
+        with self.lock:
+            cached = self.hashes.get(apk_path)
+        if cached is not None and cached[:2] == (stat.st_size, stat.st_mtime):
+            return cached[2]
+
+        apk_hash = hashlib.sha256()
+        with open(apk_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), ''):
+                apk_hash.update(chunk)
+        digest = apk_hash.hexdigest()
+        with self.lock:
+            self.hashes[apk_path] = (stat.st_size, stat.st_mtime, digest)
+        return digest
+
+    def get_package_name(self, apk_path):
+        with self.lock:
+            if apk_path in self.package_names:
+                return self.package_names[apk_path]
+        package = get_package_name(apk_path)
+        with self.lock:
+            self.package_names[apk_path] = package
+        return package
+
+    def query_installed(self, pilot, package):
+        """
+        Return the (recorded APK hash, recorded lastUpdateTime, current
+        lastUpdateTime, versionCode) of a package, with one shell command.
+        """
+        output, _ = pilot.shell(
+            'cat %s/%s 2>/dev/null; echo %s; dumpsys package %s' % (
+                MARKER_DIR, package, MARKER_SEPARATOR, package))
+        marker, _, package_info = output.partition(MARKER_SEPARATOR)
+        recorded = marker.split()
+        recorded_hash = recorded[0] if recorded else None
+        recorded_time = ' '.join(recorded[1:]) or None
+
+        # dumpsys output may describe other packages too, only consider
+        # the section of the requested one
+        start = package_info.find('Package [%s]' % package)
+        if start < 0:
+            return recorded_hash, recorded_time, None, None
+        package_info = package_info[start:]
+        update_time = LAST_UPDATE_TIME_RE.search(package_info)
+        version_code = VERSION_CODE_RE.search(package_info)
+        return (recorded_hash, recorded_time,
+                update_time.group(1).strip() if update_time else None,
+                int(version_code.group(1)) if version_code else None)
+
+    def is_installed(self, pilot, apk_path, package):
+        recorded_hash, recorded_time, update_time, _ = \
+            self.query_installed(pilot, package)
+        return (update_time is not None and
+                recorded_hash == self.get_apk_hash(apk_path) and
+                recorded_time == update_time)
+
+    def install(self, pilot, apk_path, package=None):
+        """
+        Install the APK on the device of pilot, unless it is already
+        installed. Returns True if the APK has been installed, False if
+        the install has been skipped.
+        """
+        if package is None:
+            package = self.get_package_name(apk_path)
+        if package is None:
+            logger.warning("Package name of %s unknown, installing it",
+                           apk_path)
+            pilot.install_package(apk_path)
+            return True
+
+        if self.is_installed(pilot, apk_path, package):
+            logger.info("Package %s already installed on %s, skipping",
+                        package, pilot.device_name)
+            return False
+
+        pilot.install_package(apk_path)
+
+        update_time = self.query_installed(pilot, package)[2]
+        if update_time is None:
+            raise InstallException('Package %s not found after install' %
+                                   package)
+        pilot.shell("mkdir -p %s; echo '%s %s' > %s/%s" % (
+            MARKER_DIR, self.get_apk_hash(apk_path), update_time,
+            MARKER_DIR, package))
+        return True
+
+    def install_on_devices(self, pilots, apk_path, package=None,
+                           max_parallel=None):
+        """
+        Install the APK on several devices at the same time, at most
+        max_parallel at once.
+        Returns a dictionary mapping every device name to the result of
+        install() or to the exception raised by it.
+        """
+        if max_parallel is None:
+            max_parallel = self.max_parallel
+        if package is None:
+            package = self.get_package_name(apk_path)
+        # hash once, before the workers start
+        self.get_apk_hash(apk_path)
+
+        pending = Queue.Queue()
+        for pilot in pilots:
+            pending.put(pilot)
+        results = {}
+
+        def _work():
+            while True:
+                try:
+                    pilot = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    results[pilot.device_name] = self.install(
+                        pilot, apk_path, package)
+                except Exception as e:
+                    logger.exception("Install failed on %s",
+                                     pilot.device_name)
+                    results[pilot.device_name] = e
+
+        workers = [threading.Thread(target=_work, name='install-%d' % i)
+                   for i in range(min(max_parallel, len(pilots)))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return results
+
+
+# shared by all the pilots, so that each APK is hashed once
+default_manager = InstallManager()
@@ -0,0 +1,462 @@
+"""
+Load test of one orchestration host: N AndroPilot sessions driven at the
+same time against simulated devices (see simulator), reporting the
+throughput, the tail latencies of every operation and the host CPU and
+memory used per session.
+"""
+import collections
+import logging
+import multiprocessing
+import os
+import Queue
+import random
+import resource
+import threading
+import traceback
+
+from adb_client import AdbClient
+from farm import THREAD_WORKERS, PROCESS_WORKERS
+from pilot import AndroPilot
+import simulator
+import wait
+
+logger = logging.getLogger('loadtest')
+
+DEFAULT_SESSIONS = 4
+DEFAULT_DURATION = 30  # seconds
+
+# the operations of a session, with their relative frequency
+DEFAULT_WORKLOAD = (('refresh', 30), ('lookup', 30), ('tap', 20),
+                    ('wait', 10), ('screenshot', 10))
+
+PERCENTILES = (50, 95, 99)
+
+WAIT_QUIET_PERIOD = 0.1
+WAIT_TIMEOUT = 5
+
+SIMULATOR_START_TIMEOUT = 30
+OPEN_TIMEOUT = 60
+FIRST_SERIAL_PORT = 5554
+
+
+class LoadTestException(Exception):
+    pass
+
+
+# operations #
+def _refresh(pilot, rng):
+    pilot.refresh()
+
+
+def _lookup(pilot, rng):
+    nodes = pilot.viewserver_controller.tree_nodes_list
+    texts = [n.mText for n in nodes if n.mText]
+    if texts:
+        pilot.get_view_by_text(rng.choice(texts), partial_matching=False)
+    pilot.get_view_by_id('title')
+
+
+def _tap(pilot, rng):
+    nodes = [n for n in pilot.viewserver_controller.tree_nodes_list
+             if n.isShown and getattr(n, 'isClickable', False)]
+    if not nodes:
+        pilot.press_back()
+        return
+    left, top, right, bottom = rng.choice(nodes).get_absolute_rect()
+    pilot.tap_on_coordinates((left + right) // 2,
+                             (top + bottom) // 2 + pilot.statusbar_height)
+
+
+def _wait(pilot, rng):
+    pilot.wait_for_idle(quiet_period=WAIT_QUIET_PERIOD, timeout=WAIT_TIMEOUT)
+
+
+def _screenshot(pilot, rng):
+    pilot.capture_screen()
+
+
+OPERATIONS = {
+    'refresh': _refresh,
+    'lookup': _lookup,
+    'tap': _tap,
+    'wait': _wait,
+    'screenshot': _screenshot,
+}
+
+
+def _choose(rng, workload, total_weight):
+    point = rng.uniform(0, total_weight)
+    for name, weight in workload:
+        point -= weight
+        if point <= 0:
+            return name
+    return workload[-1][0]
+
+
+# host resources #
+def cpu_seconds():
+    """
+    The CPU time (user and system) of this process and of its terminated
+    children (the adb processes).
+    """
+    usage = 0.0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        r = resource.getrusage(who)
+        usage += r.ru_utime + r.ru_stime
+    return usage
+
+
+def rss_bytes():
+    """
+    The resident memory of this process, its peak where the current value
+    is not available.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, IndexError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _percentile(sorted_values, percent):
+    # nearest rank
+    index = max(0, int(round(percent / 100.0 * len(sorted_values))) - 1)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+def summarize(latencies):
+    """
+    Return the count, mean, percentiles and max of a list of latencies.
+    """
+    values = sorted(latencies)
+    summary = {'count': len(values)}
+    if not values:
+        return summary
+    summary['mean'] = sum(values) / len(values)
+    for percent in PERCENTILES:
+        summary['p%d' % percent] = _percentile(values, percent)
+    summary['max'] = values[-1]
+    return summary
+
+
+class SessionResult(object):
+
+    """
+    The latencies of the operations run by a session, by operation name,
+    and its errors.
+    """
+
+    def __init__(self, serial):
+        self.serial = serial
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        # set by the process workers only: their own resources
+        self.cpu_seconds = None
+        self.rss_bytes = None
+
+
+def run_session(pilot, duration, workload=DEFAULT_WORKLOAD, seed=0,
+                start_event=None):
+    """
+    Run the operations of workload, chosen at random by weight, on an
+    opened pilot for duration seconds. Returns a SessionResult.
+    """
+    result = SessionResult(pilot.device_name)
+    rng = random.Random(seed)
+    total_weight = float(sum(weight for _, weight in workload))
+    if start_event is not None:
+        start_event.wait()
+    pilot.refresh()
+
+    deadline = wait.monotonic() + duration
+    while wait.monotonic() < deadline:
+        name = _choose(rng, workload, total_weight)
+        start_time = wait.monotonic()
+        try:
+            OPERATIONS[name](pilot, rng)
+        except Exception:
+            logger.debug("%s failed on %s", name, pilot.device_name,
+                         exc_info=True)
+            result.errors[name] += 1
+            continue
+        result.latencies[name].append(wait.monotonic() - start_time)
+    return result
+
+
+def _serve_simulator(sessions, device_options, connection):
+    """
+    Body of the process simulating the devices, so that their CPU and
+    memory are not accounted to the host under test.
+    """
+    sim = simulator.Simulator()
+    for index in range(sessions):
+        sim.add_device(simulator.sample_device(
+            'emulator-%d' % (FIRST_SERIAL_PORT + 2 * index),
+            **device_options))
+    with sim:
+        connection.send((
+            dict((name, os.environ[name])
+                 for name in ('PATH', 'ANDROID_ADB_SERVER_PORT')),
+            [sim.pilot_options(serial) for serial in sim.devices]))
+        # block until the load test is over
+        connection.recv()
+
+
+def _create_pilot(pilot_options):
+    pilot = AndroPilot(**pilot_options)
+    if pilot.adb_client is not None:
+        # the default port has been read before the simulator started
+        pilot.adb_client = AdbClient(
+            port=int(os.environ['ANDROID_ADB_SERVER_PORT']))
+    return pilot
+
+
+def _process_session(pilot_options, duration, workload, seed, start_event,
+                     results):
+    """
+    Body of a session process in process mode.
+    """
+    serial = pilot_options['device_name']
+    try:
+        pilot = _create_pilot(pilot_options)
+        pilot.open()
+        try:
+            results.put(('ready', serial, None))
+            cpu_before = cpu_seconds()
+            result = run_session(pilot, duration, workload, seed,
+                                 start_event)
+            result.cpu_seconds = cpu_seconds() - cpu_before
+            result.rss_bytes = rss_bytes()
+        finally:
+            pilot.close()
+    except Exception:
+        results.put(('error', serial, traceback.format_exc()))
+        return
+    results.put(('done', serial, result))
+
+
+class LoadTest(object):
+
+    """
+    Drives sessions AndroPilot sessions for duration seconds, each against
+    its own simulated device with the given latency and bandwidth, from
+    threads (THREAD_WORKERS) or processes (PROCESS_WORKERS).
+
+    The simulated devices run in a separate process: the CPU and memory
+    reported are those of the sessions (and of the adb processes they
+    fork) only.
+    """
+
+    def __init__(self, sessions=DEFAULT_SESSIONS, duration=DEFAULT_DURATION,
+                 workload=DEFAULT_WORKLOAD, workers=THREAD_WORKERS,
+                 latency=0.0, bandwidth=None, pilot_options=None, seed=0):
+        if workers not in (THREAD_WORKERS, PROCESS_WORKERS):
+            raise LoadTestException('Unknown workers type %s' % workers)
+        unknown = [name for name, _ in workload if name not in OPERATIONS]
+        if unknown:
+            raise LoadTestException('Unknown operations %s' %
+                                    ', '.join(unknown))
+        self.sessions = sessions
+        self.duration = duration
+        self.workload = tuple(workload)
+        self.workers = workers
+        self.device_options = {'latency': latency, 'bandwidth': bandwidth}
+        self.pilot_options = dict(pilot_options or {})
+        self.pilot_options.setdefault('profile_cache_path', None)
+        self.seed = seed
+
+    def run(self):
+        """
+        Run the load test and return its report (see make_report).
+        """
+        connection, child_connection = multiprocessing.Pipe()
+        simulator_process = multiprocessing.Process(
+            target=_serve_simulator, name='loadtest-simulator',
+            args=(self.sessions, self.device_options, child_connection))
+        simulator_process.daemon = True
+        simulator_process.start()
+        saved_environ = {}
+        try:
+            if not connection.poll(SIMULATOR_START_TIMEOUT):
+                raise LoadTestException('The simulator did not start')
+            environ, options = connection.recv()
+            for name, value in environ.items():
+                saved_environ[name] = os.environ.get(name)
+                os.environ[name] = value
+            options = [dict(self.pilot_options, **o) for o in options]
+            if self.workers == PROCESS_WORKERS:
+                return self.__run_processes(options)
+            return self.__run_threads(options)
+        finally:
+            for name, value in saved_environ.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+            try:
+                connection.send(None)
+            except (IOError, OSError):
+                pass
+            simulator_process.join(10)
+            if simulator_process.is_alive():
+                simulator_process.terminate()
+
+    def __open_pilots(self, options):
+        pilots = [_create_pilot(o) for o in options]
+        errors = []
+
+        def _open(pilot):
+            try:
+                pilot.open()
+            except Exception as e:
+                errors.append((pilot.device_name, e))
+
+        threads = [threading.Thread(target=_open, args=(p,)) for p in pilots]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            for pilot in pilots:
+                pilot.close()
+            raise LoadTestException('Unable to open %s: %s' % errors[0])
+        return pilots
+
+    def __run_threads(self, options):
+        rss_before = rss_bytes()
+        pilots = self.__open_pilots(options)
+        rss_opened = rss_bytes()
+        results = []
+        start_event = threading.Event()
+
+        def _run(index, pilot):
+            results.append(run_session(pilot, self.duration, self.workload,
+                                       self.seed + index, start_event))
+
+        threads = [threading.Thread(target=_run, args=(i, p),
+                                    name='loadtest-%s' % p.device_name)
+                   for i, p in enumerate(pilots)]
+        try:
+            for thread in threads:
+                thread.start()
+            cpu_before = cpu_seconds()
+            start_time = wait.monotonic()
+            start_event.set()
+            for thread in threads:
+                thread.join()
+            elapsed = wait.monotonic() - start_time
+            cpu = cpu_seconds() - cpu_before
+        finally:
+            for pilot in pilots:
+                pilot.close()
+        return self.make_report(results, elapsed, cpu, {
+            'growth_after_open': rss_opened - rss_before,
+            'growth_after_run': rss_bytes() - rss_before})
+
+    def __run_processes(self, options):
+        start_event = multiprocessing.Event()
+        queue = multiprocessing.Queue()
+        processes = [multiprocessing.Process(
+            target=_process_session, name='loadtest-%s' % o['device_name'],
+            args=(o, self.duration, self.workload, self.seed + i,
+                  start_event, queue)) for i, o in enumerate(options)]
+        for process in processes:
+            process.daemon = True
+            process.start()
+        try:
+            # the sessions start together, once they are all opened
+            self.__collect(queue, 'ready', len(processes), OPEN_TIMEOUT)
+            start_event.set()
+            start_time = wait.monotonic()
+            results = self.__collect(queue, 'done', len(processes),
+                                     self.duration + OPEN_TIMEOUT)
+            elapsed = wait.monotonic() - start_time
+        finally:
+            for process in processes:
+                process.join(10)
+                if process.is_alive():
+                    process.terminate()
+        return self.make_report(
+            results, elapsed, sum(r.cpu_seconds for r in results),
+            {'process_rss': sum(r.rss_bytes for r in results)})
+
+    def __collect(self, queue, kind, count, timeout):
+        """
+        Return the payloads of count messages of the given kind sent by
+        the session processes, raising on the first error.
+        """
+        payloads = []
+        deadline = wait.monotonic() + timeout
+        while len(payloads) < count:
+            try:
+                message, serial, payload = queue.get(
+                    timeout=max(0, deadline - wait.monotonic()))
+            except Queue.Empty:
+                raise LoadTestException('%d sessions not %s in time' % (
+                    count - len(payloads), kind))
+            if message == 'error':
+                raise LoadTestException('Session %s failed:\n%s' % (
+                    serial, payload))
+            payloads.append(payload)
+        return payloads
+
+    def make_report(self, results, elapsed, cpu, memory):
+        """
+        Return the report of the load test: the throughput (operations per
+        second), the latencies of each operation (count, mean, p50, p95,
+        p99, max in seconds), the errors and the host CPU (seconds and
+        percent of one core) and memory (bytes), in total and per
+        session. The memory is the growth of the resident memory in
+        thread mode, the resident memory of the session processes in
+        process mode.
+        """
+        latencies = collections.defaultdict(list)
+        errors = collections.Counter()
+        for result in results:
+            for name, values in result.latencies.items():
+                latencies[name].extend(values)
+            errors.update(result.errors)
+        operations = sum(len(v) for v in latencies.values())
+        sessions = len(results) or 1
+        return {
+            'sessions': len(results),
+            'workers': self.workers,
+            'elapsed': elapsed,
+            'operations': operations,
+            'throughput': operations / elapsed if elapsed else 0.0,
+            'errors': dict(errors),
+            'latency': dict((name, summarize(values))
+                            for name, values in latencies.items()),
+            'cpu_seconds': cpu,
+            'cpu_percent': 100.0 * cpu / elapsed if elapsed else 0.0,
+            'cpu_seconds_per_session': cpu / sessions,
+            'memory_bytes': memory,
+            'memory_bytes_per_session': dict(
+                (k, v / sessions) for k, v in memory.items()),
+        }
+
+
+def format_report(report):
+    """
+    Return the report as a human readable table.
+    """
+    lines = ['%d %s sessions, %d operations in %.1fs: %.1f ops/s' % (
+        report['sessions'], report['workers'], report['operations'],
+        report['elapsed'], report['throughput'])]
+    lines.append('%-12s %7s %9s %9s %9s %9s' % (
+        'operation', 'count', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+    for name, summary in sorted(report['latency'].items()):
+        lines.append('%-12s %7d %9.1f %9.1f %9.1f %9.1f' % (
+            name, summary['count'], summary['p50'] * 1000,
+            summary['p95'] * 1000, summary['p99'] * 1000,
+            summary['max'] * 1000))
+    if report['errors']:
+        lines.append('errors: %s' % ', '.join(
+            '%s %d' % item for item in sorted(report['errors'].items())))
+    lines.append('cpu: %.2fs (%.0f%% of a core), %.3fs per session' % (
+        report['cpu_seconds'], report['cpu_percent'],
+        report['cpu_seconds_per_session']))
+    lines.append('memory per session: %s' % ', '.join(
+        '%s %.1f MiB' % (k, v / 1048576.0) for k, v in
+        sorted(report['memory_bytes_per_session'].items())))
+    return '\n'.join(lines)
@@ -0,0 +1,239 @@
+import collections
+import logging
+import re
+import subprocess
+import threading
+import time
+
+import wait
+
+logger = logging.getLogger('logcat')
+
+# tags silenced in the collected logs (they are the noisy ones generated by
+# andropilot itself)
+LOGCAT_FILTERS = ['Choreographer:S', 'WindowManager:S', 'MonkeyStub:S',
+                  'ViewServer:S', 'AndroTotal:S', 'dalvikvm:S']
+
+DEFAULT_BUFFER_SIZE = 10000
+
+# the records already in the device buffer are replayed when the stream
+# starts: start() waits for them until the stream is quiet for
+# BACKLOG_QUIET_PERIOD (BACKLOG_FIRST_LINE before the first line, while
+# adb starts), at most BACKLOG_TIMEOUT
+BACKLOG_QUIET_PERIOD = 0.2
+BACKLOG_FIRST_LINE = 1
+BACKLOG_TIMEOUT = 5
+# 'logcat -T count' (replay only the last count records) is available
+# since API level 19
+TAIL_API_LEVEL = 19
+
+# brief format: "D/Tag( 1234): message"
+BRIEF_LINE_RE = re.compile(r'^([VDIWEFAS])/(.*?)\(\s*(\d+)\): ?(.*)$')
+
+# timestamp is the host wall-clock time.time() of reception, comparable
+# with the times of the other logs (see LogcatStore.attach)
+LogRecord = collections.namedtuple(
+    'LogRecord', ['sequence', 'timestamp', 'level', 'tag', 'pid', 'message'])
+
+
+def parse_brief_line(line):
+    """
+    Parse a line in brief format, returning a (level, tag, pid, message)
+    tuple or None if the line does not match the format.
+    """
+    match = BRIEF_LINE_RE.match(line)
+    if match is None:
+        return None
+    level, tag, pid, message = match.groups()
+    return level, tag.strip(), int(pid), message
+
+
+def format_record(record):
+    return '%s/%s(%5d): %s' % (record.level, record.tag, record.pid,
+                               record.message)
+
+
+class LogcatReader(object):
+
+    """
+    Streams the device logcat in background, keeping the last buffer_size
+    parsed records in a ring buffer.
+    Records get an increasing sequence number, so callers can ask for the
+    records logged after a given point (see mark()).
+    """
+
+    def __init__(self, pilot, buffer_size=DEFAULT_BUFFER_SIZE,
+                 filters=LOGCAT_FILTERS):
+        self.pilot = pilot
+        self.filters = list(filters)
+        self.records = collections.deque(maxlen=buffer_size)
+        self.condition = threading.Condition()
+        self.sequence = 0
+        # sequence number of the last record of the replayed backlog
+        self.backlog_sequence = 0
+        self.last_received = None
+        self.exported_sequence = 0
+        self.listeners = []
+        self.process = None
+        self.thread = None
+
+    def start(self):
+        """
+        Start streaming, returning once the backlog of the device buffer
+        has been received (see BACKLOG_QUIET_PERIOD).
+        """
+        logger.info("Starting logcat reader on %s", self.pilot.device_name)
+        options = ['-v', 'brief']
+        api_level = getattr(self.pilot, 'device_api_level', None)
+        if api_level is not None and api_level >= TAIL_API_LEVEL:
+            options += ['-T', '1']
+        start_time = wait.monotonic()
+        self.process = subprocess.Popen(
+            ['adb', '-s', self.pilot.device_name, 'logcat'] + options +
+            self.filters, stdout=subprocess.PIPE)
+        self.thread = threading.Thread(
+            target=self.__read, args=(self.process.stdout,),
+            name='logcat-%s' % self.pilot.device_name)
+        self.thread.daemon = True
+        self.thread.start()
+        self.__wait_backlog(start_time)
+
+    def __wait_backlog(self, start_time):
+        end_time = start_time + BACKLOG_TIMEOUT
+        with self.condition:
+            while True:
+                if self.last_received is None:
+                    quiet_end = start_time + BACKLOG_FIRST_LINE
+                else:
+                    quiet_end = self.last_received + BACKLOG_QUIET_PERIOD
+                now = wait.monotonic()
+                if now >= min(quiet_end, end_time):
+                    break
+                self.condition.wait(min(quiet_end, end_time) - now)
+            self.backlog_sequence = self.sequence
+        logger.debug("Logcat backlog: %d records", self.backlog_sequence)
+
+    def stop(self):
+        process, self.process = self.process, None
+        if process is None:
+            return
+        try:
+            process.terminate()
+        except OSError:
+            pass
+        self.thread.join(1)
+
+    def add_listener(self, listener):
+        """
+        Register a function called (from the reader thread) with every
+        new LogRecord.
+        """
+        self.listeners.append(listener)
+
+    def __read(self, stream):
+        last = None
+        for line in iter(stream.readline, ''):
+            line = line.rstrip('\r\n')
+            if not line or line.startswith('--------- beginning of'):
+                with self.condition:
+                    self.last_received = wait.monotonic()
+                continue
+            fields = parse_brief_line(line)
+            if fields is None:
+                if last is None:
+                    continue
+                # continuation of a multi-line message
+                fields = (last.level, last.tag, last.pid, line)
+            last = self.__append(fields)
+        logger.debug("Logcat stream closed")
+
+    def __append(self, fields):
+        with self.condition:
+            self.sequence += 1
+            record = LogRecord(self.sequence, time.time(), *fields)
+            self.last_received = wait.monotonic()
+            self.records.append(record)
+            self.condition.notify_all()
+        for listener in self.listeners:
+            try:
+                listener(record)
+            except Exception:
+                logger.exception("Logcat listener failed")
+        return record
+
+    def mark(self):
+        """
+        Return the sequence number of the last received record.
+        """
+        with self.condition:
+            return self.sequence
+
+    def get_records(self, since=0, tag=None, level=None):
+        """
+        Return the buffered records with sequence number greater than since.
+        """
+        with self.condition:
+            records = list(self.records)
+        return [r for r in records if r.sequence > since and
+                (tag is None or r.tag == tag) and
+                (level is None or r.level == level)]
+
+    def __find(self, regex, since, tag):
+        # walk back only over the records newer than since
+        candidates = []
+        for record in reversed(self.records):
+            if record.sequence <= since:
+                break
+            candidates.append(record)
+        for record in reversed(candidates):
+            if tag is not None and record.tag != tag:
+                continue
+            if regex.search(record.message):
+                return record
+        return None
+
+    def wait_for_log(self, pattern, timeout, since=None, tag=None):
+        """
+        Wait for a record whose message matches pattern (a regular
+        expression) to be logged after the since sequence number.
+        Only the records logged after this call are matched by default:
+        to catch the record of an operation, take a mark() before it:
+
+            mark = reader.mark()
+            pilot.start_activity(component)
+            reader.wait_for_log('Displayed', 10, since=mark)
+
+        Returns the matching record, or None when the timeout expires.
+        """
+        regex = re.compile(pattern)
+        if since is None:
+            since = self.mark()
+        end_time = wait.monotonic() + timeout
+        with self.condition:
+            while True:
+                record = self.__find(regex, since, tag)
+                if record is not None:
+                    return record
+                since = max(since, self.sequence)
+                remaining = end_time - wait.monotonic()
+                if remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+
+    def export(self, filename):
+        """
+        Append to filename (in brief format) the records received since
+        the previous export, returning how many have been written.
+        """
+        records = self.get_records(since=self.exported_sequence)
+        if not records:
+            return 0
+        if records[0].sequence > self.exported_sequence + 1:
+            logger.warning("%d logcat records dropped from the buffer "
+                           "before being exported",
+                           records[0].sequence - self.exported_sequence - 1)
+        with open(filename, 'a') as f:
+            for record in records:
+                f.write(format_record(record) + '\n')
+        self.exported_sequence = records[-1].sequence
+        return len(records)
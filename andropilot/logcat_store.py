@@ -0,0 +1,245 @@
+import array
+import bisect
+import datetime
+import logging
+import re
+import threading
+import time
+
+from logcat import LogRecord, parse_brief_line
+
+logger = logging.getLogger('logcat')
+
+LEVELS = 'VDIWEFAS'
+
+# time format: "10-19 12:00:00.123 D/Tag( 1234): message"
+TIME_PREFIX_RE = re.compile(r'^(\d\d)-(\d\d) (\d\d):(\d\d):(\d\d)\.(\d{3}) ')
+
+
+class _StringTable(object):
+
+    """
+    Interned strings: each distinct value is stored once and referenced
+    by its integer id.
+    """
+
+    def __init__(self):
+        self.values = []
+        self.ids = {}
+
+    def intern(self, value):
+        ident = self.ids.get(value)
+        if ident is None:
+            ident = len(self.values)
+            self.values.append(value)
+            self.ids[value] = ident
+        return ident
+
+    def __len__(self):
+        return len(self.values)
+
+
+class LogcatStore(object):
+
+    """
+    Column store of logcat records, indexed by tag, level and time.
+
+    Every column is a compact array (timestamps, pids, level codes, tag and
+    message ids); tags and messages are interned, so the repeated lines
+    produced by chatty apps cost one integer per record.
+    Records can be appended while the queries run (e.g. by a LogcatReader
+    listener, see attach()).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timestamps = array.array('d')
+        self.pids = array.array('l')
+        self.levels = array.array('B')
+        self.tag_ids = array.array('l')
+        self.message_ids = array.array('l')
+
+        self.tags = _StringTable()
+        self.messages = _StringTable()
+
+        self.tag_index = {}
+        self.level_index = {}
+        # time range queries use bisect as long as timestamps are sorted
+        self.sorted_by_time = True
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def append(self, timestamp, level, tag, pid, message):
+        with self.lock:
+            row = len(self.timestamps)
+            if row and timestamp < self.timestamps[-1]:
+                self.sorted_by_time = False
+            tag_id = self.tags.intern(tag)
+            level_code = LEVELS.find(level)
+
+            self.timestamps.append(timestamp)
+            self.pids.append(pid)
+            self.levels.append(level_code)
+            self.tag_ids.append(tag_id)
+            self.message_ids.append(self.messages.intern(message))
+
+            self.tag_index.setdefault(tag_id, array.array('l')).append(row)
+            self.level_index.setdefault(
+                level_code, array.array('l')).append(row)
+        return row
+
+    def append_record(self, record):
+        return self.append(record.timestamp, record.level, record.tag,
+                           record.pid, record.message)
+
+    def attach(self, logcat_reader):
+        """
+        Store every record received by a LogcatReader from now on.
+        """
+        logcat_reader.add_listener(self.append_record)
+
+    def load(self, filename, timestamp=None):
+        """
+        Append the records of a logcat file in brief (or time) format.
+        Brief lines carry no time, they are stored with timestamp (by
+        default the time of the load).
+        Returns the number of appended records.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        year = datetime.date.today().year
+        count = 0
+        last = None
+        with open(filename, 'r') as f:
+            for line in f:
+                line = line.rstrip('\r\n')
+                line_timestamp = timestamp
+                match = TIME_PREFIX_RE.match(line)
+                if match is not None:
+                    line_timestamp = _parse_time_prefix(match, year)
+                    line = line[match.end():]
+                fields = parse_brief_line(line)
+                if fields is None:
+                    if last is None or not line or line.startswith('-----'):
+                        continue
+                    fields = last[:3] + (line,)
+                self.append(line_timestamp, *fields)
+                last = fields
+                count += 1
+        return count
+
+    def get(self, row):
+        return LogRecord(row, self.timestamps[row], LEVELS[self.levels[row]],
+                         self.tags.values[self.tag_ids[row]], self.pids[row],
+                         self.messages.values[self.message_ids[row]])
+
+    def __time_rows(self, start, end, size):
+        if start is None and end is None:
+            return None
+        if not self.sorted_by_time:
+            return [row for row in xrange(size)
+                    if (start is None or self.timestamps[row] >= start) and
+                    (end is None or self.timestamps[row] <= end)]
+        timestamps = self.timestamps
+        first = 0 if start is None else \
+            bisect.bisect_left(timestamps, start, 0, size)
+        last = size if end is None else \
+            bisect.bisect_right(timestamps, end, 0, size)
+        return xrange(first, last)
+
+    def find_rows(self, tag=None, level=None, start=None, end=None,
+                  pattern=None, pid=None):
+        """
+        Return the row numbers of the records matching all the given
+        criteria; pattern is a regular expression searched in the message,
+        matched once for each distinct message.
+        """
+        with self.lock:
+            size = len(self.timestamps)
+            candidates = []
+            if tag is not None:
+                tag_id = self.tags.ids.get(tag)
+                if tag_id is None:
+                    return []
+                candidates.append(self.tag_index[tag_id])
+            if level is not None:
+                level_code = LEVELS.find(level)
+                candidates.append(self.level_index.get(level_code, []))
+            time_rows = self.__time_rows(start, end, size)
+            if time_rows is not None:
+                candidates.append(time_rows)
+
+            if candidates:
+                # scan the smallest candidate set, checking the others
+                # against the columns
+                rows = min(candidates, key=len)
+            else:
+                rows = xrange(size)
+
+            matching_messages = None
+            if pattern is not None:
+                regex = re.compile(pattern)
+                matching_messages = set(
+                    i for i, m in enumerate(self.messages.values)
+                    if regex.search(m))
+
+            result = []
+            for row in rows:
+                if row >= size:
+                    break
+                if tag is not None and self.tag_ids[row] != tag_id:
+                    continue
+                if level is not None and self.levels[row] != level_code:
+                    continue
+                if start is not None and self.timestamps[row] < start:
+                    continue
+                if end is not None and self.timestamps[row] > end:
+                    continue
+                if pid is not None and self.pids[row] != pid:
+                    continue
+                if matching_messages is not None and \
+                        self.message_ids[row] not in matching_messages:
+                    continue
+                result.append(row)
+        return result
+
+    def query(self, **criteria):
+        """
+        Return the LogRecord (with the row number as sequence) of every
+        record matching the criteria (see find_rows).
+        """
+        return [self.get(row) for row in self.find_rows(**criteria)]
+
+    def count(self, **criteria):
+        return len(self.find_rows(**criteria))
+
+    def count_by_tag(self, level=None):
+        """
+        Return a dictionary with the number of records of each tag.
+        """
+        with self.lock:
+            if level is None:
+                return dict((self.tags.values[t], len(rows))
+                            for t, rows in self.tag_index.items())
+            level_code = LEVELS.find(level)
+            counts = {}
+            for row in self.level_index.get(level_code, []):
+                tag = self.tags.values[self.tag_ids[row]]
+                counts[tag] = counts.get(tag, 0) + 1
+            return counts
+
+    def crashes(self):
+        return self.query(tag='AndroidRuntime', level='E',
+                          pattern='^FATAL EXCEPTION')
+
+    def anrs(self):
+        return self.query(tag='ActivityManager', level='E',
+                          pattern='^ANR in ')
+
+
+def _parse_time_prefix(match, year):
+    month, day, hour, minute, second, millis = [int(g)
+                                                for g in match.groups()]
+    moment = datetime.datetime(year, month, day, hour, minute, second)
+    return time.mktime(moment.timetuple()) + millis / 1000.0
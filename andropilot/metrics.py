@@ -0,0 +1,222 @@
+import bisect
+import json
+import threading
+
+import wait
+
+# upper bounds of the histogram buckets
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+
+PROMETHEUS_PREFIX = 'andropilot_'
+
+
+def default_buckets(name):
+    """
+    Buckets for a histogram, chosen by the unit suffix of its name.
+    """
+    if name.endswith('_seconds'):
+        return TIME_BUCKETS
+    if name.endswith('_bytes'):
+        return SIZE_BUCKETS
+    return COUNT_BUCKETS
+
+
+class Histogram(object):
+
+    """
+    Counts of the observed values in fixed buckets, plus their sum: an
+    observation is a bisection and a few increments.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = tuple(sorted(buckets))
+        # the last count is for the values above the last bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def quantile(self, q):
+        """
+        Estimate the q quantile (0 <= q <= 1) as the upper bound of the
+        bucket holding it, None if nothing has been observed.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def to_dict(self):
+        with self.lock:
+            return {'buckets': list(self.buckets), 'counts': list(self.counts),
+                    'count': self.count, 'sum': self.sum}
+
+
+class _Timer(object):
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = wait.monotonic()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.metrics.observe(self.name, wait.monotonic() - self.start,
+                             **self.labels)
+
+
+class Metrics(object):
+
+    """
+    Registry of the histograms of a pilot session, identified by name and
+    labels. labels are added to every exported series (e.g. the device
+    serial).
+    """
+
+    enabled = True
+
+    def __init__(self, labels=None):
+        self.labels = labels or {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def histogram(self, name, buckets=None, **labels):
+        """
+        Return the histogram with the given name and labels, created with
+        buckets (by default chosen by the name suffix: _seconds, _bytes
+        or a count) if it does not exist.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(
+                    key, Histogram(buckets or default_buckets(name)))
+        return histogram
+
+    def observe(self, name, value, **labels):
+        self.histogram(name, **labels).observe(value)
+
+    def time(self, name, **labels):
+        """
+        Context manager observing the seconds spent in its block.
+        """
+        return _Timer(self, name, labels)
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+
+    def to_dict(self):
+        with self.lock:
+            items = sorted(self.histograms.items())
+        series = []
+        for (name, labels), histogram in items:
+            entry = histogram.to_dict()
+            entry['name'] = name
+            entry['labels'] = dict(self.labels, **dict(labels))
+            series.append(entry)
+        return {'labels': self.labels, 'histograms': series}
+
+    def export_json(self, filename=None):
+        """
+        Return the histograms as a JSON document, also written to filename
+        if given.
+        """
+        data = json.dumps(self.to_dict(), indent=2, sort_keys=True)
+        if filename is not None:
+            with open(filename, 'w') as f:
+                f.write(data)
+        return data
+
+    def export_prometheus(self):
+        return export_prometheus([self])
+
+
+class _NullTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+
+class NullMetrics(object):
+
+    """
+    The metrics of a pilot when they are not enabled: every operation
+    does nothing.
+    """
+
+    enabled = False
+
+    def observe(self, name, value, **labels):
+        pass
+
+    def time(self, name, **labels):
+        return NULL_TIMER
+
+
+NULL_TIMER = _NullTimer()
+NULL_METRICS = NullMetrics()
+
+
+def _format_labels(labels):
+    return '{%s}' % ','.join(
+        '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in labels)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def export_prometheus(registries):
+    """
+    Return the histograms of several registries (e.g. one for each device
+    of a pool) in the Prometheus text exposition format.
+    """
+    series = {}
+    for registry in registries:
+        for entry in registry.to_dict()['histograms']:
+            series.setdefault(entry['name'], []).append(entry)
+
+    lines = []
+    for name in sorted(series):
+        metric = PROMETHEUS_PREFIX + name
+        lines.append('# TYPE %s histogram' % metric)
+        for entry in series[name]:
+            labels = sorted(entry['labels'].items())
+            cumulative = 0
+            bounds = entry['buckets'] + [float('inf')]
+            for bound, count in zip(bounds, entry['counts']):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (
+                    metric, _format_labels(labels + [('le', _format_value(
+                        bound))]), cumulative))
+            lines.append('%s_sum%s %s' % (metric, _format_labels(labels),
+                                          _format_value(entry['sum'])))
+            lines.append('%s_count%s %d' % (metric, _format_labels(labels),
+                                            entry['count']))
+    return '\n'.join(lines) + '\n'
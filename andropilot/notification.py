@@ -1,14 +1,15 @@
-import datetime
-import time
+import collections
 import logging
 
 from controllers import viewserver_parser as vs_parser
+import wait
 
 SHORT_TIMEOUT = 60
 MEDIUM_TIMEOUT = 120
 LONG_TIMEOUT = 240
 
 TIMEOUT = MEDIUM_TIMEOUT
+SETTLE_TIMEOUT = 5
 
 logger = logging.getLogger(__name__)
 
@@ -17,7 +18,34 @@ STATUS_BAR_CLASSNAME_10 = "StatusBarExpanded"
 STATUS_BAR_CLASSNAME_16 = "StatusBar"
 
 
-class NotificationManager:
+class NotificationWaits(object):
+
+    """
+    The notification waits shared by the notification managers, built on
+    their refresh() and get_notifications_by_* queries.
+    """
+
+    def _wait_for_notification(self, check, timeout, name):
+        condition = wait.Condition(check, refresh=True, name=name)
+        self.pilot.last_wait = wait.wait_for(
+            condition, timeout, refresh=self.refresh,
+            probe=self.pilot.probe)
+        return self.pilot.last_wait.satisfied
+
+    def wait_for_notification_by_message(
+            self, text, timeout=TIMEOUT, partial_matching=True):
+        return self._wait_for_notification(
+            lambda: self.get_notifications_by_message(text, partial_matching),
+            timeout, 'notification message %s' % text)
+
+    def wait_for_notification_by_title(
+            self, text, timeout=TIMEOUT, partial_matching=True):
+        return self._wait_for_notification(
+            lambda: self.get_notifications_by_title(text, partial_matching),
+            timeout, 'notification title %s' % text)
+
+
+class NotificationManager(NotificationWaits):
 
     def __init__(self, pilot):
         self.pilot = pilot
@@ -37,6 +65,16 @@ class NotificationManager:
 
         self.ongoing_items = []
         self.notification_items = []
+        self.items_by_title = {}
+        self.items_by_message = {}
+        # the items that appeared and disappeared with the last refresh
+        self.added_items = []
+        self.removed_items = []
+
+        # the status bar window, cached until the window list changes
+        self.status_bar_hashcode = None
+        self.window_list_version = None
+        self.last_dump = None
 
     def open_notification_bar(self):
         logger.info("Opening notification bar")
@@ -47,94 +85,105 @@ class NotificationManager:
         end_y = self.pilot.display_height * 3 / 4
         res = self.pilot.monkey_controller.drag(
             start_x, start_y, end_x, end_y, 0.5, 3)
-        time.sleep(0.5)
+        # wait for the expansion animation to end
+        self.pilot.wait_for_idle(quiet_period=0.2, timeout=SETTLE_TIMEOUT)
         return True
 
-    def _refresh10(self):
+    def __get_status_bar_hashcode(self, class_name):
+        """
+        Return the hashcode of the status bar window: the window list is
+        only fetched again when it changed since the last time.
+        """
+        version = self.pilot.viewserver_controller.get_window_list_version()
+        if self.status_bar_hashcode is not None and version is not None \
+                and version == self.window_list_version:
+            return self.status_bar_hashcode
+
         view_list = self.pilot.get_activity_list()
-        hashcode = next(
-            v['hashcode'] for v in view_list if v['classname'] == STATUS_BAR_CLASSNAME_10)
+        self.status_bar_hashcode = next(
+            v['hashcode'] for v in view_list if v['classname'] == class_name)
+        self.window_list_version = version
+        return self.status_bar_hashcode
 
+    def __dump_status_bar(self, class_name):
+        hashcode = self.__get_status_bar_hashcode(class_name)
         data = self.pilot.viewserver_controller.dump_view_by_hashcode(hashcode)
+        if not _has_views(data):
+            # the cached window is gone
+            self.status_bar_hashcode = None
+            hashcode = self.__get_status_bar_hashcode(class_name)
+            data = self.pilot.viewserver_controller.dump_view_by_hashcode(
+                hashcode)
+        return data
+
+    def __update_items(self, data, is_item):
+        """
+        Extract the notification items from a status bar dump, unless it
+        is the same as the previous one, and compute the changes.
+        Returns True if the items changed.
+        """
+        if data == self.last_dump:
+            self.added_items = []
+            self.removed_items = []
+            return False
+        self.last_dump = data
         # build the view notification bar view tree
-        self.tree_nodes_list = vs_parser.build_tree(data)
+        self.tree_nodes_list = \
+            self.pilot.viewserver_controller.build_tree(data)
+
+        # self.notification_items is a list of dictionaries, each one
+        # containing the notification title, message and view node
+        previous_items = self.notification_items
+        self.notification_items = extract_items(self.tree_nodes_list,
+                                                is_item)
+        self.added_items = _subtract(self.notification_items, previous_items)
+        self.removed_items = _subtract(previous_items, self.notification_items)
+
+        self.items_by_title = {}
+        self.items_by_message = {}
+        for n in self.notification_items:
+            self.items_by_title.setdefault(n['title'], []).append(n)
+            self.items_by_message.setdefault(n['message'], []).append(n)
+        return bool(self.added_items or self.removed_items)
 
-        # now get all the notification items
-        # self.notification_items is a list of dictionaries, each one containing the
-        # the notification title, message and view node
-        self.notification_items = []
-
-        # retrieve all the "ongoing" notification items
-        ongoing_items_root = next(
-            (n for n in self.tree_nodes_list if n.mId == 'id/ongoingItems'),
-            None)
-        for node in ongoing_items_root.get_all_children():
-            if node.mClassName == "com.android.systemui.statusbar.LatestItemView":
-                n = {'title': node.get_children_by_id('title')[0].mText,
-                     'message': node.get_children_by_id('text')[0].mText,
-                     'node': node
-                     }
-                self.notification_items.append(n)
-
-        # retrieve all the "default" notification items
-        latest_items_root = next(
-            (n for n in self.tree_nodes_list if n.mId == 'id/latestItems'),
-            None)
-        for node in latest_items_root.get_all_children():
-            if node.mClassName == "com.android.systemui.statusbar.LatestItemView":
-                n = {'title': node.get_children_by_id('title')[0].mText,
-                     'message': node.get_children_by_id('text')[0].mText,
-                     'node': node
-                     }
-                self.notification_items.append(n)
+    def _refresh10(self):
+        # the "ongoing" and the "default" notification items
+        return self.__update_items(
+            self.__dump_status_bar(STATUS_BAR_CLASSNAME_10),
+            lambda node: node.mClassName == self.ITEM_CLASS_NAME)
 
     def _refresh16(self):
-        view_list = self.pilot.get_activity_list()
-        hashcode = next(
-            v['hashcode'] for v in view_list if v['classname'] == STATUS_BAR_CLASSNAME_16)
-
-        data = self.pilot.viewserver_controller.dump_view_by_hashcode(hashcode)
-        # build the view notification bar view tree
-        self.tree_nodes_list = vs_parser.build_tree(data)
-        # now get all the notification items
-        self.notification_items = []
-
         # on the Android API 16 there is no difference between ongoing
         # and default notification view elements
-        for node in self.tree_nodes_list:
-            if node.mId == "id/status_bar_latest_event_content":
-                n = {'title': node.get_children_by_id('title')[0].mText,
-                     'message': node.get_children_by_id('text')[0].mText,
-                     'node': node
-                     }
-                self.notification_items.append(n)
+        return self.__update_items(
+            self.__dump_status_bar(STATUS_BAR_CLASSNAME_16),
+            lambda node: node.mId == "id/status_bar_latest_event_content")
 
     def refresh(self):
+        """
+        Update the notification items, returns True if they changed (see
+        added_items and removed_items).
+        """
         logger.debug("Notifications dump START.")
+        changed = False
         # choose the right refresh method based on the
         # Android API level
         if self.pilot.device_api_level == 10:
-            self._refresh10()
+            changed = self._refresh10()
         elif self.pilot.device_api_level == 16:
-            self._refresh16()
+            changed = self._refresh16()
         logger.debug("Notifications dump COMPLETE.")
+        return changed
 
     def get_notifications_by_message(self, text, partial_matching=True):
-        if partial_matching:
-            check = lambda x, y: (x in y)
-        else:
-            check = lambda x, y: (x == y)
-
-        return [n for n in self.notification_items if check(
-            text, n['message'])]
+        if not partial_matching:
+            return list(self.items_by_message.get(text, []))
+        return [n for n in self.notification_items if text in n['message']]
 
     def get_notifications_by_title(self, text, partial_matching=True):
-        if partial_matching:
-            check = lambda x, y: (x in y)
-        else:
-            check = lambda x, y: (x == y)
-
-        return [n for n in self.notification_items if check(text, n['title'])]
+        if not partial_matching:
+            return list(self.items_by_title.get(text, []))
+        return [n for n in self.notification_items if text in n['title']]
 
     def click_notification_by_id(self, id):
         notification_node = (
@@ -147,37 +196,56 @@ class NotificationManager:
         self.open_notification_bar()
         return self.pilot.monkey_controller.tap(location.x, location.y)
 
-    def wait_for_notification_by_message(
-            self, text, timeout=TIMEOUT, partial_matching=True):
-        SLEEP_TIME = 0.2  # 200 mseconds
-        end_time = datetime.datetime.now() + \
-            datetime.timedelta(seconds=timeout)
-        while datetime.datetime.now().time() <= end_time.time():
-            self.refresh()
-
-            if len(self.get_notifications_by_message(
-                    text, partial_matching)) > 0:
-                return True
-            time.sleep(SLEEP_TIME)
-        return False
-
-    def wait_for_notification_by_title(
-            self, text, timeout=TIMEOUT, partial_matching=True):
-        SLEEP_TIME = 0.2  # 200 mseconds
-        end_time = datetime.datetime.now() + \
-            datetime.timedelta(seconds=timeout)
-        while datetime.datetime.now().time() <= end_time.time():
-            self.refresh()
-
-            if len(self.get_notifications_by_title(
-                    text, partial_matching)) > 0:
-                return True
-            time.sleep(SLEEP_TIME)
-        return False
-
     def __get_real_location(self, location):
         real_location = vs_parser.Point()
         real_location.x = location.x
-        real_location.y = location.y + self.statusbar_height
+        real_location.y = location.y + self.pilot.statusbar_height
 
         return real_location
+
+
+def _has_views(data):
+    return bool(data.replace('DONE.', '').replace('DONE', '').strip()) and \
+        not data.startswith('FAILURE')
+
+
+def extract_items(tree_nodes_list, is_item):
+    """
+    Return the notification items (title, message and view node) of a
+    status bar tree in a single pass: the title and text views of an item
+    are the ones that follow it (in tree order) before any node that is
+    not deeper than it.
+    """
+    items = []
+    item = None
+    for node in tree_nodes_list:
+        if item is not None and node.mDepth <= item['node'].mDepth:
+            item = None
+        if is_item(node):
+            item = {'title': None, 'message': None, 'node': node}
+            items.append(item)
+        elif item is not None:
+            if node.mId == 'id/title' and item['title'] is None:
+                item['title'] = node.mText
+            elif node.mId == 'id/text' and item['message'] is None:
+                item['message'] = node.mText
+    for item in items:
+        item['title'] = item['title'] or ''
+        item['message'] = item['message'] or ''
+    return items
+
+
+def _subtract(items, other_items):
+    """
+    Return the items (compared by title and message) not in other_items.
+    """
+    counts = collections.Counter((n['title'], n['message'])
+                                 for n in other_items)
+    result = []
+    for n in items:
+        key = (n['title'], n['message'])
+        if counts[key]:
+            counts[key] -= 1
+        else:
+            result.append(n)
+    return result
@@ -1,11 +1,27 @@
-import datetime
 import logging
+import socket
 import time
 import subprocess
 
+from adb_client import AdbClient
+import file_sync
+from hooks import HookRegistry
+from device_profile import DEFAULT_CACHE_PATH, DeviceProfileCache, \
+    load_profile
+from logcat import LOGCAT_FILTERS, LogcatReader
+from metrics import Metrics, NULL_METRICS
+import tracing
 from notification import NotificationManager
+from dumpsys_notification import DumpsysNotificationManager
+from refresher import BackgroundRefresher
+import install
+import screen_diff
+import screenshot
+import wait
+from shell_session import ShellSession, ShellSessionException
 from controllers.monkey_controller import MonkeyController
 from controllers.viewserver_controller import ViewServerController
+from controllers import viewserver_parser as vs_parser
 
 SHORT_TIMEOUT = 60
 MEDIUM_TIMEOUT = 120
@@ -15,6 +31,21 @@ TIMEOUT = MEDIUM_TIMEOUT
 
 DEFAULT_SLEEP_TIME = 0.5  # 500 mseconds
 
+IDLE_QUIET_PERIOD = 0.5
+IDLE_POLL_INTERVAL = 0.1
+
+# methods that are never instrumented (see enable_tracing, add_hook)
+# adb_command is not wrapped: it records its own adb_command probe
+TRACING_EXCLUDED = ('probe', 'enable_metrics', 'enable_tracing',
+                    'disable_tracing', 'add_hook', 'remove_hook',
+                    'start_background_refresh', 'stop_background_refresh',
+                    'adb_command')
+
+# notification backends: scraping the status bar views (API levels 10
+# and 16 only) or, opt-in, parsing dumpsys notification (any level, no UI)
+UI_NOTIFICATIONS = 'ui'
+DUMPSYS_NOTIFICATIONS = 'dumpsys'
+
 logger = logging.getLogger('andropilot')
 
 
@@ -25,26 +56,147 @@ class AndroPilotException(Exception):
 class AndroPilot(object):
 
     def __init__(self, device_name="emulator-5554", device_address="127.0.0.1",
-                 view_server_port=4939, monkey_server_port=12345):
+                 view_server_port=4939, monkey_server_port=12345,
+                 profile_cache_path=DEFAULT_CACHE_PATH, use_adb_client=False,
+                 notification_backend=UI_NOTIFICATIONS):
         # set the device under test parameters
         self.device_name = device_name
         self.device_address = device_address
         self.view_server_port = view_server_port
         self.monkey_server_port = monkey_server_port
+        # the device profiles are cached on disk, unless the path is None
+        if profile_cache_path is not None:
+            self.profile_cache = DeviceProfileCache(profile_cache_path)
+        else:
+            self.profile_cache = None
+        # when enabled, adb commands talk directly to the adb server
+        # instead of forking an adb process
+        if use_adb_client:
+            self.adb_client = AdbClient()
+        else:
+            self.adb_client = None
+        # long-lived adb shell, opened by the first shell() call
+        self.shell_session = None
+        self.logcat_reader = None
+        # outcome of the last wait, with its polls count and duration
+        self.last_wait = None
+        # latency histograms, see enable_metrics()
+        self.metrics = NULL_METRICS
+        # trace-event writer, see enable_tracing()
+        self.tracer = None
+        # callbacks around the operations, see add_hook()
+        self.hooks = HookRegistry()
+        # view tree refresher thread, see start_background_refresh()
+        self.refresher = None
+        # UI_NOTIFICATIONS (NotificationManager) or DUMPSYS_NOTIFICATIONS
+        # (DumpsysNotificationManager)
+        if notification_backend not in (UI_NOTIFICATIONS,
+                                        DUMPSYS_NOTIFICATIONS):
+            raise AndroPilotException(
+                "Unknown notification backend %s" % notification_backend)
+        self.notification_backend = notification_backend
+
+    def enable_metrics(self, labels=None):
+        """
+        Start recording the latency of the adb, monkey and ViewServer
+        operations, the view tree parsing and the waits.
+        Returns the metrics.Metrics registry, labelled with the device
+        serial and labels.
+        """
+        if not self.metrics.enabled:
+            all_labels = {'device': self.device_name}
+            all_labels.update(labels or {})
+            self.metrics = Metrics(all_labels)
+        return self.metrics
+
+    def enable_tracing(self, filename):
+        """
+        Record a Chrome trace-event timeline of the session in filename:
+        a span for every call of the public methods of the pilot and of its
+        controllers, and for the adb commands, monkey round trips,
+        ViewServer transfers, parsing and waits beneath them.
+        """
+        self.disable_tracing()
+        self.tracer = tracing.Tracer(filename, 'andropilot %s' %
+                                     self.device_name)
+        self.__instrument()
+        return self.tracer
+
+    def disable_tracing(self):
+        if self.tracer is None:
+            return
+        self.tracer.close()
+        self.tracer = None
+        self.__instrument()
+
+    def add_hook(self, hook):
+        """
+        Register a hooks.Hook, called around the matching operations (see
+        hooks.HookRegistry).
+        """
+        self.hooks.add(hook)
+        self.__instrument()
+        return hook
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+        self.__instrument()
+
+    def __instrument(self):
+        """
+        Wrap the public methods of the pilot and of its controllers while
+        tracing or hooks are enabled, unwrap them otherwise.
+        """
+        enabled = self.tracer is not None or len(self.hooks) > 0
+        for obj, category in (
+                (self, 'pilot'),
+                (getattr(self, 'monkey_controller', None), 'monkey'),
+                (getattr(self, 'viewserver_controller', None), 'viewserver')):
+            if obj is None:
+                continue
+            tracing.untrace_methods(obj)
+            if enabled:
+                tracing.trace_methods(obj, self.__method_probe, category,
+                                      TRACING_EXCLUDED)
+
+    def __method_probe(self, name, category, call):
+        if self.tracer is None and not self.hooks:
+            return tracing.NULL_PROBE
+        probe = tracing.Probe(name, category, {}, {}, NULL_METRICS,
+                              self.tracer, self.hooks or None)
+        probe.call = call
+        return probe
+
+    def probe(self, name, category='pilot', labels=None, **args):
+        """
+        Return a context manager measuring an operation for the metrics,
+        the tracer and the hooks (see tracing.Probe): labels label its
+        histograms, args are only recorded in its span.
+        """
+        if not self.metrics.enabled and self.tracer is None and \
+                not self.hooks:
+            return tracing.NULL_PROBE
+        return tracing.Probe(name, category, labels or {}, args,
+                             self.metrics, self.tracer, self.hooks or None)
 
     def open(self):
         # set and initialize the monkey controller instance
-        self.monkey_controller = MonkeyController(self)
+        self.monkey_controller = MonkeyController(self, clock=wait.monotonic)
         self.monkey_controller.open()
         # set and initialize the ViewServer controller instance
         self.viewserver_controller = ViewServerController(self)
         self.viewserver_controller.open()
+        self.__instrument()
 
-        self.device_api_level = self.monkey_controller.get_api_level()
+        self.device_profile = load_profile(
+            self.monkey_controller, self.device_name, self.profile_cache)
+
+        self.device_api_level = self.device_profile.api_level
         logger.info("API level: %s", self.device_api_level)
 
-        self.display_width = self.monkey_controller.get_display_width()
-        self.display_height = self.monkey_controller.get_display_height()
+        self.display_width = self.device_profile.display_width
+        self.display_height = self.device_profile.display_height
+        self.statusbar_height = self.device_profile.statusbar_height
 
         logger.info("Display size (width, height): %s, %s",
                     self.display_width, self.display_height)
@@ -52,7 +204,11 @@ class AndroPilot(object):
 
         logger.info("Current focus activity: %s", focus_activity)
         # set the notification manager instance
-        self.notification_manager = NotificationManager(self)
+        if self.notification_backend == DUMPSYS_NOTIFICATIONS:
+            self.notification_manager = DumpsysNotificationManager(self)
+        else:
+            self.notification_manager = NotificationManager(self)
+        logger.info("Notification backend: %s", self.notification_backend)
 
     # context management methods #
     def __delete__(self):
@@ -67,11 +223,35 @@ class AndroPilot(object):
     ##############################
 
     def refresh(self):
+        if self.refresher is not None and self.refresher.is_alive():
+            # a tree dumped after this call, usually without waiting for
+            # a full dump and parse
+            if self.refresher.wait_for_snapshot() is not None:
+                return
+            logger.warning("No background refresh, refreshing directly")
         logger.debug("View tree refresh START")
         self.viewserver_controller.refresh_view()
         logger.debug("View tree refresh COMPLETE")
 
+    def start_background_refresh(self, **options):
+        """
+        Keep the view tree refreshed by a background thread (see
+        refresher.BackgroundRefresher for the options): refresh() then
+        returns as soon as a tree dumped after the call is available.
+        """
+        self.stop_background_refresh()
+        self.refresher = BackgroundRefresher(self, **options)
+        self.refresher.start()
+        return self.refresher
+
+    def stop_background_refresh(self):
+        if self.refresher is None:
+            return
+        self.refresher.stop()
+        self.refresher = None
+
     def close(self):
+        self.stop_background_refresh()
         try:
             self.monkey_controller.close()
         except:
@@ -85,6 +265,12 @@ class AndroPilot(object):
                 self.viewserver_controller.close()
             except:
                 pass
+        if self.logcat_reader is not None:
+            self.logcat_reader.stop()
+        if self.shell_session is not None:
+            self.shell_session.close()
+        if self.adb_client is not None:
+            self.adb_client.close()
 
     def install_package(self, package_name):
         cmd = ['install', '-r', package_name]
@@ -96,6 +282,13 @@ class AndroPilot(object):
             logger.warning("Package %s NOT installed on device", package_name)
             raise AndroPilotException("Package not installed correctly")
 
+    def install_package_if_changed(self, apk_path, package=None):
+        """
+        Install an APK unless the very same APK is already installed.
+        Returns True if it has been installed, False if skipped.
+        """
+        return install.default_manager.install(self, apk_path, package)
+
     def push_file(self, src, dst='/sdcard/'):
         cmd = ['push', src, dst]
         ret_code = self.adb_command(cmd)
@@ -105,10 +298,17 @@ class AndroPilot(object):
             logger.warning("File %s NOT pushed to %s", src, dst)
             raise AndroPilotException("File not correctly copied")
 
+    def push_directory(self, src, dst):
+        """
+        Copy the src directory tree to dst on the device, pushing only the
+        files that are missing or changed.
+        Returns the list of pushed files.
+        """
+        return file_sync.push_tree(self, src, dst)
+
     def start_activity(self, package_name, activity_name):
-        cmd = ['shell', 'am', 'start', '-W', '-n',
-               package_name + '/' + activity_name]
-        output = self.adb_command(cmd, need_result=True)
+        cmd = ['am', 'start', '-W', '-n', package_name + '/' + activity_name]
+        output, exit_code = self.shell(cmd)
 
         if 'Complete' in output:
             logger.debug('Activity %s/%s started', package_name, activity_name)
@@ -139,6 +339,14 @@ class AndroPilot(object):
     def get_focus_activity(self):
         return self.viewserver_controller.get_focus_activity()
 
+    def get_screen_hash(self):
+        """
+        Get the structural hash of the last refreshed view tree.
+        Equal hashes mean equal screens (see viewserver_parser).
+        """
+        return vs_parser.get_tree_hash(
+            self.viewserver_controller.tree_nodes_list)
+
     def get_activity_list(self):
         activity_pairs = self.viewserver_controller.get_activity_list()
         view_list = [{'hashcode': a[0], 'classname': a[1]}
@@ -198,21 +406,45 @@ class AndroPilot(object):
     def tap_on_coordinates(self, x, y):
         self.monkey_controller.tap(x, y)
 
+    def drag(self, from_x, from_y, to_x, to_y, duration=0.5, steps=10):
+        self.monkey_controller.drag(from_x, from_y, to_x, to_y, duration,
+                                    steps)
+
 # WAITING METHODS #
 
+    def wait_any(self, conditions, timeout=TIMEOUT, **options):
+        """
+            Wait for any of the conditions (wait.Condition instances or
+            functions) to be met.
+            The view tree is refreshed once per poll, if any condition has
+            been created with refresh=True.
+            Returns a wait.WaitResult, also stored in last_wait.
+        """
+        self.last_wait = wait.wait_any(
+            conditions, timeout, refresh=self.refresh, probe=self.probe,
+            **options)
+        return self.last_wait
+
+    def wait_all(self, conditions, timeout=TIMEOUT, **options):
+        """
+            Wait for all the conditions to be met at the same time
+            (see wait_any).
+        """
+        self.last_wait = wait.wait_all(
+            conditions, timeout, refresh=self.refresh, probe=self.probe,
+            **options)
+        return self.last_wait
+
     def wait_for_activity(self, activity_name, timeout=TIMEOUT, critical=True):
         """
             Wait for a given activity to show up.
         """
-        SLEEP_TIME = 0.5  # 500 ms
-        end_time = datetime.datetime.now() + \
-            datetime.timedelta(seconds=timeout)
-        while datetime.datetime.now() <= end_time:
-            current_activity = self.get_focus_activity()
-            if current_activity == activity_name:
-                logger.debug("Activity found: %s.", current_activity)
-                return True
-            time.sleep(SLEEP_TIME)
+        condition = wait.Condition(
+            lambda: self.get_focus_activity() == activity_name,
+            name='activity %s' % activity_name)
+        if self.wait_any([condition], timeout, interval=0.5):
+            logger.debug("Activity found: %s.", activity_name)
+            return True
         logger.debug("Activity %s not found.", activity_name)
         if critical is True:
             raise AndroPilotException(
@@ -224,23 +456,19 @@ class AndroPilot(object):
         """
             Wait for a dialog window to close.
         """
-        SLEEP_TIME = 0.2  # 200 mseconds
-        views_count_before = len(self.get_activity_list())
-
-        end_time = datetime.datetime.now() + \
-            datetime.timedelta(seconds=timeout)
+        views_count = {'before': len(self.get_activity_list())}
 
-        while datetime.datetime.now().time() <= end_time.time():
+        def _dialog_closed():
             views_count_now = len(self.get_activity_list())
 
-            if views_count_before < views_count_now:
-                views_count_before = views_count_now
+            if views_count['before'] < views_count_now:
+                views_count['before'] = views_count_now
 
-            if views_count_before > views_count_now:
-                logger.debug("Detected dialog view closing.")
-                return True
-            time.sleep(SLEEP_TIME)
+            return views_count['before'] > views_count_now
 
+        if self.wait_any([_dialog_closed], timeout):
+            logger.debug("Detected dialog view closing.")
+            return True
         return False
 
     def wait_for_text(
@@ -251,16 +479,13 @@ class AndroPilot(object):
             Internally it keeps dumping the view hierarchy until the text
             is found or the timout is reached.
         """
-        end_time = datetime.datetime.now() + \
-            datetime.timedelta(seconds=timeout)
-        while datetime.datetime.now().time() <= end_time.time():
-            self.refresh()
-
-            r = self.exist_view_by_text(text, True)
-            if r is True:
-                return True
-            time.sleep(sleep_time)
-        return False
+        condition = wait.Condition(
+            lambda: self.exist_view_by_text(text, True), refresh=True,
+            name='text %s' % text)
+        # a fixed cadence of sleep_time, without backoff
+        result = self.wait_any([condition], timeout, interval=sleep_time,
+                               max_interval=sleep_time, backoff=1)
+        return result.satisfied
 
     def wait_for_custom_event(
             self, event_checker,
@@ -270,20 +495,76 @@ class AndroPilot(object):
             event_checker is a boolean function which checks
             whether the event has occurred or not.
         """
-        SLEEP_TIME = 0.2  # 200 mseconds
-        end_time = datetime.datetime.now() + \
-            datetime.timedelta(seconds=timeout)
-        while datetime.datetime.now().time() <= end_time.time():
-            if refresh:
-                self.refresh()
-            result = event_checker()
-            if result:
-                logger.debug("Custom event found")
-                return result
-            time.sleep(SLEEP_TIME)
+        condition = wait.Condition(event_checker, refresh=refresh)
+        result = self.wait_any([condition], timeout)
+        if result:
+            logger.debug("Custom event found")
+            return result.value
         logger.debug("Custom event not found. Timeout reached")
         return False
 
+    def wait_for_idle(self, quiet_period=IDLE_QUIET_PERIOD,
+                      timeout=SHORT_TIMEOUT, include_windows=True):
+        """
+            Wait for the UI to settle, i.e. for the view tree (and the
+            window list, if include_windows is set) to stay unchanged for
+            quiet_period seconds.
+            It replaces fixed sleeps after input events: it returns as
+            soon as animations are over.
+            The polls only compare the cheap window fingerprint: the view
+            tree is dumped when the windows change and once more at the
+            end of the quiet period, to check that nothing moved inside
+            them.
+        """
+        viewserver = self.viewserver_controller
+        state = {'windows': None, 'tree': None, 'since': None}
+
+        def _idle():
+            windows = viewserver.get_window_fingerprint(include_windows)
+            now = wait.monotonic()
+            if windows != state['windows']:
+                state['windows'] = windows
+                state['tree'] = viewserver.get_tree_fingerprint()
+                state['since'] = now
+                return False
+            if now - state['since'] < quiet_period:
+                return False
+            tree = viewserver.get_tree_fingerprint()
+            if tree != state['tree']:
+                state['tree'] = tree
+                state['since'] = now
+                return False
+            return True
+
+        interval = min(IDLE_POLL_INTERVAL, quiet_period / 2.0)
+        self.last_wait = wait.wait_for(
+            wait.Condition(_idle, name='idle'), timeout,
+            interval=interval, max_interval=interval, probe=self.probe)
+        return self.last_wait.satisfied
+
+    def wait_for_screen_change(self, timeout=SHORT_TIMEOUT, region=None):
+        """
+            Wait for the screen to change, comparing in-memory screenshots
+            (Android >= 5.0, requires NumPy).
+            region, a (left, top, width, height) tuple, restricts the
+            comparison to a part of the screen.
+            Useful for content not exposed by the ViewServer
+            (e.g. WebViews and games).
+        """
+        self.last_wait = screen_diff.wait_for_screen_change(
+            self, timeout, region)
+        return self.last_wait.satisfied
+
+    def wait_for_screen_stable(self, quiet_period=1.0, timeout=SHORT_TIMEOUT,
+                               region=None):
+        """
+            Wait for the screen (or region of it) to stay unchanged for
+            quiet_period seconds.
+        """
+        self.last_wait = screen_diff.wait_for_screen_stable(
+            self, quiet_period, timeout, region)
+        return self.last_wait.satisfied
+
     def get_logcat(self, filename, remove=False):
         """
         to get the logcat this function will in turn:
@@ -298,24 +579,66 @@ class AndroPilot(object):
                     device after reading it
         """
         LOGCAT_REMOTE_PATH = '/data/user/logcat.out'
-        self.adb_command(
-            ['shell', 'logcat', '-d', '-f', LOGCAT_REMOTE_PATH, '-v', 'brief',
-             'Choreographer:S', 'WindowManager:S', 'MonkeyStub:S'
-             'ViewServer:S', 'AndroTotal:S', 'dalvikvm:S'])
+        self.shell(
+            ['logcat', '-d', '-f', LOGCAT_REMOTE_PATH, '-v', 'brief'] +
+            LOGCAT_FILTERS)
         self.adb_command(['pull', LOGCAT_REMOTE_PATH, filename])
 
         if remove:
-            self.adb_command(['shell', 'rm', LOGCAT_REMOTE_PATH])
+            self.shell(['rm', LOGCAT_REMOTE_PATH])
+
+    def capture_screen(self, as_array=False):
+        """
+            Capture the screen in memory (Android >= 5.0).
+            Returns a screenshot.Screenshot, or a NumPy array of its pixels
+            if as_array is True.
+        """
+        frame = screenshot.capture(self)
+        if as_array:
+            return frame.to_array()
+        return frame
+
+    def start_logcat_reader(self, buffer_size=None):
+        """
+            Start streaming the device logcat in background (see
+            logcat.LogcatReader), required by wait_for_log.
+        """
+        if self.logcat_reader is None:
+            if buffer_size is None:
+                self.logcat_reader = LogcatReader(self)
+            else:
+                self.logcat_reader = LogcatReader(self, buffer_size)
+            self.logcat_reader.start()
+        return self.logcat_reader
+
+    def wait_for_log(self, pattern, timeout=TIMEOUT, since=None, tag=None):
+        """
+            Wait for a logcat message matching the regular expression
+            pattern, logged after the since mark (see LogcatReader.mark),
+            by default after the call: the records logged before it,
+            including the replayed device buffer, are not matched.
+            Take the mark before the operation that logs:
+            mark = pilot.start_logcat_reader().mark(), then
+            pilot.wait_for_log(pattern, since=mark).
+            Returns the matching logcat.LogRecord or None.
+        """
+        reader = self.start_logcat_reader()
+        return reader.wait_for_log(pattern, timeout, since, tag)
 
-    def take_screenshot(self, filename, use_screencap=True):
+    def take_screenshot(self, filename, use_screencap=True, stream=False):
         """
             on old android OS versions (< 3.0)  there's no screencap
             use_screencap can be set to false to use a fallback method
             with screenshot.jar
             [uses the same method as ddmlib, but sometimes the java process
             crashes so its better to stick to screencap as long as possible]
+            stream can be set to true (Android >= 5.0) to stream the raw
+            screen over exec-out and encode the PNG on the host, without
+            temporary files on the device
         """
-        if use_screencap is False:
+        if stream:
+            self.capture_screen().save_png(filename)
+        elif use_screencap is False:
             import os
             pilot_path = os.path.dirname(__file__)
             screenshot_jar_path = os.path.join(pilot_path, 'screenshot.jar')
@@ -328,15 +651,54 @@ class AndroPilot(object):
                 cmd_screenshot, stderr=subprocess.STDOUT)
             logger.debug(res)
         else:
-            self.adb_command(
-                'shell screencap -p /data/user/snapshot.png'.split())
+            self.shell('screencap -p /data/user/snapshot.png')
             self.adb_command(
                 ('pull /data/user/snapshot.png %s' % filename).split())
-            self.adb_command('shell rm /data/user/snapshot.png'.split())
+            self.shell('rm /data/user/snapshot.png')
         return filename
 
+    def shell(self, cmd, timeout=None):
+        """
+        Run a shell command on the device and return its
+        (output, exit code).
+        Commands are executed by a persistent shell session, falling back
+        to a dedicated 'adb shell' (whose exit code is not available and is
+        reported as 0) if the session cannot be used.
+        """
+        if self.shell_session is None:
+            self.shell_session = ShellSession(self)
+        try:
+            return self.shell_session.execute(cmd, timeout)
+        except ShellSessionException:
+            logger.warning("Shell session failed, using adb shell",
+                           exc_info=True)
+        if not isinstance(cmd, (list, tuple)):
+            cmd = cmd.split()
+        return self.adb_command(['shell'] + list(cmd), need_result=True), 0
+
     def adb_command(self, cmd, stdin=None, stdout=None, stderr=None,
                     blocking=True, need_result=False):
+        if not blocking:
+            return self.__adb_command(cmd, stdin, stdout, stderr, blocking,
+                                      need_result)
+        with self.probe('adb_command', 'adb', {'command': cmd[0]},
+                        cmd=' '.join(cmd)):
+            return self.__adb_command(cmd, stdin, stdout, stderr, blocking,
+                                      need_result)
+
+    def __adb_command(self, cmd, stdin, stdout, stderr, blocking,
+                      need_result):
+        if self.adb_client is not None and blocking and stdin is None and \
+                (stdout is None or hasattr(stdout, 'write')):
+            result = self.__adb_client_command(cmd, stdout)
+            if result is not None:
+                ret_code, output = result
+                if need_result:
+                    if ret_code != 0:
+                        raise subprocess.CalledProcessError(
+                            ret_code, ['adb'] + cmd, output)
+                    return output
+                return ret_code
 
         adb_cmd = ['adb', '-s', self.device_name] + cmd
         logger.debug("Executing command: " + ' '.join(adb_cmd))
@@ -354,5 +716,18 @@ class AndroPilot(object):
                     adb_cmd, stdin=stdin, stdout=stdout, stderr=stderr)
                 return proc
 
+    def __adb_client_command(self, cmd, stdout):
+        """
+        Execute the command with the in-process adb client.
+        Returns None if the command must be executed by the adb
+        executable instead (unsupported command or adb server not running).
+        """
+        logger.debug("Executing command (adb client): " + ' '.join(cmd))
+        try:
+            return self.adb_client.run(self.device_name, cmd, stdout)
+        except socket.error:
+            logger.debug("adb server not reachable, using adb executable")
+            return None
+
     def type(self, text):
         self.monkey_controller.type(text)
@@ -0,0 +1,215 @@
+import collections
+import json
+import logging
+import threading
+
+from hooks import Hook
+
+logger = logging.getLogger('andropilot')
+
+SCRIPT_HEADER = '# andropilot script 1'
+
+# the AndroPilot methods recorded in a script
+RECORDED_INPUTS = ('tap_on_coordinates', 'press_home', 'press_back',
+                   'press_menu', 'click_view_by_id', 'click_view_by_text',
+                   'drag', 'type', 'start_activity')
+RECORDED_WAITS = ('wait_for_activity', 'wait_for_text',
+                  'wait_for_dialog_to_close', 'wait_for_idle',
+                  'wait_for_screen_change', 'wait_for_screen_stable',
+                  'wait_for_log')
+
+# waits whose last poll refreshed the view tree
+REFRESHING_WAITS = ('wait_for_text',)
+# clicks resolving a view selector on the view tree
+CLICKS = ('click_view_by_id', 'click_view_by_text')
+
+
+class RecorderException(Exception):
+    pass
+
+
+# at is the (x, y) location a click selector resolved to, None otherwise
+Action = collections.namedtuple('Action', 'name args kwargs at')
+
+
+def save_script(actions, filename):
+    """
+    Write the actions one per line, as compact JSON arrays:
+    [name, args, kwargs, at], without the trailing empty fields.
+    """
+    with open(filename, 'w') as f:
+        f.write(SCRIPT_HEADER + '\n')
+        for action in actions:
+            fields = [action.name, list(action.args), action.kwargs or {},
+                      action.at]
+            while len(fields) > 1 and not fields[-1]:
+                fields.pop()
+            f.write(json.dumps(fields, separators=(',', ':')) + '\n')
+
+
+def load_script(filename):
+    actions = []
+    with open(filename) as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                fields = json.loads(line)
+            except ValueError:
+                raise RecorderException('%s:%d: invalid action' % (
+                    filename, number))
+            fields += [[], {}, None][len(fields) - 1:]
+            name, args, kwargs, at = fields[:4]
+            if name not in RECORDED_INPUTS + RECORDED_WAITS:
+                raise RecorderException('%s:%d: unknown action %s' % (
+                    filename, number, name))
+            actions.append(Action(name, tuple(args), kwargs,
+                                  tuple(at) if at else None))
+    return actions
+
+
+class Recorder(object):
+
+    """
+    Records the input and wait methods called on a pilot, with the
+    location each click selector resolved to. Only the calls made by the
+    user are recorded, not those made by the pilot itself, and only if
+    they succeed.
+    """
+
+    def __init__(self, pilot):
+        self.pilot = pilot
+        self.actions = []
+        self.hook = None
+        self.calls = threading.local()
+
+    def start(self):
+        if self.hook is None:
+            self.hook = self.pilot.add_hook(Hook(
+                self._before, self._after,
+                names=['AndroPilot.*', 'MonkeyController.tap']))
+
+    def stop(self):
+        if self.hook is not None:
+            self.pilot.remove_hook(self.hook)
+            self.hook = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+    def save(self, filename):
+        save_script(self.actions, filename)
+
+    def __stack(self):
+        if not hasattr(self.calls, 'stack'):
+            self.calls.stack = []
+        return self.calls.stack
+
+    def _before(self, probe):
+        stack = self.__stack()
+        if probe.name == 'MonkeyController.tap':
+            # the tap of a click: remember where the selector resolved
+            if stack and stack[-1] is not None and \
+                    stack[-1]['name'] in CLICKS:
+                stack[-1]['at'] = tuple(probe.call[0][:2])
+            return
+        name = probe.name.split('.', 1)[1]
+        if stack or name not in RECORDED_INPUTS + RECORDED_WAITS or \
+                probe.call is None:
+            # nested calls and other methods are not recorded
+            stack.append(None)
+            return
+        args, kwargs = probe.call
+        stack.append({'name': name, 'args': args, 'kwargs': kwargs,
+                      'at': None})
+
+    def _after(self, probe):
+        if probe.name == 'MonkeyController.tap':
+            return
+        call = self.__stack().pop()
+        if call is not None and probe.error is None:
+            self.actions.append(Action(call['name'], call['args'],
+                                       call['kwargs'], call['at']))
+
+
+class Replayer(object):
+
+    """
+    Replays a script with as little device I/O as possible: consecutive
+    taps, presses, typing and clicks at their recorded location are sent
+    to monkey in one pipelined batch, waits and the other actions are
+    synchronization points, and the view tree is refreshed only when a
+    click must resolve its selector (resolve_selectors, or no recorded
+    location) and the tree is not already fresh.
+    """
+
+    def __init__(self, pilot, actions, resolve_selectors=False):
+        self.pilot = pilot
+        self.actions = actions
+        self.resolve_selectors = resolve_selectors
+
+    @classmethod
+    def from_file(cls, pilot, filename, **options):
+        return cls(pilot, load_script(filename), **options)
+
+    def __commands(self, action):
+        """
+        Return the monkey commands of an action that can be batched, None
+        if it has to be executed by the pilot.
+        """
+        if action.name == 'tap_on_coordinates':
+            return ['tap %s %s' % tuple(action.args[:2])]
+        if action.name in ('press_home', 'press_back', 'press_menu'):
+            return ['press %s' % action.name[len('press_'):]]
+        if action.name == 'type':
+            text = action.args[0] if action.args else action.kwargs['text']
+            return self.pilot.monkey_controller.type_commands(text)
+        if action.name in CLICKS and action.at is not None and \
+                not self.resolve_selectors:
+            return ['tap %s %s' % action.at]
+        return None
+
+    def compile(self):
+        """
+        Return the replay steps: ('batch', commands) or ('call', action).
+        """
+        steps = []
+        batch = []
+        for action in self.actions:
+            commands = self.__commands(action)
+            if commands is not None:
+                batch.extend(commands)
+                continue
+            if batch:
+                steps.append(('batch', batch))
+                batch = []
+            steps.append(('call', action))
+        if batch:
+            steps.append(('batch', batch))
+        return steps
+
+    def run(self):
+        """
+        Replay the script. Returns the results of the calls.
+        """
+        steps = self.compile()
+        logger.info("Replaying %d actions in %d steps", len(self.actions),
+                    len(steps))
+        tree_fresh = False
+        results = []
+        for kind, value in steps:
+            if kind == 'batch':
+                self.pilot.monkey_controller.send_batch(value)
+                tree_fresh = False
+                continue
+            if value.name in CLICKS and not tree_fresh:
+                self.pilot.refresh()
+            results.append(getattr(self.pilot, value.name)(*value.args,
+                                                           **value.kwargs))
+            tree_fresh = value.name in REFRESHING_WAITS
+        return results
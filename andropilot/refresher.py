@@ -0,0 +1,176 @@
+import logging
+import threading
+import zlib
+
+from hooks import Hook
+import wait
+
+logger = logging.getLogger('andropilot')
+
+DEFAULT_MIN_INTERVAL = 0.05
+DEFAULT_MAX_INTERVAL = 1.0
+DEFAULT_BACKOFF = 1.5
+SNAPSHOT_TIMEOUT = 10
+
+# the operations after which the screen is expected to change
+INPUT_OPERATIONS = ['MonkeyController.tap', 'MonkeyController.press',
+                    'MonkeyController.type', 'MonkeyController.drag',
+                    'MonkeyController.send_batch',
+                    'AndroPilot.start_activity']
+
+
+class RefresherException(Exception):
+    pass
+
+
+class Snapshot(object):
+
+    """
+    A parsed view tree. sequence increases with every dump: a snapshot
+    with a sequence greater than mark() has been dumped after the mark.
+    """
+
+    def __init__(self, sequence, tree_nodes_list, checksum, taken_at):
+        self.sequence = sequence
+        self.tree_nodes_list = tree_nodes_list
+        self.checksum = checksum
+        self.taken_at = taken_at
+
+
+class BackgroundRefresher(threading.Thread):
+
+    """
+    Keeps dumping and parsing the view tree of a pilot in background.
+
+    Every dump is parsed into a new tree (the back buffer), which is then
+    swapped in as the latest snapshot and as the tree of the ViewServer
+    controller, so the pilot queries read it without blocking. A dump
+    identical to the previous one is not parsed again.
+
+    The interval between dumps is adaptive: it drops to min_interval when
+    the screen changes or after an input event (see INPUT_OPERATIONS) and
+    grows by backoff, up to max_interval, while the screen is unchanged.
+    """
+
+    def __init__(self, pilot, min_interval=DEFAULT_MIN_INTERVAL,
+                 max_interval=DEFAULT_MAX_INTERVAL, backoff=DEFAULT_BACKOFF):
+        threading.Thread.__init__(
+            self, name='refresher-%s' % pilot.device_name)
+        self.daemon = True
+        self.pilot = pilot
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.interval = min_interval
+
+        self.condition = threading.Condition()
+        self.snapshot = None
+        # sequence number of the last dump started
+        self.started = 0
+        self.wakeup = False
+        self.stopped = False
+        self.hook = None
+        self.parses = 0
+        self.errors = 0
+
+    def start(self):
+        if getattr(self.pilot, 'viewserver_controller', None) is None:
+            raise RefresherException('The pilot is not open')
+        self.hook = self.pilot.add_hook(Hook(
+            after=self._input_done, names=INPUT_OPERATIONS))
+        threading.Thread.start(self)
+
+    def stop(self):
+        if self.hook is not None:
+            self.pilot.remove_hook(self.hook)
+            self.hook = None
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
+
+    def _input_done(self, probe):
+        self.notify_input()
+
+    def notify_input(self):
+        """
+        Dump again now, and at min_interval until the screen settles.
+        """
+        with self.condition:
+            self.interval = self.min_interval
+            self.wakeup = True
+            self.condition.notify_all()
+
+    def latest(self):
+        """
+        The last snapshot, None until the first dump is parsed.
+        """
+        return self.snapshot
+
+    def mark(self):
+        return self.started
+
+    def wait_for_snapshot(self, after=None, timeout=SNAPSHOT_TIMEOUT):
+        """
+        Return the first snapshot whose sequence is greater than after
+        (by default: dumped after this call), waking the refresher up.
+        Returns None on timeout.
+        """
+        if after is None:
+            after = self.mark()
+        deadline = wait.monotonic() + timeout
+        with self.condition:
+            self.wakeup = True
+            self.condition.notify_all()
+            while self.snapshot is None or self.snapshot.sequence <= after:
+                remaining = deadline - wait.monotonic()
+                if remaining <= 0 or self.stopped:
+                    return None
+                self.condition.wait(remaining)
+            return self.snapshot
+
+    def run(self):
+        while True:
+            with self.condition:
+                if self.stopped:
+                    return
+                self.started += 1
+                sequence = self.started
+            try:
+                self.__refresh(sequence)
+            except Exception:
+                self.errors += 1
+                logger.warning("Background refresh of %s failed",
+                               self.pilot.device_name, exc_info=True)
+                with self.condition:
+                    self.interval = self.max_interval
+            with self.condition:
+                if not self.wakeup and not self.stopped:
+                    self.condition.wait(self.interval)
+                self.wakeup = False
+
+    def __refresh(self, sequence):
+        viewserver = self.pilot.viewserver_controller
+        data = viewserver.get_data_by_socket(viewserver.DUMP_ALL_CMD)
+        checksum = zlib.crc32(data)
+        previous = self.snapshot
+        changed = previous is None or previous.checksum != checksum
+        if changed:
+            tree_nodes_list = viewserver.build_tree(data)
+            self.parses += 1
+        else:
+            tree_nodes_list = previous.tree_nodes_list
+        snapshot = Snapshot(sequence, tree_nodes_list, checksum,
+                            wait.monotonic())
+
+        with self.condition:
+            # the swap: readers get either the old or the new tree
+            self.snapshot = snapshot
+            viewserver.tree_nodes_list = tree_nodes_list
+            if changed:
+                self.interval = self.min_interval
+            else:
+                self.interval = min(self.interval * self.backoff,
+                                    self.max_interval)
+            self.condition.notify_all()
@@ -0,0 +1,156 @@
+import logging
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import wait
+
+logger = logging.getLogger('screen_diff')
+
+HASH_SIZE = 8
+THUMBNAIL_SIZE = (64, 64)
+
+# grayscale difference (0-255) above which a thumbnail cell is changed
+PIXEL_THRESHOLD = 16
+# fraction of changed thumbnail cells above which two frames differ
+CHANGED_FRACTION = 0.005
+# hash bits that may differ between two frames of the same screen
+HASH_DISTANCE = 0
+
+DEFAULT_INTERVAL = 0.2
+
+
+class ScreenDiffException(Exception):
+    pass
+
+
+def _check_numpy():
+    if numpy is None:
+        raise ScreenDiffException('NumPy is required for screen comparison')
+
+
+def crop(array, region):
+    """
+    Restrict the frame to region, a (left, top, width, height) tuple.
+    """
+    if region is None:
+        return array
+    left, top, width, height = region
+    return array[top:top + height, left:left + width]
+
+
+def grayscale(array):
+    """
+    Convert a (height, width, channels) RGB(A) frame to luminance.
+    """
+    if array.ndim == 2:
+        return array.astype(numpy.float32)
+    rgb = array[..., :3].astype(numpy.float32)
+    return rgb[..., 0] * 0.299 + rgb[..., 1] * 0.587 + rgb[..., 2] * 0.114
+
+
+def downsample(gray, size):
+    """
+    Reduce a grayscale frame to size (rows, columns) by averaging blocks.
+    """
+    rows, columns = size
+    height, width = gray.shape
+    rows, columns = min(rows, height), min(columns, width)
+    row_edges = (numpy.arange(rows) * height) // rows
+    column_edges = (numpy.arange(columns) * width) // columns
+
+    sums = numpy.add.reduceat(
+        numpy.add.reduceat(gray, row_edges, axis=0), column_edges, axis=1)
+    row_counts = numpy.diff(numpy.append(row_edges, height))
+    column_counts = numpy.diff(numpy.append(column_edges, width))
+    return sums / numpy.outer(row_counts, column_counts)
+
+
+def difference_hash(gray, hash_size=HASH_SIZE):
+    """
+    Perceptual hash of a grayscale frame: one bit for each pair of
+    horizontally adjacent cells of a (hash_size, hash_size + 1) thumbnail.
+    """
+    cells = downsample(gray, (hash_size, hash_size + 1))
+    bits = (cells[:, 1:] > cells[:, :-1]).flatten()
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+    return value
+
+
+def hamming_distance(hash1, hash2):
+    return bin(hash1 ^ hash2).count('1')
+
+
+class ScreenState(object):
+
+    """
+    The fingerprint of a frame (or of a region of it): a perceptual hash
+    for cheap equality checks and a small grayscale thumbnail for
+    measuring how much of it changed.
+    """
+
+    def __init__(self, array, region=None):
+        _check_numpy()
+        gray = grayscale(crop(array, region))
+        self.region = region
+        self.hash = difference_hash(gray)
+        self.thumbnail = downsample(gray, THUMBNAIL_SIZE)
+        self.timestamp = wait.monotonic()
+
+    def changed_fraction(self, other, pixel_threshold=PIXEL_THRESHOLD):
+        if self.thumbnail.shape != other.thumbnail.shape:
+            return 1.0
+        changed = numpy.abs(self.thumbnail - other.thumbnail) > \
+            pixel_threshold
+        return float(changed.mean())
+
+    def differs(self, other, hash_distance=HASH_DISTANCE,
+                changed_fraction=CHANGED_FRACTION):
+        if hamming_distance(self.hash, other.hash) > hash_distance:
+            return True
+        return self.changed_fraction(other) > changed_fraction
+
+
+def capture_state(pilot, region=None):
+    return ScreenState(pilot.capture_screen(as_array=True), region)
+
+
+def wait_for_screen_change(pilot, timeout, region=None, reference=None,
+                           interval=DEFAULT_INTERVAL):
+    """
+    Wait until the screen (or region) differs from reference, by default
+    the screen at the time of the call.
+    Returns a wait.WaitResult.
+    """
+    if reference is None:
+        reference = capture_state(pilot, region)
+
+    def _screen_changed():
+        return capture_state(pilot, region).differs(reference)
+
+    return wait.wait_for(_screen_changed, timeout, interval=interval,
+                         max_interval=interval, probe=pilot.probe)
+
+
+def wait_for_screen_stable(pilot, quiet_period, timeout, region=None,
+                           interval=DEFAULT_INTERVAL):
+    """
+    Wait until the screen (or region) has not changed for quiet_period
+    seconds.
+    Returns a wait.WaitResult.
+    """
+    states = {'last': capture_state(pilot, region)}
+
+    def _screen_stable():
+        state = capture_state(pilot, region)
+        if state.differs(states['last']):
+            states['last'] = state
+            return False
+        return state.timestamp - states['last'].timestamp >= quiet_period
+
+    return wait.wait_for(_screen_stable, timeout, interval=interval,
+                         max_interval=interval, probe=pilot.probe)
@@ -0,0 +1,217 @@
+import logging
+import struct
+import threading
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+logger = logging.getLogger('screenshot')
+
+# the raw screencap header is (width, height, format), Android 8.0 added
+# a fourth field (the color space)
+HEADER_SIZE = 12
+COLOR_SPACE_SIZE = 4
+
+# android.graphics.PixelFormat values and their bytes per pixel
+PIXEL_FORMAT_RGBA_8888 = 1
+PIXEL_FORMAT_RGBX_8888 = 2
+PIXEL_FORMAT_RGB_888 = 3
+PIXEL_FORMAT_RGB_565 = 4
+
+BYTES_PER_PIXEL = {
+    PIXEL_FORMAT_RGBA_8888: 4,
+    PIXEL_FORMAT_RGBX_8888: 4,
+    PIXEL_FORMAT_RGB_888: 3,
+    PIXEL_FORMAT_RGB_565: 2,
+}
+
+# PNG color types for the pixel formats we can encode without conversion
+PNG_COLOR_TYPES = {
+    PIXEL_FORMAT_RGBA_8888: 6,
+    PIXEL_FORMAT_RGBX_8888: 6,
+    PIXEL_FORMAT_RGB_888: 2,
+}
+
+SCREENCAP_CMD = 'screencap'
+
+
+class ScreenshotException(Exception):
+    pass
+
+
+class Screenshot(object):
+
+    """
+    A raw frame captured by screencap.
+    The pixels are kept in the buffer they have been received into:
+    pixels is a memoryview on it and to_array() a NumPy view, no copy is
+    made until the frame is encoded.
+    """
+
+    def __init__(self, width, height, pixel_format, data, offset):
+        self.width = width
+        self.height = height
+        self.pixel_format = pixel_format
+        self.bytes_per_pixel = BYTES_PER_PIXEL.get(pixel_format, 4)
+        self.data = data
+        self.offset = offset
+
+    @classmethod
+    def from_raw(cls, data):
+        """
+        Build a screenshot from the whole screencap output.
+        """
+        if len(data) < HEADER_SIZE:
+            raise ScreenshotException('screencap output too short')
+        width, height, pixel_format = struct.unpack_from('<III', data)
+        size = width * height * BYTES_PER_PIXEL.get(pixel_format, 4)
+        offset = len(data) - size
+        if offset not in (HEADER_SIZE, HEADER_SIZE + COLOR_SPACE_SIZE):
+            raise ScreenshotException(
+                'Unexpected screencap size %s for %sx%s' % (
+                    len(data), width, height))
+        return cls(width, height, pixel_format, data, offset)
+
+    @property
+    def stride(self):
+        return self.width * self.bytes_per_pixel
+
+    @property
+    def pixels(self):
+        return memoryview(self.data)[self.offset:]
+
+    def to_array(self):
+        """
+        Return the pixels as a (height, width, bytes per pixel) NumPy array
+        sharing the memory of the screenshot.
+        RGB_565 frames are converted to a new (height, width, 3) RGB array.
+        """
+        if numpy is None:
+            raise ScreenshotException('NumPy is required by to_array()')
+        if self.pixel_format == PIXEL_FORMAT_RGB_565:
+            return self.__rgb565_to_rgb()
+        if self.pixel_format not in BYTES_PER_PIXEL:
+            raise ScreenshotException(
+                'Pixel format %s not supported' % self.pixel_format)
+        return numpy.frombuffer(
+            self.data, dtype=numpy.uint8, count=self.height * self.stride,
+            offset=self.offset).reshape(
+                self.height, self.width, self.bytes_per_pixel)
+
+    def __rgb565_to_rgb(self):
+        pixels = numpy.frombuffer(
+            self.data, dtype='<u2', count=self.height * self.width,
+            offset=self.offset).reshape(self.height, self.width)
+        rgb = numpy.empty((self.height, self.width, 3), dtype=numpy.uint8)
+        # scale the 5 and 6 bit channels to 0-255
+        rgb[..., 0] = ((pixels >> 11) & 0x1f) * 255 // 0x1f
+        rgb[..., 1] = ((pixels >> 5) & 0x3f) * 255 // 0x3f
+        rgb[..., 2] = (pixels & 0x1f) * 255 // 0x1f
+        return rgb
+
+    def to_png(self):
+        """
+        Encode the screenshot as PNG (RGB_565 frames require NumPy).
+        """
+        data, offset, stride = self.data, self.offset, self.stride
+        color_type = PNG_COLOR_TYPES.get(self.pixel_format)
+        if self.pixel_format == PIXEL_FORMAT_RGB_565 and numpy is not None:
+            data, offset, stride = self.to_array().tostring(), 0, \
+                self.width * 3
+            color_type = PNG_COLOR_TYPES[PIXEL_FORMAT_RGB_888]
+        if color_type is None:
+            raise ScreenshotException(
+                'Pixel format %s not supported' % self.pixel_format)
+
+        raw_rows = []
+        for y in range(self.height):
+            start = offset + y * stride
+            # filter type 0 (none) for every scanline
+            raw_rows.append('\x00')
+            raw_rows.append(str(data[start:start + stride]))
+
+        def _chunk(chunk_type, payload):
+            crc = zlib.crc32(chunk_type + payload) & 0xffffffff
+            return (struct.pack('>I', len(payload)) + chunk_type + payload +
+                    struct.pack('>I', crc))
+
+        header = struct.pack('>IIBBBBB', self.width, self.height, 8,
+                             color_type, 0, 0, 0)
+        return ''.join([
+            '\x89PNG\r\n\x1a\n',
+            _chunk('IHDR', header),
+            _chunk('IDAT', zlib.compress(''.join(raw_rows), 1)),
+            _chunk('IEND', ''),
+        ])
+
+    def save_png(self, filename, background=False):
+        """
+        Write the screenshot to filename as PNG.
+        With background=True the encoding is done by a separate thread,
+        which is returned (already started).
+        """
+        def _save():
+            with open(filename, 'wb') as f:
+                f.write(self.to_png())
+            logger.debug("Screenshot saved to %s", filename)
+
+        if not background:
+            _save()
+            return None
+
+        thread = threading.Thread(target=_save, name='png-%s' % filename)
+        thread.start()
+        return thread
+
+
+def _read_into_buffer(connection):
+    """
+    Read the screencap output from an adb connection straight into a
+    buffer sized after the header, without intermediate copies.
+    """
+    header = connection.read_exactly(HEADER_SIZE)
+    width, height, pixel_format = struct.unpack('<III', header)
+    size = width * height * BYTES_PER_PIXEL.get(pixel_format, 4)
+
+    data = bytearray(HEADER_SIZE + COLOR_SPACE_SIZE + size)
+    data[:HEADER_SIZE] = header
+    view = memoryview(data)
+    received = HEADER_SIZE
+    while received < len(data):
+        count = connection.socket.recv_into(view[received:])
+        if count == 0:
+            break
+        received += count
+
+    if received == len(data):
+        offset = HEADER_SIZE + COLOR_SPACE_SIZE
+    elif received == HEADER_SIZE + size:
+        offset = HEADER_SIZE
+    else:
+        raise ScreenshotException('Truncated screencap output')
+    return Screenshot(width, height, pixel_format, data, offset)
+
+
+def capture(pilot):
+    """
+    Capture the screen of the device in memory, streaming the raw
+    screencap output over exec-out (requires Android 5.0): nothing is
+    written on the device and no PNG is encoded there.
+    """
+    cmd = ['exec-out', SCREENCAP_CMD]
+    if pilot.adb_client is not None:
+        # read straight into the frame buffer, measured as the
+        # pilot.adb_command it replaces
+        with pilot.probe('adb_command', 'adb', {'command': cmd[0]},
+                         cmd=' '.join(cmd)):
+            connection = pilot.adb_client.open_service(
+                pilot.device_name, 'exec:%s' % SCREENCAP_CMD)
+            try:
+                return _read_into_buffer(connection)
+            finally:
+                connection.close()
+
+    return Screenshot.from_raw(pilot.adb_command(cmd, need_result=True))
@@ -0,0 +1,161 @@
+import itertools
+import logging
+import os
+import Queue
+import re
+import subprocess
+import threading
+import uuid
+
+logger = logging.getLogger('shell_session')
+
+# every command is followed by an echo of this marker, carrying its exit code
+MARKER_FORMAT = '__AP_%s_$?__'
+MARKER_RE = re.compile(r'__AP_([0-9a-fx]+)_(\d+)__')
+
+# silence the prompt and the echo of the pty allocated by old adb versions
+SESSION_SETUP = "export PS1='' PS2=''; stty -echo 2>/dev/null"
+
+
+class ShellSessionException(Exception):
+    pass
+
+
+class _Request(object):
+
+    def __init__(self, command):
+        self.command = command
+        self.done = threading.Event()
+        self.output = None
+        self.exit_code = None
+        self.error = None
+
+
+class ShellSession(object):
+
+    """
+    A long-lived 'adb shell' on the device, which runs the commands one
+    after the other instead of starting a new shell for each one.
+
+    Commands are framed by a unique marker echoed after each of them
+    (together with its exit code), so their output can be split on the
+    single stdout stream. Concurrent callers are served in order through
+    a queue by a single worker thread.
+    """
+
+    def __init__(self, pilot):
+        self.pilot = pilot
+        self.session_id = uuid.uuid4().hex[:8]
+        self.counter = itertools.count()
+        self.requests = Queue.Queue()
+        self.process = None
+        self.worker = None
+        self.lock = threading.Lock()
+        self.buffer = ''
+
+    def open(self):
+        logger.info("Opening shell session on %s", self.pilot.device_name)
+        self.process = subprocess.Popen(
+            ['adb', '-s', self.pilot.device_name, 'shell'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT)
+        self.buffer = ''
+        # the setup output (if any) is discarded with the first marker
+        self.__run(SESSION_SETUP)
+
+    def close(self):
+        with self.lock:
+            if self.worker is not None:
+                self.requests.put(None)
+                self.worker = None
+        self.__kill()
+
+    def __kill(self):
+        process, self.process = self.process, None
+        if process is None:
+            return
+        try:
+            process.stdin.write('exit\n')
+            process.stdin.close()
+        except (IOError, OSError):
+            pass
+        try:
+            process.kill()
+        except OSError:
+            pass
+
+    def execute(self, command, timeout=None):
+        """
+        Run a command on the device and return its (output, exit code).
+
+        Args:
+            command (str or list): the shell command line.
+            timeout (float): seconds to wait for the command to complete,
+                on expiration the session is killed (and reopened by the
+                following command).
+        """
+        if isinstance(command, (list, tuple)):
+            command = ' '.join(command)
+
+        self.__ensure_worker()
+        request = _Request(command)
+        self.requests.put(request)
+
+        request.done.wait(timeout)
+        if not request.done.is_set():
+            logger.warning("Shell command '%s' timed out", command)
+            # unblock the worker, which will report the failure
+            self.__kill()
+            request.done.wait()
+        if request.error is not None:
+            raise ShellSessionException(request.error)
+        return request.output, request.exit_code
+
+    def __ensure_worker(self):
+        with self.lock:
+            if self.worker is None:
+                self.worker = threading.Thread(
+                    target=self.__work,
+                    name='shell-session-%s' % self.pilot.device_name)
+                self.worker.daemon = True
+                self.worker.start()
+
+    def __work(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                return
+            try:
+                if self.process is None or self.process.poll() is not None:
+                    self.open()
+                request.output, request.exit_code = self.__run(
+                    request.command)
+            except (ShellSessionException, IOError, OSError) as e:
+                request.error = 'Shell command %s failed: %s' % (
+                    request.command, e)
+                self.__kill()
+            request.done.set()
+
+    def __run(self, command):
+        marker_id = '%sx%d' % (self.session_id, next(self.counter))
+        process = self.process
+        # stdin is detached so that the command cannot swallow the echo
+        process.stdin.write('{ %s\n} </dev/null\necho "%s"\n' % (
+            command, MARKER_FORMAT % marker_id))
+        process.stdin.flush()
+
+        return self.__read_until_marker(process, marker_id)
+
+    def __read_until_marker(self, process, marker_id):
+        while True:
+            for match in MARKER_RE.finditer(self.buffer):
+                if match.group(1) != marker_id:
+                    continue
+                output = self.buffer[:match.start()]
+                self.buffer = self.buffer[match.end():].lstrip('\r\n')
+                return output.replace('\r\n', '\n'), int(match.group(2))
+
+            data = os.read(process.stdout.fileno(), 4096)
+            if not data:
+                raise ShellSessionException('shell session closed')
+            self.buffer += data
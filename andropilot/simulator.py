@@ -0,0 +1,1152 @@
+"""
+A simulated device for running AndroPilot without an emulator.
+
+The Simulator serves, on local ports, a monkey server and a ViewServer for
+every SimulatedDevice, and an adb server for all of them (smart-socket
+protocol: shell, exec, sync and forward). This module is also the fake
+adb executable: Simulator.start() puts a wrapper running it first in the
+PATH, so the adb processes forked by the pilot talk to the simulated adb
+server. Every device reply goes through a Link, which can add latency and
+limit the bandwidth.
+"""
+import collections
+import hashlib
+import json
+import logging
+import os
+import pipes
+import shlex
+import shutil
+import socket
+import SocketServer
+import stat
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+import adb_client
+from device_profile import DeviceProfile
+import screenshot
+from controllers import viewserver_parser as vs_parser
+
+logger = logging.getLogger('simulator')
+
+ADB_VERSION = 31
+DEFAULT_SERIAL = 'emulator-5554'
+
+DEFAULT_PROPERTIES = {
+    'build.fingerprint': 'andropilot/simulator/generic:4.4.2/KOT49H/1:eng',
+    'build.version.sdk': '19',
+    'build.version.release': '4.4.2',
+    'build.model': 'AndroPilot simulator',
+    'build.product': 'simulator',
+    'display.width': '480',
+    'display.height': '800',
+    'display.density': '1.5',
+}
+
+# getprop names of the monkey variables
+GETPROP_NAMES = {
+    'ro.build.fingerprint': 'build.fingerprint',
+    'ro.build.version.sdk': 'build.version.sdk',
+    'ro.build.version.release': 'build.version.release',
+    'ro.product.model': 'build.model',
+    'ro.product.name': 'build.product',
+}
+
+KEYCODES = {'3': 'home', '4': 'back', '82': 'menu'}
+
+# the key of the transition followed when back is pressed
+BACK_KEY = 'back'
+
+STATUS_BAR_HASHCODE = '5a7b0001'
+STATUS_BAR_CLASSNAME = 'com.android.systemui.statusbar.phone.PhoneStatusBarView'
+
+# seconds between the checks of the streaming connections (AUTOLIST,
+# monkey and logcat) for new data or a closed peer
+STREAM_POLL_INTERVAL = 0.2
+
+SYNC_DATA_MAX = adb_client.SYNC_DATA_MAX
+DEVICE_DIRECTORIES = ('/', '/data', '/data/local', '/data/local/tmp',
+                      '/data/user', '/sdcard')
+
+
+class SimulatorException(Exception):
+    pass
+
+
+class Link(object):
+
+    """
+    The connection to a device: every reply is delayed by latency seconds
+    and sent at most at bandwidth bytes per second (None for unlimited).
+    """
+
+    def __init__(self, latency=0.0, bandwidth=None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+
+    def wait(self, size=0):
+        """
+        Sleep for the time a transfer of size bytes takes.
+        """
+        delay = self.latency
+        if self.bandwidth:
+            delay += size / float(self.bandwidth)
+        if delay > 0:
+            time.sleep(delay)
+
+    def send(self, sock, data):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        if not self.bandwidth:
+            sock.sendall(data)
+            return
+        for start in xrange(0, len(data), SYNC_DATA_MAX):
+            chunk = data[start:start + SYNC_DATA_MAX]
+            sock.sendall(chunk)
+            time.sleep(len(chunk) / float(self.bandwidth))
+
+
+def view_line(depth, class_name, ident='', text='', rect=(0, 0, 0, 0),
+              clickable=False, hashcode=None):
+    """
+    Return the ViewServer dump line of a view, rect is (left, top, right,
+    bottom) relative to its parent.
+    """
+    left, top, right, bottom = rect
+    if hashcode is None:
+        hashcode = '%x' % (zlib.crc32('%s|%s|%s|%s' % (
+            class_name, ident, text, rect)) & 0xffffffff)
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    properties = [
+        ('mID', ident), ('mText', text),
+        ('layout:mLeft', left), ('layout:mTop', top),
+        ('layout:mRight', right), ('layout:mBottom', bottom),
+        ('layout:getWidth()', right - left),
+        ('layout:getHeight()', bottom - top),
+        ('isClickable()', 'true' if clickable else 'false'),
+        ('isEnabled()', 'true'), ('getVisibility()', 'VISIBLE')]
+    return '%s%s@%s %s' % (' ' * depth, class_name, hashcode, ' '.join(
+        '%s=%d,%s' % (name, len(str(value)), value)
+        for name, value in properties))
+
+
+class Screen(object):
+
+    """
+    A screen of the simulated device: the component of its activity, its
+    view tree dump (scripted with view_line or recorded, see record_screen)
+    and the screens reached by tapping its views, by view id. The
+    BACK_KEY transition is followed when back is pressed.
+    """
+
+    def __init__(self, name, component, dump, transitions=None):
+        self.name = name
+        self.component = component
+        self.dump = dump.rstrip('\n')
+        self.transitions = dict(transitions or {})
+        self.hashcode = '%08x' % (zlib.crc32(name) & 0xffffffff)
+        self.nodes = None
+
+    def target_at(self, x, y, y_offset=0):
+        """
+        Return the screen reached by a tap at (x, y), None if no view with
+        a transition is there.
+        """
+        if self.nodes is None:
+            self.nodes = vs_parser.build_tree(self.dump)
+        for node in reversed(self.nodes):
+            if not node.isShown or node.mId not in self.transitions:
+                continue
+            left, top, right, bottom = node.get_absolute_rect()
+            if left <= x < right and top + y_offset <= y < bottom + y_offset:
+                return self.transitions[node.mId]
+        return None
+
+    def to_dict(self):
+        return {'name': self.name, 'component': self.component,
+                'dump': self.dump, 'transitions': self.transitions}
+
+    @classmethod
+    def from_dict(cls, values):
+        return cls(values['name'], values['component'], values['dump'],
+                   values.get('transitions'))
+
+
+def record_screen(pilot, name, transitions=None):
+    """
+    Return a Screen with the focused window of a real device.
+    """
+    viewserver = pilot.viewserver_controller
+    focus = viewserver.get_data_by_socket(viewserver.GET_FOCUS_CMD)
+    dump = viewserver.get_data_by_socket(viewserver.DUMP_ALL_CMD)
+    if dump.endswith('DONE.'):
+        dump = dump[:-len('DONE.')]
+    return Screen(name, focus.partition(' ')[2], dump, transitions)
+
+
+def save_screens(screens, filename):
+    with open(filename, 'w') as f:
+        json.dump([s.to_dict() for s in screens], f, indent=1)
+
+
+def load_screens(filename):
+    with open(filename) as f:
+        return [Screen.from_dict(values) for values in json.load(f)]
+
+
+def _extra_value(text):
+    # in dumpsys notification a redacted text shows only its type
+    return 'String' if text is None else 'String (%s)' % text
+
+
+class SimulatedDevice(object):
+
+    """
+    The state of a simulated device: its screens, files, packages,
+    notifications and logcat, and the counts of the commands received.
+    """
+
+    def __init__(self, serial, screens, start=None, properties=None,
+                 latency=0.0, bandwidth=None):
+        if not screens:
+            raise SimulatorException('A device needs at least one screen')
+        self.serial = serial
+        self.screens = collections.OrderedDict((s.name, s) for s in screens)
+        self.current = self.screens[start or screens[0].name]
+        self.properties = dict(DEFAULT_PROPERTIES)
+        self.properties.update(properties or {})
+        profile = DeviceProfile(serial, self.properties)
+        self.display_width = profile.display_width
+        self.display_height = profile.display_height
+        self.statusbar_height = profile.statusbar_height
+        self.link = Link(latency, bandwidth)
+
+        # notified on every change of the screen, the files or the logcat
+        self.changed = threading.Condition()
+        self.window_list_version = 0
+        self.files = {}
+        self.directories = set(DEVICE_DIRECTORIES)
+        self.packages = collections.OrderedDict()
+        self.notifications = []
+        self.log_lines = []
+        self.typed = []
+        self.events = collections.Counter()
+        self.frames = {}
+
+    # screens #
+    def show(self, name):
+        with self.changed:
+            screen = self.screens[name]
+            if screen is not self.current:
+                self.current = screen
+                self.window_list_version += 1
+                self.log('I', 'ActivityManager',
+                         'Displayed %s' % screen.component)
+            self.changed.notify_all()
+
+    def tap(self, x, y):
+        self.events['tap'] += 1
+        target = self.current.target_at(x, y, self.statusbar_height)
+        if target is not None:
+            self.show(target)
+
+    def press(self, key):
+        key = key.lower()
+        if key.startswith('keycode_'):
+            key = key[len('keycode_'):]
+        key = KEYCODES.get(key, key)
+        self.events['press'] += 1
+        if key == BACK_KEY and BACK_KEY in self.current.transitions:
+            self.show(self.current.transitions[BACK_KEY])
+
+    def start_activity(self, component):
+        screen = next((s for s in self.screens.values()
+                       if s.component == component), None)
+        if screen is None:
+            return False
+        self.show(screen.name)
+        return True
+
+    def windows(self):
+        return [(self.current.hashcode, self.current.component),
+                (STATUS_BAR_HASHCODE, 'StatusBar')]
+
+    def dump(self, hashcode=None):
+        if hashcode == STATUS_BAR_HASHCODE:
+            return view_line(0, STATUS_BAR_CLASSNAME, 'id/panel', '', (
+                0, 0, self.display_width, self.statusbar_height))
+        return self.current.dump
+
+    def frame(self):
+        """
+        Return the raw screencap output of the current screen: a plain
+        color, different for every screen.
+        """
+        frame = self.frames.get(self.current.name)
+        if frame is None:
+            color = struct.pack('<I', zlib.crc32(self.current.name) &
+                                0xffffffff | 0xff000000)
+            frame = struct.pack(
+                '<IIII', self.display_width, self.display_height,
+                screenshot.PIXEL_FORMAT_RGBA_8888, 0) + \
+                color * (self.display_width * self.display_height)
+            self.frames[self.current.name] = frame
+        return frame
+
+    # files #
+    def write_file(self, path, data, mtime=None):
+        with self.changed:
+            self.files[path] = (data, int(time.time() if mtime is None
+                                          else mtime))
+            directory = os.path.dirname(path)
+            while directory not in self.directories:
+                self.directories.add(directory)
+                directory = os.path.dirname(directory)
+
+    def read_file(self, path):
+        if path == '/dev/null':
+            return ''
+        entry = self.files.get(path)
+        return entry[0] if entry is not None else None
+
+    def stat(self, path):
+        """
+        Return the (mode, size, mtime) of a path, mode is 0 if it does
+        not exist.
+        """
+        path = path.rstrip('/') or '/'
+        if path in self.directories:
+            return stat.S_IFDIR | 0o755, 0, 0
+        entry = self.files.get(path)
+        if entry is None:
+            return 0, 0, 0
+        return stat.S_IFREG | 0o644, len(entry[0]), entry[1]
+
+    # packages, notifications and logcat #
+    def install(self, package):
+        previous = self.packages.get(package)
+        self.packages[package] = {
+            'versionCode': previous['versionCode'] + 1 if previous else 1,
+            'lastUpdateTime': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+    def notify(self, package, ident, title, text):
+        with self.changed:
+            self.notifications = [n for n in self.notifications
+                                  if n[:2] != (package, ident)]
+            self.notifications.append((package, ident, title, text))
+
+    def cancel(self, package, ident):
+        with self.changed:
+            self.notifications = [n for n in self.notifications
+                                  if n[:2] != (package, ident)]
+
+    def log(self, priority, tag, message):
+        with self.changed:
+            self.log_lines.append('%s/%s( 1234): %s' % (priority, tag,
+                                                        message))
+            self.changed.notify_all()
+
+    # protocols #
+    def monkey_command(self, command):
+        """
+        Execute a monkey command and return its reply line.
+        """
+        words = command.split()
+        name = words[0]
+        if name not in ('tap', 'press'):
+            self.events[name] += 1
+        try:
+            if name == 'getvar':
+                value = self.properties.get(words[1])
+                if value is None:
+                    return 'ERROR: no such var'
+                return 'OK:%s' % value
+            elif name == 'tap':
+                self.tap(int(words[1]), int(words[2]))
+            elif name == 'press':
+                self.press(words[1])
+            elif name == 'type':
+                self.typed.append(command[len('type '):])
+            elif name not in ('touch', 'key', 'wake', 'done', 'sleep',
+                              'flip', 'trackball'):
+                return 'ERROR: unknown command'
+        except (IndexError, ValueError):
+            return 'ERROR: bad arguments'
+        return 'OK'
+
+    def viewserver_command(self, command):
+        name, _, argument = command.partition(' ')
+        self.events[name] += 1
+        if name == 'LIST':
+            return ''.join('%s %s\n' % w for w in self.windows()) + 'DONE.\n'
+        if name == 'GET_FOCUS':
+            return '%s %s\n' % (self.current.hashcode, self.current.component)
+        if name == 'DUMP':
+            hashcode = argument if argument not in ('', '-1') else None
+            return self.dump(hashcode) + '\nDONE.\n'
+        if name in ('SERVER', 'PROTOCOL'):
+            return '4\n'
+        return ''
+
+    def dumpsys_notification(self, redact=False):
+        lines = ['Current Notification Manager state:', '  Notification List:']
+        for package, ident, title, text in self.notifications:
+            if redact:
+                title = text = None
+            lines += [
+                '    NotificationRecord(0x%08x pkg=%s user=UserHandle{0} '
+                'id=%d tag=null score=0 key=0|%s|%d|null|10001: '
+                'Notification(pri=0 flags=0x10))' % (
+                    zlib.crc32('%s|%d' % (package, ident)) & 0xffffffff,
+                    package, ident, package, ident),
+                '      extras={',
+                '        android.title=%s' % _extra_value(title),
+                '        android.text=%s' % _extra_value(text),
+                '      }']
+        return '\n'.join(lines) + '\n'
+
+    def dumpsys_package(self, package):
+        info = self.packages.get(package)
+        if info is None:
+            return ''
+        return ('Packages:\n  Package [%s] (%08x):\n'
+                '    versionCode=%d targetSdk=%s\n'
+                '    lastUpdateTime=%s\n') % (
+            package, zlib.crc32(package) & 0xffffffff, info['versionCode'],
+            self.properties['build.version.sdk'], info['lastUpdateTime'])
+
+
+def _split_commands(line):
+    """
+    Split a command line on the ';' and '&&' outside of quotes.
+    """
+    commands = []
+    current = []
+    quote = None
+    index = 0
+    while index < len(line):
+        char = line[index]
+        if quote is not None:
+            if char == quote:
+                quote = None
+        elif char in '\'"':
+            quote = char
+        elif char == ';' or line.startswith('&&', index):
+            commands.append(''.join(current))
+            current = []
+            index += 1 if char == ';' else 2
+            continue
+        current.append(char)
+        index += 1
+    commands.append(''.join(current))
+    return [c.strip() for c in commands if c.strip()]
+
+
+class DeviceShell(object):
+
+    """
+    The device shell: a minimal interpreter of the commands run by the
+    pilot (sequences, $?, output redirections and the Android tools it
+    uses), keeping the exit code of the last command.
+    """
+
+    def __init__(self, device):
+        self.device = device
+        self.status = 0
+        self.exited = False
+        # the error messages of the running command
+        self.errors = []
+
+    def run(self, line):
+        """
+        Run a command line and return its output.
+        """
+        line = line.strip()
+        # the command groups of ShellSession: "{ command" ... "} </dev/null"
+        if line.startswith('{'):
+            line = line[1:]
+        if line.startswith('}'):
+            return ''
+        return ''.join(self.execute(c) for c in _split_commands(line))
+
+    def execute(self, command):
+        try:
+            words = shlex.split(command.replace('$?', str(self.status)))
+        except ValueError:
+            self.status = 2
+            return '/system/bin/sh: syntax error\n'
+
+        args = []
+        output_path = None
+        discard = False
+        discard_errors = False
+        words = iter(words)
+        for word in words:
+            if word in ('>/dev/null', '1>/dev/null'):
+                discard = True
+            elif word == '2>/dev/null':
+                discard_errors = True
+            elif word in ('>', '1>'):
+                output_path = next(words, None)
+            elif word.startswith('>'):
+                output_path = word[1:]
+            elif not word.startswith('2>'):
+                args.append(word)
+        if not args:
+            return ''
+
+        self.errors = []
+        handler = getattr(self, '_sh_' + args[0].replace('-', '_'), None)
+        if handler is None:
+            self.errors.append('/system/bin/sh: %s: not found\n' % args[0])
+            output, self.status = '', 127
+        else:
+            output, self.status = handler(args[1:])
+        errors = '' if discard_errors else ''.join(self.errors)
+        if output_path is not None and output_path != '/dev/null':
+            self.device.write_file(output_path, output)
+            return errors
+        # stdout and stderr share the pty
+        return ('' if discard or output_path else output) + errors
+
+    def _sh_exit(self, args):
+        self.exited = True
+        return '', 0
+
+    def _sh_true(self, args):
+        return '', 0
+
+    _sh_export = _sh_stty = _sh_cd = _sh_true
+
+    def _sh_sleep(self, args):
+        time.sleep(float(args[0]) if args else 0)
+        return '', 0
+
+    def _sh_echo(self, args):
+        return ' '.join(args) + '\n', 0
+
+    def _sh_cat(self, args):
+        output = []
+        status = 0
+        for path in args:
+            data = self.device.read_file(path)
+            if data is None:
+                self.errors.append('cat: %s: No such file or directory\n' %
+                                   path)
+                status = 1
+            else:
+                output.append(data)
+        return ''.join(output), status
+
+    def _sh_rm(self, args):
+        for path in args:
+            if not path.startswith('-'):
+                self.device.files.pop(path, None)
+        return '', 0
+
+    def _sh_mkdir(self, args):
+        for path in args:
+            if not path.startswith('-'):
+                self.device.directories.add(path.rstrip('/'))
+        return '', 0
+
+    def _sh_ls(self, args):
+        directory = (args[-1] if args else '/').rstrip('/')
+        names = sorted(set(
+            p[len(directory) + 1:].split('/')[0]
+            for p in list(self.device.files) + list(self.device.directories)
+            if p.startswith(directory + '/')))
+        return ''.join(n + '\n' for n in names), 0
+
+    def _sh_md5sum(self, args):
+        output = []
+        status = 0
+        for path in args:
+            data = self.device.read_file(path)
+            if data is None:
+                self.errors.append('md5sum: %s: No such file or directory\n'
+                                   % path)
+                status = 1
+            else:
+                output.append('%s  %s\n' % (hashlib.md5(data).hexdigest(),
+                                            path))
+        return ''.join(output), status
+
+    def _sh_getprop(self, args):
+        if not args:
+            return ''.join('[%s]: [%s]\n' % (name, self.device.properties[p])
+                           for name, p in sorted(GETPROP_NAMES.items())), 0
+        name = GETPROP_NAMES.get(args[0])
+        return self.device.properties.get(name, '') + '\n', 0
+
+    def _sh_service(self, args):
+        # service call window 1 (start the ViewServer), 2 (stop it)
+        if args[:2] == ['call', 'window'] and len(args) > 2:
+            started = '1' if args[2] == '1' else '0'
+            return "Result: Parcel(00000000 0000000%s   '........')\n" % \
+                started, 0
+        return '', 0
+
+    def _sh_dumpsys(self, args):
+        if args[:1] == ['notification']:
+            # the texts are redacted since API level 26
+            redact = int(self.device.properties['build.version.sdk']) >= 26 \
+                and '--noredact' not in args
+            return self.device.dumpsys_notification(redact), 0
+        if args[:1] == ['package'] and len(args) > 1:
+            return self.device.dumpsys_package(args[1]), 0
+        return '', 0
+
+    def _sh_am(self, args):
+        if args[:1] == ['start'] and '-n' in args:
+            component = args[args.index('-n') + 1]
+            if self.device.start_activity(component):
+                return ('Starting: Intent { cmp=%s }\nStatus: ok\n'
+                        'Activity: %s\nComplete\n') % (component, component), 0
+            return 'Error: Activity class {%s} does not exist.\n' % \
+                component, 1
+        return '', 0
+
+    def _sh_pm(self, args):
+        if args[:1] == ['install'] and len(args) > 1:
+            path = args[-1]
+            if self.device.read_file(path) is None:
+                return 'Failure [INSTALL_FAILED_INVALID_URI]\n', 1
+            self.device.install(os.path.splitext(os.path.basename(path))[0])
+            return 'Success\n', 0
+        if args[:1] == ['uninstall'] and len(args) > 1:
+            if self.device.packages.pop(args[-1], None) is None:
+                return 'Failure\n', 1
+            return 'Success\n', 0
+        if args[:2] == ['list', 'packages']:
+            return ''.join('package:%s\n' % p
+                           for p in self.device.packages), 0
+        return '', 0
+
+    def _sh_input(self, args):
+        if args[:1] == ['tap'] and len(args) == 3:
+            self.device.tap(int(args[1]), int(args[2]))
+        elif args[:1] == ['keyevent'] and len(args) > 1:
+            self.device.press(args[1])
+        elif args[:1] == ['text'] and len(args) > 1:
+            self.device.typed.append(args[1])
+        return '', 0
+
+    def _sh_screencap(self, args):
+        self.device.events['screencap'] += 1
+        frame = self.device.frame()
+        paths = [a for a in args if not a.startswith('-')]
+        if not paths:
+            return frame, 0
+        data = screenshot.Screenshot.from_raw(frame)
+        self.device.write_file(paths[0], data.to_png() if '-p' in args
+                               else frame)
+        return '', 0
+
+    def _sh_logcat(self, args):
+        if '-c' in args:
+            del self.device.log_lines[:]
+            return '', 0
+        output = ''.join(l + '\n' for l in self.device.log_lines)
+        if '-f' in args:
+            self.device.write_file(args[args.index('-f') + 1], output)
+            return '', 0
+        return output, 0
+
+    def _sh_monkey(self, args):
+        # the monkey server is always listening, see Simulator.add_device
+        return '', 0
+
+    def _sh_wm(self, args):
+        return 'Physical size: %dx%d\n' % (self.device.display_width,
+                                           self.device.display_height), 0
+
+
+class _Server(SocketServer.ThreadingTCPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, handler, device=None, simulator=None):
+        SocketServer.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0),
+                                                 handler)
+        self.device = device
+        self.simulator = simulator
+        self.port = self.server_address[1]
+        self.stopping = False
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.serve_forever,
+            name='simulator-%s-%d' % (self.RequestHandlerClass.__name__,
+                                      self.port))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopping = True
+        self.shutdown()
+        self.server_close()
+
+
+class _StreamHandler(SocketServer.BaseRequestHandler):
+
+    def wait_closed(self, poll=None):
+        """
+        Block until the peer closes the connection (or the server stops),
+        calling poll every STREAM_POLL_INTERVAL.
+        """
+        self.request.settimeout(STREAM_POLL_INTERVAL)
+        while not self.server.stopping:
+            if poll is not None:
+                poll()
+            try:
+                if not self.request.recv(1024):
+                    return
+            except socket.timeout:
+                continue
+            except socket.error:
+                return
+
+
+class MonkeyHandler(_StreamHandler):
+
+    def handle(self):
+        device = self.server.device
+        pending = ''
+        while True:
+            try:
+                data = self.request.recv(4096)
+            except socket.error:
+                return
+            if not data:
+                return
+            pending += data
+            lines = pending.split('\n')
+            pending = lines.pop()
+            # the replies of pipelined commands share one link latency
+            replies = []
+            for line in lines:
+                command = line.strip()
+                if command == 'quit':
+                    return
+                if command:
+                    replies.append(device.monkey_command(command) + '\n')
+            if replies:
+                device.link.send(self.request, ''.join(replies))
+
+
+class ViewServerHandler(_StreamHandler):
+
+    def handle(self):
+        device = self.server.device
+        command = self.request.makefile('rb').readline().strip()
+        if command == 'AUTOLIST':
+            self.__autolist(device)
+            return
+        device.link.send(self.request, device.viewserver_command(command))
+
+    def __autolist(self, device):
+        versions = [device.window_list_version]
+
+        def _notify():
+            if device.window_list_version != versions[0]:
+                versions[0] = device.window_list_version
+                self.request.sendall('LIST UPDATE\n')
+
+        self.wait_closed(_notify)
+
+
+class AdbHandler(_StreamHandler):
+
+    def read_exactly(self, size):
+        data = ''
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                raise socket.error('Connection closed')
+            data += chunk
+        return data
+
+    def read_request(self):
+        return self.read_exactly(int(self.read_exactly(4), 16))
+
+    def okay(self, data=None):
+        if data is None:
+            self.request.sendall('OKAY')
+        else:
+            self.request.sendall('OKAY%04x%s' % (len(data), data))
+
+    def fail(self, message):
+        self.request.sendall('FAIL%04x%s' % (len(message), message))
+
+    def handle(self):
+        simulator = self.server.simulator
+        try:
+            request = self.read_request()
+            if request == 'host:version':
+                self.okay('%04x' % ADB_VERSION)
+            elif request in ('host:devices', 'host:devices-l'):
+                self.okay(''.join('%s\tdevice\n' % s
+                                  for s in simulator.devices))
+            elif request.startswith('host-serial:') and \
+                    ':forward:' in request:
+                serial = request[len('host-serial:'):].split(':forward:')[0]
+                if serial not in simulator.devices:
+                    self.fail("device '%s' not found" % serial)
+                    return
+                # the simulated servers already listen on the host
+                self.request.sendall('OKAYOKAY')
+            elif request == 'host:transport-any' or \
+                    request.startswith('host:transport:'):
+                serial = request.partition('host:transport:')[2]
+                device = simulator.devices.get(serial) if serial else \
+                    next(iter(simulator.devices.values()), None)
+                if device is None:
+                    self.fail("device '%s' not found" % serial)
+                    return
+                self.okay()
+                self.service(device, self.read_request())
+            else:
+                self.fail('unknown host service %s' % request)
+        except socket.error:
+            logger.debug("adb connection closed", exc_info=True)
+
+    def service(self, device, service):
+        if service == 'sync:':
+            self.okay()
+            self.sync(device)
+        elif service == 'shell:':
+            self.okay()
+            self.interactive_shell(device)
+        elif service.startswith(('shell:', 'exec:')):
+            command = service.partition(':')[2]
+            self.okay()
+            words = command.split()
+            if words[0] == 'monkey':
+                self.wait_closed()
+            elif words[0] == 'logcat' and '-d' not in words and \
+                    '-c' not in words:
+                self.stream_logcat(device, words)
+            else:
+                device.link.send(self.request, DeviceShell(device).run(
+                    command))
+        else:
+            self.fail('unknown service %s' % service)
+
+    def interactive_shell(self, device):
+        shell = DeviceShell(device)
+        pending = ''
+        while not shell.exited:
+            data = self.request.recv(4096)
+            if not data:
+                return
+            pending += data
+            lines = pending.split('\n')
+            pending = lines.pop()
+            output = ''.join(shell.run(line) for line in lines)
+            if output:
+                device.link.send(self.request, output)
+
+    def stream_logcat(self, device, words):
+        sent = [0]
+        if '-T' in words:
+            count = int(words[words.index('-T') + 1])
+            sent[0] = max(0, len(device.log_lines) - count)
+
+        def _send_new_lines():
+            lines = device.log_lines[sent[0]:]
+            if lines:
+                sent[0] += len(lines)
+                device.link.send(self.request,
+                                 ''.join(l + '\n' for l in lines))
+
+        self.wait_closed(_send_new_lines)
+
+    def sync(self, device):
+        while True:
+            command = self.read_exactly(4)
+            length = struct.unpack('<I', self.read_exactly(4))[0]
+            if command == 'STAT':
+                path = self.read_exactly(length)
+                device.link.wait()
+                self.request.sendall('STAT' + struct.pack(
+                    '<III', *device.stat(path)))
+            elif command == 'SEND':
+                path = self.read_exactly(length).rsplit(',', 1)[0]
+                chunks = []
+                while True:
+                    chunk_id = self.read_exactly(4)
+                    length = struct.unpack('<I', self.read_exactly(4))[0]
+                    if chunk_id == 'DONE':
+                        break
+                    chunks.append(self.read_exactly(length))
+                data = ''.join(chunks)
+                # the upload time is accounted before the reply
+                device.link.wait(len(data))
+                device.write_file(path, data, length)
+                self.request.sendall('OKAY' + struct.pack('<I', 0))
+            elif command == 'RECV':
+                path = self.read_exactly(length)
+                data = device.read_file(path)
+                if data is None:
+                    message = 'No such file or directory'
+                    self.request.sendall('FAIL' + struct.pack(
+                        '<I', len(message)) + message)
+                    continue
+                reply = [''.join(['DATA', struct.pack('<I', len(
+                    data[i:i + SYNC_DATA_MAX])), data[i:i + SYNC_DATA_MAX]])
+                    for i in xrange(0, len(data), SYNC_DATA_MAX)]
+                reply.append('DONE' + struct.pack('<I', 0))
+                device.link.send(self.request, ''.join(reply))
+            else:
+                return
+
+
+class Simulator(object):
+
+    """
+    Serves simulated devices on local ports. AndroPilot runs unmodified
+    against them: pilot_options() gives the constructor arguments of a
+    device and, while the simulator is started, the adb executable in the
+    PATH is the fake one (see main) talking to the simulated adb server.
+    """
+
+    def __init__(self):
+        self.devices = collections.OrderedDict()
+        self.servers = {}
+        self.adb_server = None
+        self.bin_dir = None
+        self.saved_environ = {}
+
+    @property
+    def adb_port(self):
+        return self.adb_server.port if self.adb_server else None
+
+    def add_device(self, device):
+        if device.serial in self.devices:
+            raise SimulatorException('Device %s already simulated' %
+                                     device.serial)
+        monkey = _Server(MonkeyHandler, device)
+        viewserver = _Server(ViewServerHandler, device)
+        monkey.start()
+        viewserver.start()
+        self.servers[device.serial] = (monkey, viewserver)
+        self.devices[device.serial] = device
+        return device
+
+    def start(self):
+        self.adb_server = _Server(AdbHandler, simulator=self)
+        self.adb_server.start()
+        self.bin_dir = write_adb_executable(tempfile.mkdtemp(
+            prefix='andropilot-simulator-'))
+        for name, value in (
+                ('PATH', self.bin_dir + os.pathsep +
+                 os.environ.get('PATH', '')),
+                ('ANDROID_ADB_SERVER_PORT', str(self.adb_server.port))):
+            self.saved_environ[name] = os.environ.get(name)
+            os.environ[name] = value
+        logger.info("Simulated adb server on port %d", self.adb_server.port)
+
+    def stop(self):
+        for name, value in self.saved_environ.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        self.saved_environ = {}
+        for monkey, viewserver in self.servers.values():
+            monkey.stop()
+            viewserver.stop()
+        self.servers = {}
+        if self.adb_server is not None:
+            self.adb_server.stop()
+            self.adb_server = None
+        if self.bin_dir is not None:
+            shutil.rmtree(self.bin_dir, ignore_errors=True)
+            self.bin_dir = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+    def pilot_options(self, serial):
+        monkey, viewserver = self.servers[serial]
+        return {'device_name': serial, 'device_address': '127.0.0.1',
+                'view_server_port': viewserver.port,
+                'monkey_server_port': monkey.port}
+
+    def create_pilot(self, serial, **options):
+        """
+        Return an AndroPilot (not opened yet) for a simulated device, with
+        no on-disk profile cache unless profile_cache_path is given.
+        """
+        # imported here: the fake adb executable does not need the pilot
+        from pilot import AndroPilot
+        arguments = self.pilot_options(serial)
+        arguments.setdefault('profile_cache_path', None)
+        arguments.update(options)
+        pilot = AndroPilot(**arguments)
+        if pilot.adb_client is not None:
+            pilot.adb_client = adb_client.AdbClient(port=self.adb_port)
+        return pilot
+
+
+def sample_screens():
+    """
+    Return the screens of a small app: a main screen with a list and two
+    buttons opening a details and a settings screen.
+    """
+    root = (0, 0, 480, 775)
+    main = [view_line(0, 'android.widget.FrameLayout', 'id/content', '',
+                      root),
+            view_line(1, 'android.widget.TextView', 'id/title', 'Welcome',
+                      (20, 20, 460, 80)),
+            view_line(1, 'android.widget.Button', 'id/details', 'Details',
+                      (40, 100, 440, 170), clickable=True),
+            view_line(1, 'android.widget.Button', 'id/settings', 'Settings',
+                      (40, 190, 440, 260), clickable=True),
+            view_line(1, 'android.widget.ListView', 'id/list', '',
+                      (0, 280, 480, 775))]
+    for index in range(10):
+        main.append(view_line(
+            2, 'android.widget.TextView', 'id/item', 'Item %d' % index,
+            (0, index * 48, 480, index * 48 + 48), clickable=True))
+    details = [view_line(0, 'android.widget.FrameLayout', 'id/content', '',
+                         root),
+               view_line(1, 'android.widget.TextView', 'id/title',
+                         'Details', (20, 20, 460, 80)),
+               view_line(1, 'android.widget.TextView', 'id/status',
+                         'Download complete', (20, 100, 460, 160)),
+               view_line(1, 'android.widget.Button', 'id/back_button',
+                         'Back', (40, 200, 440, 270), clickable=True)]
+    settings = [view_line(0, 'android.widget.FrameLayout', 'id/content', '',
+                          root),
+                view_line(1, 'android.widget.TextView', 'id/title',
+                          'Settings', (20, 20, 460, 80)),
+                view_line(1, 'android.widget.CheckBox', 'id/sync',
+                          'Sync data', (20, 100, 460, 160), clickable=True)]
+    return [
+        Screen('main', 'com.example.app/com.example.app.MainActivity',
+               '\n'.join(main),
+               {'id/details': 'details', 'id/settings': 'settings'}),
+        Screen('details', 'com.example.app/com.example.app.DetailsActivity',
+               '\n'.join(details),
+               {'id/back_button': 'main', BACK_KEY: 'main'}),
+        Screen('settings', 'com.example.app/com.example.app.SettingsActivity',
+               '\n'.join(settings), {BACK_KEY: 'main'})]
+
+
+def sample_device(serial=DEFAULT_SERIAL, **options):
+    return SimulatedDevice(serial, sample_screens(), **options)
+
+
+def write_adb_executable(directory):
+    """
+    Write in directory an adb executable running this module, return the
+    directory.
+    """
+    path = os.path.join(directory, 'adb')
+    module = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+    with open(path, 'w') as f:
+        f.write('#!/bin/sh\nexec %s %s "$@"\n' % (
+            pipes.quote(sys.executable), pipes.quote(module)))
+    os.chmod(path, 0o755)
+    return directory
+
+
+def _copy_to_stdout(connection):
+    while True:
+        data = connection.socket.recv(SYNC_DATA_MAX)
+        if not data:
+            return
+        os.write(sys.stdout.fileno(), data)
+
+
+def _interactive_shell(connection):
+    def _forward_stdin():
+        try:
+            for data in iter(lambda: os.read(sys.stdin.fileno(), 4096), ''):
+                connection.socket.sendall(data)
+            connection.socket.shutdown(socket.SHUT_WR)
+        except (OSError, socket.error):
+            pass
+
+    forwarder = threading.Thread(target=_forward_stdin)
+    forwarder.daemon = True
+    forwarder.start()
+    _copy_to_stdout(connection)
+
+
+def main(argv):
+    """
+    The fake adb executable: the subset of the adb command line used by
+    AndroPilot, executed by the simulated adb server.
+    """
+    serial = os.environ.get('ANDROID_SERIAL')
+    port = int(os.environ.get('ANDROID_ADB_SERVER_PORT',
+                              adb_client.DEFAULT_PORT))
+    argv = list(argv)
+    while argv and argv[0].startswith('-'):
+        option = argv.pop(0)
+        if option == '-s' and argv:
+            serial = argv.pop(0)
+        elif option == '-P' and argv:
+            port = int(argv.pop(0))
+    if not argv:
+        sys.stderr.write('usage: adb [-s serial] command [args]\n')
+        return 1
+
+    client = adb_client.AdbClient(port=port)
+    command, params = argv[0], argv[1:]
+    try:
+        if command == 'devices':
+            sys.stdout.write('List of devices attached\n' + ''.join(
+                '%s\t%s\n' % d for d in client.devices()) + '\n')
+            return 0
+        if command == 'version':
+            sys.stdout.write('Android Debug Bridge version 1.0.%d\n' %
+                             client.version())
+            return 0
+        if command in ('start-server', 'wait-for-device'):
+            return 0
+        if serial is None:
+            serial = client.devices()[0][0]
+
+        if command == 'shell' and not params:
+            _interactive_shell(client.open_service(serial, 'shell:'))
+            return 0
+        if command in ('shell', 'exec-out', 'logcat'):
+            if command == 'logcat':
+                params = ['logcat'] + params
+            service = 'exec:' if command == 'exec-out' else 'shell:'
+            _copy_to_stdout(client.open_service(
+                serial, service + ' '.join(params)))
+            return 0
+
+        result = client.run(serial, argv)
+        if result is None:
+            sys.stderr.write('adb: unknown command %s\n' % command)
+            return 1
+        code, output = result
+        (sys.stdout if code == 0 else sys.stderr).write(output)
+        return code
+    except (adb_client.AdbError, socket.error, IndexError) as e:
+        sys.stderr.write('error: %s\n' % e)
+        return 1
+    finally:
+        client.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,8 +1,44 @@
+import collections
+import hashlib
+import json
 import logging
+import os
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
 import time
 import unittest
+import zlib
 
+from andrototal.andropilot import adb_client
+from andrototal.andropilot import async_pilot
+from andrototal.andropilot import device_profile
+from andrototal.andropilot import dumpsys_notification
+from andrototal.andropilot import explorer
+from andrototal.andropilot import farm
+from andrototal.andropilot import file_sync
+from andrototal.andropilot import hooks
+from andrototal.andropilot import install
+from andrototal.andropilot import loadtest
+from andrototal.andropilot import logcat
+from andrototal.andropilot import logcat_store
+from andrototal.andropilot import metrics
+from andrototal.andropilot import notification
 from andrototal.andropilot import pilot
+from andrototal.andropilot import recorder
+from andrototal.andropilot import refresher
+from andrototal.andropilot import screen_diff
+from andrototal.andropilot import screenshot
+from andrototal.andropilot import shell_session
+from andrototal.andropilot import simulator
+from andrototal.andropilot import tracing
+from andrototal.andropilot import wait
+from andrototal.andropilot.controllers import monkey_controller
+from andrototal.andropilot.controllers import viewserver_parser
 
 
 class TestAndroPilot(unittest.TestCase):
@@ -49,5 +85,1934 @@ class TestAndroPilot(unittest.TestCase):
             print v
 
 
+class FakeAdbServer(threading.Thread):
+
+    """
+    Minimal adb server: a single device whose shell echoes the commands and
+    whose file system is a dictionary.
+    """
+
+    def __init__(self, serial='emulator-5554'):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.serial = serial
+        self.files = {}
+        self.forwards = []
+        self.server = socket.socket()
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(5)
+        self.port = self.server.getsockname()[1]
+
+    def run(self):
+        while True:
+            conn, _ = self.server.accept()
+            threading.Thread(target=self.handle, args=(conn,)).start()
+
+    def _read(self, conn, size):
+        data = ''
+        while len(data) < size:
+            data += conn.recv(size - len(data))
+        return data
+
+    def _request(self, conn):
+        return self._read(conn, int(self._read(conn, 4), 16))
+
+    def handle(self, conn):
+        request = self._request(conn)
+        if request == 'host:version':
+            conn.sendall('OKAY0004001f')
+        elif request.startswith('host-serial:'):
+            self.forwards.append(request.split(':forward:')[1])
+            conn.sendall('OKAYOKAY')
+        elif request == 'host:transport:' + self.serial:
+            conn.sendall('OKAY')
+            service = self._request(conn)
+            conn.sendall('OKAY')
+            if service.startswith('shell:'):
+                conn.sendall(service[len('shell:'):] + '\n')
+            elif service == 'sync:':
+                self.handle_sync(conn)
+        else:
+            conn.sendall('FAIL%04x%s' % (len('device not found'),
+                                         'device not found'))
+        conn.close()
+
+    def handle_sync(self, conn):
+        while True:
+            command = self._read(conn, 4)
+            length = struct.unpack('<I', self._read(conn, 4))[0]
+            data = self._read(conn, length)
+            if command == 'SEND':
+                path = data.split(',')[0]
+                content = ''
+                while True:
+                    chunk_id = self._read(conn, 4)
+                    length = struct.unpack('<I', self._read(conn, 4))[0]
+                    if chunk_id == 'DONE':
+                        break
+                    content += self._read(conn, length)
+                self.files[path] = content
+                conn.sendall('OKAY' + struct.pack('<I', 0))
+            elif command == 'RECV':
+                conn.sendall('DATA' + struct.pack('<I', len(self.files[data])) +
+                             self.files[data] + 'DONE' + struct.pack('<I', 0))
+            elif command == 'STAT':
+                mode = 0o40755 if data.endswith('sdcard') else 0
+                conn.sendall('STAT' + struct.pack('<III', mode, 0, 0))
+            else:
+                return
+
+
+class TestAdbClient(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeAdbServer()
+        self.server.start()
+        self.client = adb_client.AdbClient(port=self.server.port)
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.client.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_version(self):
+        self.assertEqual(self.client.version(), 31)
+
+    def test_shell(self):
+        output = self.client.shell('emulator-5554', ['echo', 'hello'])
+        self.assertEqual(output, 'echo hello\n')
+
+    def test_unknown_device(self):
+        self.assertRaises(adb_client.AdbError,
+                          self.client.shell, 'emulator-5556', 'ls')
+
+    def test_push_pull(self):
+        src = os.path.join(self.tmp_dir, 'fixture.bin')
+        with open(src, 'wb') as f:
+            f.write('x' * 100000)
+        self.client.push('emulator-5554', src, '/sdcard')
+        self.assertEqual(len(self.server.files['/sdcard/fixture.bin']),
+                         100000)
+
+        dst = os.path.join(self.tmp_dir, 'pulled.bin')
+        self.client.pull('emulator-5554', '/sdcard/fixture.bin', dst)
+        with open(dst, 'rb') as f:
+            self.assertEqual(f.read(), 'x' * 100000)
+        # both transfers used the same pooled sync connection
+        self.assertEqual(len(self.client.sync_pool['emulator-5554']), 1)
+
+    def test_adb_command(self):
+        p = pilot.AndroPilot(profile_cache_path=None, use_adb_client=True)
+        p.adb_client = self.client
+        self.assertEqual(p.adb_command(['forward', 'tcp:1', 'tcp:2']), 0)
+        self.assertEqual(self.server.forwards, ['tcp:1;tcp:2'])
+        self.assertEqual(
+            p.adb_command(['shell', 'am', 'start'], need_result=True),
+            'am start\n')
+
+
+def _raw_frame(width, height, pixel_format, pixels, color_space=False):
+    return struct.pack('<III', width, height, pixel_format) + \
+        ('\x00' * 4 if color_space else '') + pixels
+
+
+def _decode_png(data):
+    """
+    Return the IHDR fields and the decompressed IDAT of a PNG.
+    """
+    offset = 8
+    chunks = {}
+    while offset < len(data):
+        length, chunk_type = struct.unpack_from('>I4s', data, offset)
+        chunks[chunk_type] = data[offset + 8:offset + 8 + length]
+        offset += 12 + length
+    return (struct.unpack('>IIBBBBB', chunks['IHDR']),
+            zlib.decompress(chunks['IDAT']))
+
+
+class FakeScreencapConnection(object):
+
+    """
+    An adb connection streaming a raw frame over a socket pair.
+    """
+
+    def __init__(self, data):
+        self.socket, peer = socket.socketpair()
+        peer.sendall(data)
+        peer.close()
+        self.closed = False
+
+    def read_exactly(self, size):
+        data = ''
+        while len(data) < size:
+            data += self.socket.recv(size - len(data))
+        return data
+
+    def close(self):
+        self.socket.close()
+        self.closed = True
+
+
+class FakeScreencapPilot(object):
+
+    device_name = 'emulator-5554'
+
+    def __init__(self, frame, use_adb_client):
+        self.frame = frame
+        self.adb_client = self if use_adb_client else None
+        self.commands = []
+        self.connections = []
+        self.probes = []
+
+    def probe(self, name, category='pilot', labels=None, **args):
+        self.probes.append(name)
+        return tracing.NULL_PROBE
+
+    def adb_command(self, cmd, need_result=False):
+        self.commands.append(cmd)
+        return self.frame
+
+    def open_service(self, serial, service):
+        self.commands.append(service)
+        self.connections.append(FakeScreencapConnection(self.frame))
+        return self.connections[-1]
+
+
+class TestScreenshot(unittest.TestCase):
+
+    # 2x1 RGBA: a red and a blue pixel
+    PIXELS = '\xff\x00\x00\xff\x00\x00\xff\xff'
+
+    def test_from_raw(self):
+        for color_space in (False, True):
+            frame = screenshot.Screenshot.from_raw(_raw_frame(
+                2, 1, screenshot.PIXEL_FORMAT_RGBA_8888, self.PIXELS,
+                color_space))
+            self.assertEqual((frame.width, frame.height), (2, 1))
+            self.assertEqual(frame.offset, 16 if color_space else 12)
+            self.assertEqual(frame.pixels.tobytes(), self.PIXELS)
+
+    def test_truncated(self):
+        self.assertRaises(screenshot.ScreenshotException,
+                          screenshot.Screenshot.from_raw, '\x02\x00')
+        self.assertRaises(screenshot.ScreenshotException,
+                          screenshot.Screenshot.from_raw, _raw_frame(
+                              2, 1, screenshot.PIXEL_FORMAT_RGBA_8888,
+                              self.PIXELS[:-3]))
+
+    def test_to_png(self):
+        frame = screenshot.Screenshot.from_raw(_raw_frame(
+            2, 1, screenshot.PIXEL_FORMAT_RGBA_8888, self.PIXELS))
+        header, rows = _decode_png(frame.to_png())
+        self.assertEqual(header, (2, 1, 8, 6, 0, 0, 0))
+        self.assertEqual(rows, '\x00' + self.PIXELS)
+
+    @unittest.skipIf(screenshot.numpy is None, 'NumPy not installed')
+    def test_rgb_565(self):
+        # white, red and green
+        frame = screenshot.Screenshot.from_raw(_raw_frame(
+            3, 1, screenshot.PIXEL_FORMAT_RGB_565,
+            struct.pack('<HHH', 0xffff, 0xf800, 0x07e0)))
+        self.assertEqual(frame.to_array().tolist(),
+                         [[[255, 255, 255], [255, 0, 0], [0, 255, 0]]])
+        header, rows = _decode_png(frame.to_png())
+        self.assertEqual(header[3], 2)
+        self.assertEqual(rows, '\x00\xff\xff\xff\xff\x00\x00\x00\xff\x00')
+
+    def test_capture(self):
+        data = _raw_frame(2, 1, screenshot.PIXEL_FORMAT_RGBA_8888,
+                          self.PIXELS, color_space=True)
+        # the adb executable through pilot.adb_command
+        device = FakeScreencapPilot(data, use_adb_client=False)
+        frame = screenshot.capture(device)
+        self.assertEqual(frame.pixels.tobytes(), self.PIXELS)
+        self.assertEqual(device.commands,
+                         [['exec-out', screenshot.SCREENCAP_CMD]])
+
+        # the in-process client straight into the frame buffer
+        device = FakeScreencapPilot(data, use_adb_client=True)
+        frame = screenshot.capture(device)
+        self.assertEqual(frame.pixels.tobytes(), self.PIXELS)
+        self.assertEqual(device.commands,
+                         ['exec:%s' % screenshot.SCREENCAP_CMD])
+        self.assertTrue(device.connections[0].closed)
+        self.assertEqual(device.probes, ['adb_command'])
+
+    def test_capture_through_pilot(self):
+        device = simulator.sample_device(latency=0.001)
+        calls = {}
+        with simulator.Simulator() as sim:
+            sim.add_device(device)
+            for use_adb_client in (False, True):
+                session = sim.create_pilot(device.serial,
+                                           use_adb_client=use_adb_client)
+                session.add_hook(hooks.Hook(
+                    after=lambda probe: calls.setdefault(
+                        use_adb_client, []).append(probe.name),
+                    names=['*adb_command']))
+                self.assertEqual(screenshot.capture(session).width, 480)
+                session.close()
+        # one adb_command probe for each capture, through pilot.adb_command
+        # or around the in-process client
+        self.assertEqual(calls, {False: ['adb_command'],
+                                 True: ['adb_command']})
+
+
+# an adb executable streaming the lines of a log file as 'adb logcat'
+FAKE_LOGCAT_ADB = """#!/bin/sh
+echo "$@" > %(directory)s/args
+case " $* " in
+    *" -T "*) exec tail -n 1 -f %(directory)s/log ;;
+esac
+exec tail -n +1 -f %(directory)s/log
+"""
+
+
+class FakeDevicePilot(object):
+
+    def __init__(self, device_name, device_api_level):
+        self.device_name = device_name
+        self.device_api_level = device_api_level
+
+
+class TestLogcatReader(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        adb = os.path.join(self.directory, 'adb')
+        with open(adb, 'w') as f:
+            f.write(FAKE_LOGCAT_ADB % {'directory': self.directory})
+        os.chmod(adb, 0755)
+        self.path = os.environ['PATH']
+        os.environ['PATH'] = self.directory + os.pathsep + self.path
+        self.log('I/Example( 1234): started',
+                 'E/Example( 1234): crashed',
+                 '  at com.example.Main')
+        self.reader = None
+
+    def tearDown(self):
+        if self.reader is not None:
+            self.reader.stop()
+        os.environ['PATH'] = self.path
+        shutil.rmtree(self.directory)
+
+    def log(self, *lines):
+        with open(os.path.join(self.directory, 'log'), 'a') as f:
+            f.write(''.join(line + '\n' for line in lines))
+
+    def start_reader(self, api_level):
+        self.reader = logcat.LogcatReader(
+            FakeDevicePilot('emulator-5554', api_level))
+        self.reader.start()
+        return self.reader
+
+    def adb_args(self):
+        with open(os.path.join(self.directory, 'args')) as f:
+            return f.read().split()
+
+    def test_parse_brief_line(self):
+        self.assertEqual(
+            logcat.parse_brief_line('W/Activity Manager(  61): slow: 5 ms'),
+            ('W', 'Activity Manager', 61, 'slow: 5 ms'))
+        self.assertEqual(logcat.parse_brief_line('D/Tag(1234):'),
+                         ('D', 'Tag', 1234, ''))
+        self.assertIsNone(logcat.parse_brief_line('  at com.example.Main'))
+
+    def test_backlog(self):
+        reader = self.start_reader(16)
+        self.assertNotIn('-T', self.adb_args())
+        # the whole device buffer is replayed, the continuation line with
+        # the level, tag and pid of its message
+        self.assertEqual(reader.backlog_sequence, 3)
+        self.assertEqual(
+            [(r.level, r.tag, r.message) for r in reader.get_records()],
+            [('I', 'Example', 'started'), ('E', 'Example', 'crashed'),
+             ('E', 'Example', '  at com.example.Main')])
+
+        # by default the replayed records are not matched
+        self.assertIsNone(reader.wait_for_log('started', 0.2))
+        self.assertEqual(reader.wait_for_log('started', 0.2, since=0).sequence,
+                         1)
+        mark = reader.mark()
+        self.log('I/Example( 1234): started again')
+        record = reader.wait_for_log('^started', 5, since=mark)
+        self.assertEqual(record.message, 'started again')
+        self.assertEqual(record.sequence, mark + 1)
+
+    def test_tail(self):
+        self.log('I/Example( 1234): resumed')
+        # only the last record is replayed with 'logcat -T 1'
+        reader = self.start_reader(19)
+        self.assertEqual(self.adb_args()[:6],
+                         ['-s', 'emulator-5554', 'logcat', '-v', 'brief',
+                          '-T'])
+        self.assertEqual([r.message for r in reader.get_records()],
+                         ['resumed'])
+
+    def test_export(self):
+        reader = self.start_reader(16)
+        filename = os.path.join(self.directory, 'logcat.txt')
+        self.assertEqual(reader.export(filename), 3)
+        self.assertEqual(reader.export(filename), 0)
+        mark = reader.mark()
+        self.log('W/Example( 1234): low memory')
+        reader.wait_for_log('low memory', 5, since=mark)
+        self.assertEqual(reader.export(filename), 1)
+        with open(filename) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(lines[0], 'I/Example( 1234): started')
+        self.assertEqual(lines[-1], 'W/Example( 1234): low memory')
+        self.assertEqual(len(lines), 4)
+
+    def test_store_attach(self):
+        reader = self.start_reader(16)
+        store = logcat_store.LogcatStore()
+        store.attach(reader)
+        start = time.time()
+        mark = reader.mark()
+        self.log('W/Example( 1234): low memory')
+        reader.wait_for_log('low memory', 5, since=mark)
+        end = time.time()
+        # the records carry the wall-clock time of their reception
+        rows = store.find_rows(start=start, end=end)
+        self.assertEqual([store.get(row).message for row in rows],
+                         ['low memory'])
+        self.assertEqual(store.find_rows(end=start), [])
+class FakeInstallPilot(object):
+
+    """
+    Records the installs and answers the shell queries of InstallManager.
+    """
+
+    def __init__(self, device_name):
+        self.device_name = device_name
+        self.installs = 0
+        self.marker = ''
+        self.update_time = None
+
+    def install_package(self, apk_path):
+        self.installs += 1
+        self.update_time = '2026-10-19 12:00:%02d' % self.installs
+
+    def shell(self, cmd):
+        if cmd.startswith('mkdir'):
+            self.marker = cmd.split("'")[1]
+            return '', 0
+        output = self.marker + '\n' + install.MARKER_SEPARATOR + '\n'
+        if self.update_time is not None:
+            output += ('Packages:\n  Package [com.example] (4242):\n'
+                       '    versionCode=3 targetSdk=19\n'
+                       '    lastUpdateTime=%s\n' % self.update_time)
+        return output, 0
+
+
+class TestInstallManager(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.apk = tempfile.mkstemp(suffix='.apk')
+        os.write(fd, 'not really an apk')
+        os.close(fd)
+        self.manager = install.InstallManager()
+
+    def tearDown(self):
+        os.remove(self.apk)
+
+    def test_skip_unchanged(self):
+        device = FakeInstallPilot('emulator-5554')
+        self.assertTrue(self.manager.install(device, self.apk, 'com.example'))
+        self.assertFalse(self.manager.install(device, self.apk,
+                                              'com.example'))
+        self.assertEqual(device.installs, 1)
+
+        # installed by someone else in the meantime
+        device.install_package(self.apk)
+        self.assertTrue(self.manager.install(device, self.apk, 'com.example'))
+        self.assertEqual(device.installs, 3)
+
+    def test_install_on_devices(self):
+        devices = [FakeInstallPilot('emulator-%d' % port)
+                   for port in range(5554, 5564, 2)]
+        results = self.manager.install_on_devices(devices, self.apk,
+                                                  'com.example', 2)
+        self.assertEqual(set(results.values()), set([True]))
+        results = self.manager.install_on_devices(devices, self.apk,
+                                                  'com.example', 2)
+        self.assertEqual(set(results.values()), set([False]))
+
+
+def _node(depth, class_name, ident, text, rect=None):
+    node = viewserver_parser.VSNode()
+    node.mDepth = depth
+    node.mClassName = class_name
+    node.mId = ident
+    node.mText = text
+    node.isShown = True
+    node.isClickable = rect is not None
+    node.mParentNode = None
+    node.mLeft, node.mTop, node.mRight, node.mBottom = rect or (0, 0, 0, 0)
+    return node
+
+
+class FakeApp(object):
+
+    """
+    A pilot driving an app whose screens are {name: [(button, screen)]},
+    back returns to the previous screen.
+    """
+
+    statusbar_height = 50
+
+    def __init__(self, screens):
+        self.screens = screens
+        self.stack = ['main']
+        self.clock = 0
+        self.taps = 0
+        self.viewserver_controller = self
+
+    def refresh(self):
+        # a clock, its text changes at every refresh
+        self.clock += 1
+        self.tree_nodes_list = [
+            _node(0, 'FrameLayout', 'id/content', ''),
+            _node(1, 'TextView', 'id/clock', '12:%02d' % self.clock)]
+        for index, (button, _) in enumerate(self.screens[self.stack[-1]]):
+            self.tree_nodes_list.append(_node(
+                1, 'Button', 'id/' + button, button,
+                (0, index * 100, 200, index * 100 + 80)))
+
+    def get_focus_activity(self):
+        return self.stack[-1]
+
+    def tap_on_coordinates(self, x, y):
+        self.taps += 1
+        buttons = self.screens[self.stack[-1]]
+        index = (y - self.statusbar_height) // 100
+        self.stack.append(buttons[index][1])
+
+    def press_back(self):
+        if len(self.stack) > 1:
+            self.stack.pop()
+
+    def wait_for_idle(self, quiet_period, timeout):
+        return True
+
+
+class TestExplorer(unittest.TestCase):
+
+    def test_explore(self):
+        app = FakeApp({'main': [('list', 'list'), ('settings', 'settings')],
+                       'list': [('item', 'detail')],
+                       'detail': [],
+                       'settings': [('about', 'about'), ('back', 'main')],
+                       'about': []})
+        ui_explorer = explorer.Explorer(app, time_budget=10)
+        stats = ui_explorer.explore()
+        self.assertEqual(stats['states'], 5)
+        # each button is tapped once
+        self.assertEqual(app.taps, 5)
+        self.assertEqual(
+            set(s.activity for s in ui_explorer.states.values()),
+            set(['main', 'list', 'detail', 'settings', 'about']))
+
+    def test_fingerprint(self):
+        nodes = [_node(0, 'Button', 'id/ok', 'Retry in 5s', (0, 0, 10, 10)),
+                 _node(0, 'TextView', 'id/title', 'Item 1')]
+        same = [_node(0, 'Button', 'id/ok', 'Retry in 4s', (0, 0, 10, 10)),
+                _node(0, 'TextView', 'id/title', 'Item 2')]
+        other = [_node(0, 'Button', 'id/ok', 'Cancel', (0, 0, 10, 10))]
+        self.assertEqual(explorer.state_fingerprint('Main', nodes),
+                         explorer.state_fingerprint('Main', same))
+        self.assertNotEqual(explorer.state_fingerprint('Main', nodes),
+                            explorer.state_fingerprint('Main', other))
+
+
+class FakeStatusBar(object):
+
+    """
+    The pilot and ViewServer controller of a device with API level 16.
+    """
+
+    device_api_level = 16
+
+    def __init__(self):
+        self.viewserver_controller = self
+        self.notifications = []
+        self.window_list_version = 0
+        self.lists = 0
+        self.dumps = 0
+
+    def get_window_list_version(self):
+        return self.window_list_version
+
+    def get_activity_list(self):
+        self.lists += 1
+        return [{'hashcode': '41a0', 'classname': 'Launcher'},
+                {'hashcode': '42b0', 'classname': 'StatusBar'}]
+
+    def dump_view_by_hashcode(self, hashcode):
+        self.dumps += 1
+        lines = [_view(0, 'android.widget.FrameLayout', '1', 'id/panel', '')]
+        for index, (title, text) in enumerate(self.notifications):
+            lines += [
+                _view(1, 'android.widget.FrameLayout', '2%d' % index,
+                      'id/status_bar_latest_event_content', ''),
+                _view(2, 'android.widget.TextView', '3%d' % index,
+                      'id/title', title),
+                _view(2, 'android.widget.TextView', '4%d' % index,
+                      'id/text', text)]
+        return '\n'.join(lines + ['DONE.'])
+
+    def build_tree(self, data):
+        return viewserver_parser.build_tree(data)
+
+
+class TestNotificationManager(unittest.TestCase):
+
+    def test_refresh(self):
+        device = FakeStatusBar()
+        manager = notification.NotificationManager(device)
+        device.notifications = [('Mail', '2 new messages')]
+        self.assertTrue(manager.refresh())
+        self.assertEqual(
+            [(n['title'], n['message']) for n in manager.added_items],
+            [('Mail', '2 new messages')])
+        self.assertEqual(len(manager.get_notifications_by_title(
+            'Mail', partial_matching=False)), 1)
+
+        # same dump: nothing parsed, nothing changed
+        self.assertFalse(manager.refresh())
+        device.notifications.append(('Update', 'Download complete'))
+        self.assertTrue(manager.refresh())
+        self.assertEqual([n['title'] for n in manager.added_items],
+                         ['Update'])
+        self.assertEqual(manager.removed_items, [])
+        self.assertEqual(len(manager.get_notifications_by_message(
+            'complete')), 1)
+        self.assertEqual((device.lists, device.dumps), (1, 3))
+
+        # the window list changed: the status bar is looked up again
+        device.window_list_version += 1
+        device.notifications.pop(0)
+        self.assertTrue(manager.refresh())
+        self.assertEqual([n['title'] for n in manager.removed_items],
+                         ['Mail'])
+        self.assertEqual(device.lists, 2)
+
+
+class FakeSettlingViewServer(object):
+
+    """
+    A view tree that changes on each of the first changes dumps, then
+    stays the same (or keeps changing if changes is None), in windows that
+    change on each of the first window_changes polls.
+    """
+
+    def __init__(self, changes, window_changes=0):
+        self.changes = changes
+        self.window_changes = window_changes
+        self.dumps = []
+        self.window_polls = 0
+        self.drags = []
+
+    def get_window_fingerprint(self, include_windows=True):
+        self.window_polls += 1
+        return min(self.window_polls, self.window_changes + 1)
+
+    def get_tree_fingerprint(self):
+        count = len(self.dumps)
+        if self.changes is not None:
+            count = min(count, self.changes)
+        self.dumps.append(wait.monotonic())
+        return count
+
+    def drag(self, *args):
+        self.drags.append(args)
+
+
+class TestWaitForIdle(unittest.TestCase):
+
+    def setUp(self):
+        self.session = pilot.AndroPilot(profile_cache_path=None)
+
+    def test_settles(self):
+        viewserver = FakeSettlingViewServer(3)
+        self.session.viewserver_controller = viewserver
+        self.assertTrue(self.session.wait_for_idle(quiet_period=0.1,
+                                                   timeout=5))
+        self.assertTrue(self.session.last_wait)
+        # idle once quiet_period elapsed after the last change, the tree
+        # dumped only at the end of each quiet period
+        self.assertEqual(len(viewserver.dumps), 5)
+        self.assertGreaterEqual(viewserver.dumps[-1] - viewserver.dumps[3],
+                                0.1)
+        self.assertGreater(viewserver.window_polls, len(viewserver.dumps))
+
+    def test_window_changes(self):
+        viewserver = FakeSettlingViewServer(0, window_changes=3)
+        self.session.viewserver_controller = viewserver
+        self.assertTrue(self.session.wait_for_idle(quiet_period=0.1,
+                                                   timeout=5))
+        # dumped on every window change, then once to confirm
+        self.assertEqual(len(viewserver.dumps), 5)
+
+    def test_never_idle(self):
+        self.session.viewserver_controller = FakeSettlingViewServer(None)
+        self.assertFalse(self.session.wait_for_idle(quiet_period=0.1,
+                                                    timeout=0.3))
+        self.assertEqual(self.session.last_wait.name, 'idle')
+
+    def test_open_notification_bar(self):
+        viewserver = FakeSettlingViewServer(2)
+        self.session.viewserver_controller = viewserver
+        self.session.monkey_controller = viewserver
+        self.session.display_width, self.session.display_height = 480, 800
+        manager = notification.NotificationManager(self.session)
+        self.assertTrue(manager.open_notification_bar())
+        self.assertEqual(viewserver.drags, [(240, 0, 240, 600, 0.5, 3)])
+        self.assertTrue(self.session.last_wait)
+        self.assertEqual(len(viewserver.dumps), 4)
+
+
+DUMPSYS_NOTIFICATION = '''\
+Current Notification Manager state:
+  Notification List:
+    NotificationRecord(0x41d3 pkg=com.example.mail user=UserHandle{0} id=1 tag=null score=0 key=0|com.example.mail|1|null|10052: Notification(pri=0 contentView=null vibrate=null sound=null defaults=0x0 flags=0x10 color=0x00000000 vis=PRIVATE))
+      uid=10052 userId=0
+      tickerText=null
+      extras={
+        android.title=String (Mail)
+        android.text=String (2 new messages)
+        android.showWhen=Boolean (true)
+      }
+%s
+  mArchive=Archive (0 notifications)
+    NotificationRecord(0x4000 pkg=com.example.old user=UserHandle{0} id=7 tag=null key=0|com.example.old|7|null|10060: Notification(flags=0x0))
+      extras={
+        android.title=String (Archived)
+      }
+'''
+
+DUMPSYS_DOWNLOAD = '''\
+    NotificationRecord(0x42e8 pkg=com.example.store user=UserHandle{0} id=3 tag=dl key=0|com.example.store|3|dl|10070: Notification(pri=0 flags=0x62))
+      extras={
+        android.title=String (Update)
+        android.text=String (Download complete)
+      }'''
+
+
+class FakeDumpsysPilot(object):
+
+    def __init__(self, device_api_level=19):
+        self.device_api_level = device_api_level
+        self.outputs = []
+        self.commands = []
+        self.last_wait = None
+        self.probe = None
+
+    def shell(self, cmd):
+        self.commands.append(cmd)
+        return self.outputs.pop(0) if len(self.outputs) > 1 \
+            else self.outputs[0], 0
+
+
+class FakeAsyncDevice(object):
+
+    """
+    A pilot whose text shows up after a few refreshes.
+    """
+
+    def __init__(self, name, refreshes_needed):
+        self.device_name = name
+        self.refreshes_needed = refreshes_needed
+        self.refreshes = 0
+        self.calls = []
+        self.last_wait = None
+
+    def open(self):
+        time.sleep(0.3)
+
+    def refresh(self):
+        time.sleep(0.01)
+        self.refreshes += 1
+
+    def get_view_by_text(self, text, partial_matching=True):
+        return self.refreshes >= self.refreshes_needed
+
+    def tap_on_coordinates(self, x, y):
+        self.calls.append((x, y))
+
+
+class TestAsyncPilot(unittest.TestCase):
+
+    def test_concurrent_waits(self):
+        devices = [FakeAsyncDevice('device-%d' % i, 3) for i in range(20)]
+        with async_pilot.EventLoop(max_workers=2) as loop:
+            pilots = [async_pilot.AsyncPilot(d, loop) for d in devices]
+            for p in pilots:
+                for i in range(3):
+                    p.tap_on_coordinates(i, i)
+            results = async_pilot.gather(
+                p.poll([async_pilot.wait.Condition(
+                    lambda p=p: p.pilot.get_view_by_text('Ready'),
+                    refresh=True)], 5, interval=0.05, backoff=1)
+                for p in pilots).result(5)
+            devices[0].refreshes_needed = 100
+            timed_out = pilots[0].wait_for_text(
+                'Never', 0.2, partial_matching=False)
+            self.assertFalse(timed_out.result(5))
+
+        self.assertTrue(all(results))
+        self.assertEqual([r.polls for r in results], [3] * 20)
+        self.assertEqual(devices[5].calls, [(0, 0), (1, 1), (2, 2)])
+        self.assertIs(devices[0].last_wait, timed_out.result())
+
+    def test_operations_overlap(self):
+        devices = [FakeAsyncDevice('device-%d' % i, 1) for i in range(20)]
+        start_time = wait.monotonic()
+        with async_pilot.EventLoop() as loop:
+            pilots = [async_pilot.AsyncPilot(d, loop) for d in devices]
+            # one worker for each device
+            self.assertEqual(loop.workers, 20)
+            async_pilot.gather(p.open() for p in pilots).result(5)
+        # the 20 opens ran at the same time, not one after the other
+        self.assertLess(wait.monotonic() - start_time, 2)
+
+        with async_pilot.EventLoop(max_workers=5) as loop:
+            pilots = [async_pilot.AsyncPilot(d, loop) for d in devices]
+            self.assertEqual(loop.workers, 5)
+
+        # bounded by default, unbounded with max_workers=None
+        devices = devices * 2
+        with async_pilot.EventLoop() as loop:
+            pilots = [async_pilot.AsyncPilot(d, loop) for d in devices]
+            self.assertEqual(loop.workers,
+                             async_pilot.DEFAULT_MAX_WORKERS)
+        with async_pilot.EventLoop(max_workers=None) as loop:
+            pilots = [async_pilot.AsyncPilot(d, loop) for d in devices]
+            self.assertEqual(loop.workers, 40)
+
+    def test_errors(self):
+        future = async_pilot.Future()
+        future.set_exception(ValueError('failed'))
+        self.assertRaises(ValueError, async_pilot.gather(
+            [future, async_pilot.Future()]).result, 1)
+
+
+class TestDumpsysNotificationManager(unittest.TestCase):
+
+    def test_parse(self):
+        records = dumpsys_notification.parse_notifications(
+            DUMPSYS_NOTIFICATION % DUMPSYS_DOWNLOAD)
+        self.assertEqual(records, [
+            dumpsys_notification.NotificationRecord(
+                '0|com.example.mail|1|null|10052', 'com.example.mail', 1,
+                None, 'Mail', '2 new messages', None, 0x10),
+            dumpsys_notification.NotificationRecord(
+                '0|com.example.store|3|dl|10070', 'com.example.store', 3,
+                'dl', 'Update', 'Download complete', None, 0x62)])
+
+    def test_parse_redacted(self):
+        # without --noredact (API level 26 and later) only the type of the
+        # texts is shown
+        output = (DUMPSYS_NOTIFICATION % DUMPSYS_DOWNLOAD).replace(
+            'String (Update)', 'String').replace(
+                'String (Download complete)', 'SpannableString')
+        record = dumpsys_notification.parse_notifications(output)[1]
+        self.assertEqual((record.package, record.title, record.text),
+                         ('com.example.store', None, None))
+
+    def test_noredact(self):
+        for api_level, command in (
+                (25, dumpsys_notification.DUMPSYS_CMD),
+                (26, 'dumpsys notification --noredact')):
+            device = FakeDumpsysPilot(api_level)
+            device.outputs = [DUMPSYS_NOTIFICATION % '']
+            dumpsys_notification.DumpsysNotificationManager(device).refresh()
+            self.assertEqual(device.commands, [command])
+
+    def test_refresh(self):
+        device = FakeDumpsysPilot()
+        manager = dumpsys_notification.DumpsysNotificationManager(device)
+        device.outputs = [DUMPSYS_NOTIFICATION % '',
+                          DUMPSYS_NOTIFICATION % '',
+                          DUMPSYS_NOTIFICATION % DUMPSYS_DOWNLOAD,
+                          (DUMPSYS_NOTIFICATION % DUMPSYS_DOWNLOAD).replace(
+                              'Download complete', 'Installed')]
+        self.assertTrue(manager.refresh())
+        self.assertEqual([r.title for r in manager.added_records], ['Mail'])
+        self.assertFalse(manager.refresh())
+        self.assertTrue(manager.wait_for_notification_by_title(
+            'Update', timeout=5))
+        self.assertEqual(len(manager.get_notifications_by_package(
+            'com.example.store')), 1)
+
+        self.assertTrue(manager.refresh())
+        self.assertEqual(manager.added_records, [])
+        self.assertEqual([r.text for r in manager.updated_records],
+                         ['Installed'])
+        self.assertEqual(manager.get_notifications_by_message(
+            'Installed', partial_matching=False)[0].flags, 0x62)
+
+
+class FakeSyncPilot(object):
+
+    """
+    A device file system answering md5sum (unless has_md5sum is False) and
+    receiving pushes.
+    """
+
+    adb_client = None
+    device_name = 'emulator-5554'
+
+    def __init__(self, has_md5sum=True):
+        self.has_md5sum = has_md5sum
+        self.files = {'/dev/null': ''}
+        self.mtimes = {}
+        self.pushed = []
+
+    def shell(self, cmd):
+        if not self.has_md5sum:
+            return '/system/bin/sh: md5sum: not found\n', 127
+        paths = [p.strip("'") for p in cmd.split()[1:]
+                 if p != '2>/dev/null']
+        output = ''.join('%s  %s\n' % (hashlib.md5(self.files[p]).hexdigest(),
+                                       p)
+                         for p in paths if p in self.files)
+        return output, 0
+
+    def push_file(self, src, dst):
+        with open(src, 'rb') as f:
+            self.files[dst] = f.read()
+        self.mtimes[dst] = int(os.stat(src).st_mtime)
+        self.pushed.append(dst)
+
+
+class FakeSyncClient(object):
+
+    """
+    An adb client whose sync connection stats and pushes the files of a
+    FakeSyncPilot.
+    """
+
+    def __init__(self, device):
+        self.device = device
+        self.stats = 0
+
+    def acquire_sync(self, serial):
+        return self
+
+    def release_sync(self, sync_connection):
+        pass
+
+    def stat(self, path):
+        self.stats += 1
+        if path not in self.device.files:
+            return 0, 0, 0
+        return (0100644, len(self.device.files[path]),
+                self.device.mtimes[path])
+
+    def push(self, src, dst):
+        self.device.push_file(src, dst)
+
+
+class TestFileSync(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.directory, 'media'))
+        for name, content in [('data.db', 'rows'),
+                              ('media/a.png', 'image a'),
+                              ('media/b.png', 'image b')]:
+            with open(os.path.join(self.directory, name), 'wb') as f:
+                f.write(content)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_push_changed_only(self):
+        device = FakeSyncPilot()
+        pushed = file_sync.push_tree(device, self.directory, '/sdcard/data/')
+        self.assertEqual(pushed, ['data.db', 'media/a.png', 'media/b.png'])
+        self.assertEqual(device.files['/sdcard/data/media/b.png'], 'image b')
+
+        self.assertEqual(
+            file_sync.push_tree(device, self.directory, '/sdcard/data'), [])
+
+        with open(os.path.join(self.directory, 'media/a.png'), 'wb') as f:
+            f.write('image a, edited')
+        self.assertEqual(
+            file_sync.push_tree(device, self.directory, '/sdcard/data'),
+            ['media/a.png'])
+
+    def test_push_without_md5sum(self):
+        device = FakeSyncPilot(has_md5sum=False)
+        self.assertIsNone(file_sync.device_md5sums(device, ['/sdcard/a']))
+        device.adb_client = FakeSyncClient(device)
+        self.assertEqual(
+            len(file_sync.push_tree(device, self.directory, '/sdcard/data')),
+            3)
+        # compared by size and mtime
+        self.assertEqual(
+            file_sync.push_tree(device, self.directory, '/sdcard/data'), [])
+        self.assertEqual(device.adb_client.stats, 6)
+
+        path = os.path.join(self.directory, 'data.db')
+        with open(path, 'wb') as f:
+            f.write('more rows')
+        self.assertEqual(
+            file_sync.push_tree(device, self.directory, '/sdcard/data'),
+            ['data.db'])
+
+
+class TestLogcatStore(unittest.TestCase):
+
+    LOGCAT = """--------- beginning of main
+I/ActivityManager(  61): Start proc com.example for activity
+D/Example(  400): loading
+D/Example(  400): loading
+E/AndroidRuntime(  400): FATAL EXCEPTION: main
+E/AndroidRuntime(  400): java.lang.NullPointerException
+    at com.example.Main.onCreate(Main.java:10)
+E/ActivityManager(  61): ANR in com.example
+"""
+
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as f:
+            f.write(self.LOGCAT)
+        self.store = logcat_store.LogcatStore()
+        self.assertEqual(self.store.load(self.filename, timestamp=100), 7)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_queries(self):
+        self.assertEqual(self.store.count(tag='Example'), 2)
+        self.assertEqual(self.store.count(level='E'), 4)
+        self.assertEqual(self.store.count(tag='Missing'), 0)
+        self.assertEqual(self.store.count(pid=61, level='E'), 1)
+        # the repeated message is stored once
+        self.assertEqual(len(self.store.messages), 6)
+
+        crash = self.store.crashes()
+        self.assertEqual(len(crash), 1)
+        self.assertEqual(crash[0].pid, 400)
+        self.assertEqual(self.store.anrs()[0].message, 'ANR in com.example')
+
+    def test_time_range(self):
+        self.store.append(200, 'W', 'Example', 400, 'late')
+        self.assertEqual(self.store.count(start=150), 1)
+        self.assertEqual(self.store.count(end=150, tag='Example'), 2)
+        self.assertEqual(self.store.count_by_tag(level='W'), {'Example': 1})
+
+
+class TestShellSession(unittest.TestCase):
+
+    def setUp(self):
+        self.device = simulator.sample_device()
+        self.simulator = simulator.Simulator()
+        self.simulator.start()
+        self.simulator.add_device(self.device)
+        self.session = shell_session.ShellSession(
+            FakeDevicePilot(self.device.serial, 19))
+
+    def tearDown(self):
+        self.session.close()
+        self.simulator.stop()
+
+    def test_exit_codes(self):
+        self.assertEqual(self.session.execute('echo hello'), ('hello\n', 0))
+        output, exit_code = self.session.execute('cat /missing')
+        self.assertIn('No such file', output)
+        self.assertEqual(exit_code, 1)
+        self.assertEqual(self.session.execute(['missing-command', '-x'])[1],
+                         127)
+        self.assertEqual(self.session.execute('true'), ('', 0))
+
+    def test_marker_like_output(self):
+        self.session.execute('true')
+        # markers of another session, and of a later command of this one
+        for text in ('__AP_0123abcdx0_0__',
+                     '__AP_%sx99_3__' % self.session.session_id):
+            self.assertEqual(self.session.execute('echo %s' % text),
+                             (text + '\n', 0))
+
+    def test_concurrent_callers(self):
+        results = {}
+
+        def _execute(index):
+            results[index] = self.session.execute('echo %d' % index)
+
+        threads = [threading.Thread(target=_execute, args=(i,))
+                   for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, dict((i, ('%d\n' % i, 0))
+                                       for i in range(10)))
+
+    def test_timeout_and_reopen(self):
+        self.session.execute('true')
+        process = self.session.process
+        self.assertRaises(shell_session.ShellSessionException,
+                          self.session.execute, 'sleep 1', 0.2)
+        self.assertIsNone(self.session.process)
+        self.assertEqual(self.session.execute('echo again'), ('again\n', 0))
+        self.assertIsNot(self.session.process, process)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_histograms(self):
+        session = pilot.AndroPilot('emulator-5554', profile_cache_path=None)
+        registry = session.enable_metrics()
+        for value in (0.002, 0.004, 0.2, 100):
+            registry.observe('adb_command_seconds', value, command='shell')
+        registry.observe('viewserver_transfer_bytes', 3000, command='DUMP')
+        wait.wait_for(lambda: True, 1, probe=session.probe)
+
+        histogram = registry.histogram('adb_command_seconds', command='shell')
+        self.assertEqual(histogram.count, 4)
+        self.assertEqual(histogram.quantile(0.5), 0.005)
+        self.assertEqual(histogram.quantile(1), float('inf'))
+        self.assertEqual(registry.histogram('wait_polls').count, 1)
+
+        text = metrics.export_prometheus([registry])
+        self.assertIn('# TYPE andropilot_adb_command_seconds histogram', text)
+        self.assertIn('andropilot_adb_command_seconds_bucket{command="shell",'
+                      'device="emulator-5554",le="0.005"} 2', text)
+        self.assertIn('andropilot_adb_command_seconds_bucket{command="shell",'
+                      'device="emulator-5554",le="+Inf"} 4', text)
+        self.assertIn('andropilot_viewserver_transfer_bytes_count{'
+                      'command="DUMP",device="emulator-5554"} 1', text)
+
+        data = json.loads(registry.export_json())
+        self.assertEqual(len(data['histograms']), 4)
+
+
+class TestHooks(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_hooks(self):
+        session = pilot.AndroPilot(profile_cache_path=None)
+        calls = []
+        hook = session.add_hook(hooks.Hook(
+            before=lambda probe: calls.append(('before', probe.name)),
+            after=lambda probe: calls.append(('after', probe.name,
+                                              probe.duration is not None)),
+            names=['AndroPilot.wait_*', 'wait']))
+        session.wait_any([lambda: True], 1)
+        self.assertEqual(calls, [('before', 'AndroPilot.wait_any'),
+                                 ('before', 'wait'),
+                                 ('after', 'wait', True),
+                                 ('after', 'AndroPilot.wait_any', True)])
+        session.remove_hook(hook)
+        session.wait_any([lambda: True], 1)
+        self.assertEqual(len(calls), 4)
+        self.assertFalse('wait_any' in session.__dict__)
+
+    def test_builtin_hooks(self):
+        session = pilot.AndroPilot(profile_cache_path=None)
+        profiler = session.add_hook(hooks.SlowRefreshProfiler(
+            threshold=0, sample_rate=1, directory=self.directory,
+            names=['AndroPilot.wait_all']))
+        dumper = session.add_hook(hooks.SlowParseDumper(
+            threshold=0, directory=self.directory))
+        session.wait_all([lambda: True], 1)
+        with session.probe('build_tree', 'parser') as probe:
+            probe.set_payload('DONE.')
+        self.assertEqual(len(profiler.saved), 1)
+        self.assertEqual(len(dumper.saved), 1)
+        with open(dumper.saved[0]) as f:
+            self.assertEqual(f.read(), 'DONE.')
+
+
+class FakeMonkeyServer(threading.Thread):
+
+    """
+    A monkey server replying to every command, with the values of getvar
+    from properties (an empty value as a bare OK). The connection is
+    closed once after drop_after commands in total.
+    """
+
+    def __init__(self, properties=None, drop_after=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.properties = properties or {'build.version.sdk': '19'}
+        self.drop_after = drop_after
+        self.commands = []
+        self.server = socket.socket()
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(5)
+        self.port = self.server.getsockname()[1]
+
+    def run(self):
+        while True:
+            conn, _ = self.server.accept()
+            handler = threading.Thread(target=self.handle, args=(conn,))
+            handler.daemon = True
+            handler.start()
+
+    def reply(self, command):
+        if command.startswith('getvar '):
+            value = self.properties.get(command.split()[1])
+            if value is None:
+                return 'ERROR: no such var'
+            return 'OK:' + value if value else 'OK'
+        return 'OK'
+
+    def handle(self, conn):
+        try:
+            self.serve(conn)
+        except socket.error:
+            pass
+        conn.close()
+
+    def serve(self, conn):
+        pending = ''
+        while True:
+            data = conn.recv(4096)
+            if not data:
+                return
+            lines = (pending + data).split('\n')
+            pending = lines.pop()
+            replies = []
+            for line in lines:
+                if len(self.commands) == self.drop_after:
+                    self.drop_after = None
+                    conn.sendall(''.join(replies))
+                    # the remaining commands are not executed
+                    conn.shutdown(socket.SHUT_WR)
+                    while conn.recv(4096):
+                        pass
+                    return
+                self.commands.append(line)
+                replies.append(self.reply(line) + '\n')
+            conn.sendall(''.join(replies))
+
+
+class FakeMonkeyProcess(object):
+
+    def poll(self):
+        return None
+
+    def terminate(self):
+        pass
+
+
+def _connected_monkey(server):
+    session = pilot.AndroPilot(monkey_server_port=server.port,
+                               profile_cache_path=None)
+    monkey = monkey_controller.MonkeyController(session, keepalive_interval=0)
+    # a running monkey process: errors are recovered by reconnecting
+    monkey.monkey_binder_process = FakeMonkeyProcess()
+    monkey.reconnect()
+    return monkey
+
+
+class TestMonkeyController(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeMonkeyServer()
+        self.server.start()
+        self.monkey = _connected_monkey(self.server)
+
+    def tearDown(self):
+        self.monkey.close()
+
+    def taps(self):
+        return [c for c in self.server.commands if c.startswith('tap')]
+
+    def test_partial_batch(self):
+        self.server.drop_after = len(self.server.commands) + 2
+        commands = ['tap %d %d' % (i, i) for i in range(4)]
+        self.assertEqual(self.monkey.send_batch(commands), ['OK'] * 4)
+        # the two replied taps are not executed again
+        self.assertEqual(self.taps(), commands)
+        self.assertEqual(self.monkey.reconnect_count, 2)
+
+    def test_keepalive(self):
+        self.monkey.keepalive_interval = 0.05
+        self.monkey._MonkeyController__start_keepalive()
+        time.sleep(0.3)
+        self.assertIn(monkey_controller.KEEPALIVE_COMMAND,
+                      self.server.commands[1:])
+
+        # a keepalive on a dropped connection reconnects
+        self.server.drop_after = len(self.server.commands)
+        time.sleep(0.3)
+        self.assertEqual(self.monkey.keepalive_failures, 1)
+        self.assertEqual(self.monkey.reconnect_count, 2)
+        self.monkey.tap(1, 2)
+        self.assertEqual(self.taps(), ['tap 1 2'])
+
+    def test_restart(self):
+        delays = (monkey_controller.SERVICE_START_DELAY,
+                  monkey_controller.SERVICE_LISTEN_DELAY)
+        monkey_controller.SERVICE_START_DELAY = 0.1
+        monkey_controller.SERVICE_LISTEN_DELAY = 0.1
+        device = simulator.sample_device(latency=0.001)
+        try:
+            with simulator.Simulator() as sim:
+                sim.add_device(device)
+                session = sim.create_pilot(device.serial)
+                monkey = monkey_controller.MonkeyController(
+                    session, keepalive_interval=0)
+                monkey.open()
+                # the monkey process died with its connection
+                monkey.monkey_binder_process.terminate()
+                monkey.monkey_binder_process.wait()
+                monkey.monkey_socket.close()
+                monkey.tap(10, 20)
+                self.assertEqual(monkey.restart_count, 1)
+                self.assertEqual(monkey.reconnect_count, 0)
+                self.assertEqual(
+                    monkey.get_connection_stats()['restart_count'], 1)
+                monkey.close()
+                session.close()
+        finally:
+            (monkey_controller.SERVICE_START_DELAY,
+             monkey_controller.SERVICE_LISTEN_DELAY) = delays
+        self.assertEqual(device.events['tap'], 1)
+
+
+class TestTopLevelImport(unittest.TestCase):
+
+    def test_import_pilot(self):
+        # the modules are also imported from the package directory, as
+        # top-level modules
+        output = subprocess.check_output(
+            [sys.executable, '-c', 'import pilot; print pilot.__name__'],
+            cwd=os.path.dirname(os.path.abspath(pilot.__file__)),
+            stderr=subprocess.STDOUT)
+        self.assertEqual(output.splitlines()[-1], 'pilot')
+
+
+class TestDeviceProfile(unittest.TestCase):
+
+    PROPERTIES = {
+        'build.fingerprint': 'Kyocera/torque:5.1/1:user/release-keys',
+        'build.version.sdk': '23',
+        'build.model': '',
+        'display.width': '720',
+        'display.height': '1280',
+        'display.density': '2.0',
+    }
+
+    def setUp(self):
+        self.server = FakeMonkeyServer(dict(self.PROPERTIES))
+        self.server.start()
+        self.monkey = _connected_monkey(self.server)
+        # the connection ping
+        del self.server.commands[:]
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.monkey.close()
+        shutil.rmtree(self.directory)
+
+    def getvars(self):
+        return [c for c in self.server.commands if c.startswith('getvar')]
+
+    def test_getvar_replies(self):
+        values = self.monkey.get_properties_by_socket(
+            ['build.version.sdk', 'build.model', 'build.product',
+             'build.fingerprint'])
+        self.assertEqual(values, {
+            'build.version.sdk': '23', 'build.model': '',
+            'build.product': None,
+            'build.fingerprint': self.PROPERTIES['build.fingerprint']})
+        self.assertEqual(
+            self.monkey.get_property_by_socket('build.fingerprint'),
+            self.PROPERTIES['build.fingerprint'])
+        self.assertEqual(self.monkey.get_property_by_socket('build.model'),
+                         '')
+        self.assertRaises(monkey_controller.MonkeyException,
+                          self.monkey.get_property_by_socket, 'build.product')
+
+    def test_cache(self):
+        path = os.path.join(self.directory, 'profiles', 'cache.json')
+        profile = device_profile.load_profile(
+            self.monkey, 'emulator-5554',
+            device_profile.DeviceProfileCache(path))
+        self.assertEqual((profile.display_width, profile.api_level),
+                         (720, 23))
+        # written by renaming a temporary file
+        self.assertEqual(os.listdir(os.path.dirname(path)), ['cache.json'])
+        self.assertEqual(len(self.getvars()),
+                         1 + len(device_profile.PROFILE_PROPERTIES))
+
+        # a new cache on the same file: only the fingerprint is queried
+        del self.server.commands[:]
+        cache = device_profile.DeviceProfileCache(path)
+        profile = device_profile.load_profile(self.monkey, 'emulator-5554',
+                                              cache)
+        self.assertEqual(profile.display_height, 1280)
+        self.assertEqual(self.getvars(), ['getvar build.fingerprint'])
+
+        # a system update changes the fingerprint
+        del self.server.commands[:]
+        self.server.properties['build.fingerprint'] += '.2'
+        self.server.properties['display.density'] = '3.0'
+        profile = device_profile.load_profile(self.monkey, 'emulator-5554',
+                                              cache)
+        self.assertEqual(profile.density, 3.0)
+        self.assertEqual(len(self.getvars()),
+                         1 + len(device_profile.PROFILE_PROPERTIES))
+        with open(path) as f:
+            self.assertEqual(len(json.load(f)), 2)
+
+    def test_concurrent_caches(self):
+        path = os.path.join(self.directory, 'cache.json')
+        caches = [device_profile.DeviceProfileCache(path) for _ in range(8)]
+        for cache in caches:
+            # loaded before any of the others saves
+            self.assertIsNone(cache.get('emulator-5554', 'fingerprint'))
+        self.assertIs(caches[0].lock, caches[1].lock)
+
+        def _put(index):
+            caches[index].put(device_profile.DeviceProfile(
+                'emulator-%d' % (5554 + 2 * index),
+                {device_profile.FINGERPRINT_PROPERTY: 'fingerprint'}))
+
+        threads = [threading.Thread(target=_put, args=(i,))
+                   for i in range(len(caches))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # every save merged the profiles saved before it
+        cache = device_profile.DeviceProfileCache(path)
+        for index in range(len(caches)):
+            self.assertIsNotNone(cache.get('emulator-%d' % (5554 + 2 * index),
+                                           'fingerprint'))
+        self.assertEqual(os.listdir(self.directory), ['cache.json'])
+
+    def test_statusbar_height(self):
+        for api_level, density, height in [('22', '2.0', 50),
+                                           ('23', '2.0', 48),
+                                           ('23', '1.5', 36),
+                                           ('10', None, 25)]:
+            profile = device_profile.DeviceProfile('emulator-5554', {
+                'build.version.sdk': api_level, 'display.density': density})
+            self.assertEqual(profile.statusbar_height, height)
+
+
+class FakeFarmPilot(object):
+
+    """
+    A session whose opens fail after max_opens[serial] and whose jobs fail
+    while failing[serial] is set.
+    """
+
+    max_opens = {}
+    failing = {}
+    opens = collections.Counter()
+
+    def __init__(self, device_name, **options):
+        self.device_name = device_name
+        self.options = options
+
+    def open(self):
+        FakeFarmPilot.opens[self.device_name] += 1
+        if FakeFarmPilot.opens[self.device_name] > \
+                self.max_opens.get(self.device_name, 1):
+            raise IOError('device offline')
+
+    def close(self):
+        pass
+
+
+def _farm_job(pilot, value):
+    if FakeFarmPilot.failing.get(pilot.device_name):
+        FakeFarmPilot.failing[pilot.device_name] -= 1
+        raise ValueError('job failed')
+    return pilot.device_name, value
+
+
+class TestFarm(unittest.TestCase):
+
+    def setUp(self):
+        self.pilot_class = farm.AndroPilot
+        farm.AndroPilot = FakeFarmPilot
+        FakeFarmPilot.max_opens = {}
+        FakeFarmPilot.failing = {}
+        FakeFarmPilot.opens.clear()
+
+    def tearDown(self):
+        farm.AndroPilot = self.pilot_class
+
+    def test_fair_queue(self):
+        queue = farm.FairQueue()
+        for name, group in [('a1', 'a'), ('a2', 'a'), ('a3', 'a'),
+                            ('b1', 'b'), ('c1', 'c'), ('b2', 'b')]:
+            queue.put(farm.Job(name, (), {}, group))
+        self.assertEqual(len(queue), 6)
+        queue.close()
+        order = []
+        for job in iter(queue.get, None):
+            order.append(job.function)
+        self.assertEqual(order, ['a1', 'b1', 'c1', 'a2', 'b2', 'a3'])
+
+    def test_port_allocator(self):
+        busy = socket.socket()
+        busy.bind(('127.0.0.1', 0))
+        first = busy.getsockname()[1]
+        allocator = farm.PortAllocator(first, first + 1)
+        try:
+            # the port bound by another socket is skipped
+            port = allocator.allocate()
+            self.assertEqual(port, first + 1)
+            self.assertRaises(farm.FarmException, allocator.allocate)
+            allocator.release(port)
+            self.assertEqual(allocator.allocate(), port)
+        finally:
+            busy.close()
+
+    def test_reopen(self):
+        FakeFarmPilot.max_opens = {'dev-1': 2}
+        FakeFarmPilot.failing = {'dev-1': farm.MAX_CONSECUTIVE_FAILURES}
+        with farm.DevicePool(['dev-1']) as pool:
+            jobs = [pool.submit(_farm_job, i) for i in range(5)]
+            self.assertEqual(jobs[-1].result(5), ('dev-1', 4))
+            health = pool.get_health()['dev-1']
+        self.assertEqual(FakeFarmPilot.opens['dev-1'], 2)
+        self.assertRaises(ValueError, jobs[0].result)
+        self.assertEqual(jobs[3].result(), ('dev-1', 3))
+        self.assertEqual((health['healthy'], health['jobs_done'],
+                          health['jobs_failed']), (True, 2, 3))
+
+    def test_exclusion(self):
+        FakeFarmPilot.failing = {'dev-1': 100}
+        pool = farm.DevicePool(['dev-1', 'dev-2'])
+        jobs = [pool.submit(_farm_job, i, group='dev-1')
+                for i in range(farm.MAX_CONSECUTIVE_FAILURES)]
+        # the second device never opens
+        FakeFarmPilot.max_opens = {'dev-2': 0}
+        pool.start()
+        try:
+            for job in jobs:
+                self.assertRaises(ValueError, job.result, 5)
+            # dev-1 cannot be reopened either: the queued jobs fail
+            queued = [pool.submit(_farm_job, i) for i in range(3)]
+            for job in queued:
+                self.assertRaises(farm.FarmException, job.result, 5)
+            self.assertRaises(farm.FarmException,
+                              pool.submit(_farm_job, 0).result, 5)
+            self.assertEqual(
+                [h['healthy'] for _, h in sorted(pool.get_health().items())],
+                [False, False])
+        finally:
+            pool.stop()
+        self.assertEqual(FakeFarmPilot.opens,
+                         {'dev-1': 1 + farm.MAX_REOPEN_FAILURES,
+                          'dev-2': farm.MAX_REOPEN_FAILURES})
+
+
+class FakeViewServer(object):
+
+    def __init__(self):
+        ok = viewserver_parser.VSNode()
+        ok.mId = 'id/ok'
+        ok.isShown = True
+        ok.mLocation = viewserver_parser.Point()
+        ok.mLocation.x, ok.mLocation.y = 540, 1200
+        self.tree_nodes_list = [ok]
+        self.refreshes = 0
+
+    def refresh_view(self):
+        self.refreshes += 1
+
+
+class TestRecorder(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.session = pilot.AndroPilot(profile_cache_path=None)
+        self.sent = []
+        monkey = monkey_controller.MonkeyController(self.session)
+        monkey.send_by_socket = lambda command: self.sent.append([command])
+        monkey._MonkeyController__communicate = \
+            lambda commands: self.sent.append(commands) or \
+            ['OK'] * len(commands)
+        self.session.monkey_controller = monkey
+        self.session.viewserver_controller = FakeViewServer()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_record_replay(self):
+        filename = os.path.join(self.directory, 'script.txt')
+        with recorder.Recorder(self.session) as session_recorder:
+            self.session.tap_on_coordinates(10, 20)
+            self.session.click_view_by_id('ok')
+            self.session.type('hi there')
+            self.session.wait_for_custom_event(lambda: True, 1)
+            self.session.press_back()
+            self.session.refresh()
+        session_recorder.save(filename)
+        self.assertFalse('tap_on_coordinates' in self.session.__dict__)
+        self.assertEqual(len(self.sent), 6)
+
+        actions = recorder.load_script(filename)
+        self.assertEqual([a.name for a in actions],
+                         ['tap_on_coordinates', 'click_view_by_id', 'type',
+                          'press_back'])
+        self.assertEqual(actions[1].at, (540, 1200))
+
+        del self.sent[:]
+        replayer = recorder.Replayer(self.session, actions)
+        self.assertEqual(len(replayer.compile()), 1)
+        replayer.run()
+        self.assertEqual(self.sent, [['tap 10 20', 'tap 540 1200', 'type hi',
+                                      'key down 62', 'type there',
+                                      'press back']])
+        self.assertEqual(self.session.viewserver_controller.refreshes, 1)
+
+        # resolving the selector refreshes the view tree
+        del self.sent[:]
+        recorder.Replayer(self.session, actions, resolve_selectors=True).run()
+        self.assertEqual(self.sent, [['tap 10 20'], ['tap 540 1200'],
+                                     ['type hi', 'key down 62', 'type there',
+                                      'press back']])
+        self.assertEqual(self.session.viewserver_controller.refreshes, 2)
+
+
+class TestSimulator(unittest.TestCase):
+
+    def test_shell(self):
+        device = simulator.sample_device()
+        shell = simulator.DeviceShell(device)
+        self.assertEqual(shell.run("mkdir -p /data/ap; echo 'a b' > "
+                                   "/data/ap/x; cat /data/ap/x"), 'a b\n')
+        self.assertEqual(shell.run('{ cat /missing 2>/dev/null'), '')
+        self.assertEqual(shell.run('echo "status $?"'), 'status 1\n')
+        self.assertIn('Complete', shell.run(
+            'am start -W -n com.example.app/com.example.app.DetailsActivity'))
+        self.assertEqual(device.current.name, 'details')
+        shell.run('input keyevent 4')
+        self.assertEqual(device.current.name, 'main')
+
+    def test_pilot_session(self):
+        device = simulator.sample_device(latency=0.001)
+        with simulator.Simulator() as sim:
+            sim.add_device(device)
+            with sim.create_pilot(
+                    device.serial,
+                    notification_backend=pilot.DUMPSYS_NOTIFICATIONS) as p:
+                self.assertEqual(p.device_api_level, 19)
+                p.refresh()
+                view = p.get_view_by_id('details')
+                left, top, right, bottom = view.get_absolute_rect()
+                p.tap_on_coordinates((left + right) // 2,
+                                     (top + bottom) // 2 + p.statusbar_height)
+                self.assertTrue(p.wait_for_text('Download complete',
+                                                timeout=5))
+                self.assertEqual(p.get_focus_activity(),
+                                 'com.example.app.DetailsActivity')
+                self.assertEqual(p.shell('echo hello'), ('hello\n', 0))
+                self.assertEqual(p.capture_screen().width, 480)
+                device.notify('com.example.mail', 1, 'Mail', '2 new messages')
+                self.assertTrue(p.notification_manager.
+                                wait_for_notification_by_title('Mail',
+                                                               timeout=5))
+        self.assertEqual(device.events['tap'], 1)
+
+
+class TestLoadTest(unittest.TestCase):
+
+    def test_summarize(self):
+        summary = loadtest.summarize([i / 100.0 for i in range(100, 0, -1)])
+        self.assertEqual((summary['count'], summary['p50'], summary['p99'],
+                          summary['max']), (100, 0.5, 0.99, 1.0))
+
+    def test_run(self):
+        report = loadtest.LoadTest(sessions=2, duration=1).run()
+        self.assertEqual(report['sessions'], 2)
+        self.assertEqual(report['errors'], {})
+        self.assertTrue(report['operations'] > 0)
+        self.assertTrue(set(report['latency']) <= set(loadtest.OPERATIONS))
+        self.assertIn('p99', report['latency']['refresh'])
+
+
+class TestTracing(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_trace(self):
+        session = pilot.AndroPilot(profile_cache_path=None)
+        registry = session.enable_metrics()
+        filename = os.path.join(self.directory, 'trace.json')
+        tracer = session.enable_tracing(filename)
+        session.wait_all([lambda: True], 1)
+        session.wait_any([lambda: True], 1)
+        with session.probe('build_tree', 'parser') as probe:
+            probe.set(nodes=42)
+
+        with open(filename) as f:
+            self.assertRaises(ValueError, json.loads, f.read())
+        session.disable_tracing()
+        self.assertTrue(tracer.closed)
+        with open(filename) as f:
+            events = [e for e in json.load(f) if e.get('ph') == 'X']
+        self.assertEqual([e['name'] for e in events],
+                         ['wait', 'AndroPilot.wait_all', 'wait',
+                          'AndroPilot.wait_any', 'build_tree'])
+        self.assertEqual(events[4]['args'], {'nodes': 42})
+        # the wait is nested in the wait_any call
+        self.assertTrue(events[3]['ts'] <= events[2]['ts'] and
+                        events[2]['ts'] + events[2]['dur'] <=
+                        events[3]['ts'] + events[3]['dur'])
+        self.assertEqual(registry.histogram('build_tree_nodes').count, 1)
+        self.assertFalse('wait_any' in session.__dict__)
+
+
+class FakeScreen(object):
+
+    """
+    Returns the given frames one per capture, then repeats the last one
+    (or cycles through them).
+    """
+
+    def __init__(self, frames, cycle=False):
+        self.frames = frames
+        self.cycle = cycle
+        self.captures = 0
+
+    def capture(self, as_array=False):
+        index = self.captures
+        self.captures += 1
+        if self.cycle:
+            return self.frames[index % len(self.frames)]
+        return self.frames[min(index, len(self.frames) - 1)]
+
+
+@unittest.skipIf(screen_diff.numpy is None, 'NumPy not installed')
+class TestScreenDiff(unittest.TestCase):
+
+    def setUp(self):
+        numpy = screen_diff.numpy
+        # a horizontal gradient, RGBA
+        gradient = numpy.tile(numpy.arange(256, dtype=numpy.uint8),
+                              (256, 1))
+        self.frame = numpy.dstack([gradient] * 3 +
+                                  [numpy.full((256, 256), 255, numpy.uint8)])
+        noise = numpy.random.RandomState(1).randint(0, 3, self.frame.shape)
+        self.noisy = (self.frame.astype(int) - noise).clip(0, 255).astype(
+            numpy.uint8)
+        self.mirrored = self.frame[:, ::-1].copy()
+        # a dialog in the top left corner
+        self.dialog = self.frame.copy()
+        self.dialog[:64, :64, :3] = 255
+        self.session = pilot.AndroPilot(profile_cache_path=None)
+
+    def state(self, frame, region=None):
+        return screen_diff.ScreenState(frame, region)
+
+    def test_hash_distance(self):
+        reference = self.state(self.frame)
+        self.assertEqual(screen_diff.hamming_distance(
+            reference.hash, self.state(self.noisy).hash), 0)
+        self.assertFalse(self.state(self.noisy).differs(reference))
+        self.assertEqual(screen_diff.hamming_distance(
+            reference.hash, self.state(self.mirrored).hash),
+            screen_diff.HASH_SIZE * screen_diff.HASH_SIZE)
+        self.assertTrue(self.state(self.dialog).differs(reference))
+        # the change is outside the region
+        region = (128, 128, 128, 128)
+        self.assertFalse(self.state(self.dialog, region).differs(
+            self.state(self.frame, region)))
+
+    def test_wait_for_screen_change(self):
+        screen = FakeScreen([self.frame, self.noisy, self.frame,
+                             self.dialog])
+        self.session.capture_screen = screen.capture
+        result = screen_diff.wait_for_screen_change(self.session, 5,
+                                                    interval=0.01)
+        self.assertTrue(result)
+        # the reference and three polls
+        self.assertEqual((result.polls, screen.captures), (3, 4))
+
+        self.session.capture_screen = FakeScreen([self.frame]).capture
+        self.assertFalse(screen_diff.wait_for_screen_change(
+            self.session, 0.1, interval=0.01))
+
+    def test_wait_for_screen_stable(self):
+        screen = FakeScreen([self.frame, self.dialog, self.frame,
+                             self.mirrored, self.noisy[:, ::-1]])
+        self.session.capture_screen = screen.capture
+        result = screen_diff.wait_for_screen_stable(
+            self.session, 0.1, 5, interval=0.01)
+        self.assertTrue(result)
+        self.assertGreaterEqual(result.elapsed, 0.1)
+        self.assertGreater(screen.captures, 5)
+
+        # never quiet for long enough
+        self.session.capture_screen = FakeScreen(
+            [self.frame, self.dialog], cycle=True).capture
+        self.assertFalse(screen_diff.wait_for_screen_stable(
+            self.session, 0.1, 0.3, interval=0.01))
+
+
+class TestWait(unittest.TestCase):
+
+    def test_wait_any_shares_refresh(self):
+        refreshes = []
+        polls = []
+
+        def _check():
+            polls.append(1)
+            return len(polls) >= 3 and 'found'
+
+        result = wait.wait_any(
+            [wait.Condition(_check, refresh=True),
+             wait.Condition(lambda: False, refresh=True)],
+            5, refresh=lambda: refreshes.append(1), interval=0.01)
+        self.assertTrue(result)
+        self.assertEqual(result.value, 'found')
+        self.assertEqual(result.polls, 3)
+        self.assertEqual(len(refreshes), 3)
+
+    def test_wait_all_timeout(self):
+        result = wait.wait_all([lambda: True, lambda: False], 0.2,
+                               interval=0.05)
+        self.assertFalse(result)
+        self.assertEqual(result.values, [True, None])
+        self.assertTrue(result.elapsed >= 0.2)
+
+    def test_wait_for_text_cadence(self):
+        session = pilot.AndroPilot(profile_cache_path=None)
+        checks = []
+        session.refresh = lambda: None
+        session.exist_view_by_text = \
+            lambda text, refresh: checks.append(wait.monotonic())
+        self.assertFalse(session.wait_for_text('OK', timeout=0.5,
+                                               sleep_time=0.1))
+        # polled every sleep_time, the interval does not grow
+        intervals = [b - a for a, b in zip(checks, checks[1:])]
+        self.assertGreaterEqual(len(intervals), 4)
+        self.assertLess(max(intervals), 0.15)
+
+
+def _view(depth, class_name, hashcode, ident, text):
+    return '%s%s@%s mID=%d,%s mText=%d,%s getVisibility()=7,VISIBLE' % (
+        ' ' * depth, class_name, hashcode, len(ident), ident, len(text), text)
+
+
+class FakeRefreshedPilot(object):
+
+    """
+    A pilot whose ViewServer dumps the given title, counting the parses.
+    """
+
+    DUMP_ALL_CMD = 'DUMP -1'
+
+    def __init__(self, title):
+        self.device_name = 'emulator-5554'
+        self.viewserver_controller = self
+        self.title = title
+        self.tree_nodes_list = None
+        self.parses = 0
+        self.hooks = []
+
+    def get_data_by_socket(self, command):
+        return '\n'.join([
+            _view(0, 'android.widget.FrameLayout', 'a0', 'id/content', ''),
+            _view(1, 'android.widget.TextView', 'b0', 'id/title',
+                  self.title)])
+
+    def build_tree(self, data):
+        self.parses += 1
+        return viewserver_parser.build_tree(data)
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+        return hook
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+
+class TestBackgroundRefresher(unittest.TestCase):
+
+    def setUp(self):
+        self.pilot = FakeRefreshedPilot('Inbox')
+        self.refresher = refresher.BackgroundRefresher(
+            self.pilot, min_interval=0.01, max_interval=0.2, backoff=2)
+        self.refresher.start()
+
+    def tearDown(self):
+        self.refresher.stop()
+        self.assertEqual(self.pilot.hooks, [])
+
+    def test_snapshots(self):
+        snapshot = self.refresher.wait_for_snapshot(0, timeout=5)
+        self.assertIs(self.pilot.tree_nodes_list, snapshot.tree_nodes_list)
+        self.assertEqual(snapshot.tree_nodes_list[1].mText, 'Inbox')
+
+        self.pilot.title = 'Outbox'
+        mark = self.refresher.mark()
+        snapshot = self.refresher.wait_for_snapshot(mark, timeout=5)
+        self.assertGreater(snapshot.sequence, mark)
+        self.assertEqual(snapshot.tree_nodes_list[1].mText, 'Outbox')
+        self.assertIs(self.refresher.latest(), snapshot)
+
+    def test_adaptive_interval(self):
+        self.refresher.wait_for_snapshot(0, timeout=5)
+        time.sleep(0.5)
+        # unchanged dumps are not parsed again, and slow down
+        self.assertEqual(self.pilot.parses, 1)
+        self.assertEqual(self.refresher.interval, 0.2)
+        self.assertLess(self.refresher.latest().sequence, 15)
+
+        # an input event brings the interval back to min_interval
+        mark = self.refresher.mark()
+        self.pilot.hooks[0].after(None)
+        time.sleep(0.1)
+        self.assertGreater(self.refresher.latest().sequence, mark + 2)
+
+
+class TestViewServerParser(unittest.TestCase):
+
+    def _dump(self, title, hashcode_base=0):
+        return '\n'.join([
+            _view(0, 'android.widget.FrameLayout', 'a%d' % hashcode_base,
+                  'id/content', ''),
+            _view(1, 'android.widget.LinearLayout', 'b%d' % hashcode_base,
+                  'id/header', ''),
+            _view(2, 'android.widget.TextView', 'c%d' % hashcode_base,
+                  'id/title', title),
+            _view(1, 'android.widget.Button', 'd%d' % hashcode_base,
+                  'id/ok', 'OK'),
+            'DONE.'])
+
+    def test_tree_hash(self):
+        tree = viewserver_parser.build_tree(self._dump('Hello'))
+        self.assertEqual(len(tree), 4)
+        # the hashcodes of the views do not matter
+        same_tree = viewserver_parser.build_tree(self._dump('Hello', 1))
+        self.assertEqual(viewserver_parser.get_tree_hash(tree),
+                         viewserver_parser.get_tree_hash(same_tree))
+
+        changed_tree = viewserver_parser.build_tree(self._dump('World'))
+        self.assertNotEqual(viewserver_parser.get_tree_hash(tree),
+                            viewserver_parser.get_tree_hash(changed_tree))
+        # the button subtree is unchanged
+        self.assertEqual(tree[3].mHash, changed_tree[3].mHash)
+
+        changed = viewserver_parser.find_changed_nodes(tree, changed_tree)
+        self.assertEqual([n.mId for n in changed], ['id/title'])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,207 @@
+import functools
+import inspect
+import json
+import os
+import threading
+
+from metrics import NULL_METRICS
+import wait
+
+# the buffered events are written to disk at least this often (seconds)
+FLUSH_INTERVAL = 1.0
+
+
+class Tracer(object):
+
+    """
+    Writes spans in the Chrome trace-event format (a JSON array of
+    events), readable by chrome://tracing and Perfetto.
+
+    Events are appended to the file as they complete, so the trace of a
+    long (or crashed) session can be opened at any time: the closing
+    bracket of the array is optional for the trace viewers.
+    Spans are complete ('X') events, their nesting is given by the
+    timestamps of the spans of each thread.
+    """
+
+    def __init__(self, filename, process_name='andropilot'):
+        self.filename = filename
+        self.file = open(filename, 'w')
+        self.file.write('[\n')
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.threads = set()
+        self.last_flush = wait.monotonic()
+        self.closed = False
+        self._write({'name': 'process_name', 'ph': 'M', 'pid': self.pid,
+                     'args': {'name': process_name}})
+
+    def _write(self, event):
+        line = json.dumps(event, default=repr) + ',\n'
+        with self.lock:
+            if self.closed:
+                return
+            self.file.write(line)
+            now = wait.monotonic()
+            if now - self.last_flush >= FLUSH_INTERVAL:
+                self.file.flush()
+                self.last_flush = now
+
+    def __thread_id(self):
+        thread = threading.current_thread()
+        tid = thread.ident
+        if tid not in self.threads:
+            self.threads.add(tid)
+            self._write({'name': 'thread_name', 'ph': 'M', 'pid': self.pid,
+                         'tid': tid, 'args': {'name': thread.name}})
+        return tid
+
+    def complete(self, name, category, start, duration, args=None):
+        """
+        Record a span that started at start (wait.monotonic() seconds) and
+        lasted duration seconds.
+        """
+        event = {'name': name, 'cat': category, 'ph': 'X',
+                 'ts': int(start * 1e6), 'dur': int(duration * 1e6),
+                 'pid': self.pid, 'tid': self.__thread_id()}
+        if args:
+            event['args'] = args
+        self._write(event)
+
+    def instant(self, name, category, args=None):
+        event = {'name': name, 'cat': category, 'ph': 'i', 's': 't',
+                 'ts': int(wait.monotonic() * 1e6), 'pid': self.pid,
+                 'tid': self.__thread_id()}
+        if args:
+            event['args'] = args
+        self._write(event)
+
+    def span(self, name, category='pilot', **args):
+        """
+        Context manager recording its block as a span.
+        """
+        return Probe(name, category, {}, args, NULL_METRICS, self)
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            # a trailing comma is not valid JSON, close with an empty event
+            self.file.write('{}\n]\n')
+            self.file.close()
+
+
+class Probe(object):
+
+    """
+    Measures one operation: on exit its duration, and the values set on
+    it (e.g. bytes=...), are observed by the metrics as <name>_seconds and
+    <name>_<key> histograms with the given labels, and the operation is
+    recorded as a span by the tracer (if any).
+    The hooks (a hooks.HookRegistry, if any) are called with the probe
+    before and after the operation: after it, duration and error (the
+    exception type, if it failed) are set.
+    """
+
+    def __init__(self, name, category, labels, args, metrics, tracer,
+                 hooks=None):
+        self.name = name
+        self.category = category
+        self.labels = labels
+        self.args = args
+        self.metrics = metrics
+        self.tracer = tracer
+        self.hooks = hooks
+        self.values = {}
+        # raw data of the operation and (args, kwargs) of the method call,
+        # only seen by the hooks
+        self.payload = None
+        self.call = None
+        self.duration = None
+        self.error = None
+
+    def set(self, **values):
+        self.values.update(values)
+
+    def set_payload(self, payload):
+        self.payload = payload
+
+    def __enter__(self):
+        if self.hooks is not None:
+            self.hooks.before(self)
+        self.start = wait.monotonic()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        elapsed = wait.monotonic() - self.start
+        self.duration = elapsed
+        self.error = type
+        if self.hooks is not None:
+            self.hooks.after(self)
+        self.metrics.observe(self.name + '_seconds', elapsed, **self.labels)
+        for key, observed in self.values.items():
+            self.metrics.observe('%s_%s' % (self.name, key), observed,
+                                 **self.labels)
+        if self.tracer is not None:
+            args = dict(self.labels, **self.args)
+            args.update(self.values)
+            if type is not None:
+                args['error'] = type.__name__
+            self.tracer.complete(self.name, self.category, self.start,
+                                 elapsed, args)
+
+
+class _NullProbe(object):
+
+    def set(self, **values):
+        pass
+
+    def set_payload(self, payload):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+
+NULL_PROBE = _NullProbe()
+
+
+def null_probe(name, category='pilot', labels=None, **args):
+    return NULL_PROBE
+
+
+def _traced(method, probe, name, category):
+    @functools.wraps(method)
+    def _call(*args, **kwargs):
+        with probe(name, category, (args, kwargs)):
+            return method(*args, **kwargs)
+    _call.__wrapped_by_tracer__ = True
+    return _call
+
+
+def trace_methods(obj, probe, category, exclude=()):
+    """
+    Run every call of the public methods of obj in a probe(name,
+    category, (args, kwargs)) context, by shadowing them with instance
+    attributes (see untrace_methods).
+    """
+    # obj.__class__, not type(obj): the controllers are old-style classes
+    prefix = obj.__class__.__name__ + '.'
+    for name in dir(obj.__class__):
+        if name.startswith('_') or name in exclude:
+            continue
+        method = getattr(obj, name)
+        if inspect.ismethod(method) and name not in obj.__dict__:
+            setattr(obj, name, _traced(method, probe, prefix + name,
+                                       category))
+
+
+def untrace_methods(obj):
+    for name in dir(obj.__class__):
+        if not name.startswith('_') and name in obj.__dict__ and \
+                hasattr(obj.__dict__[name], '__wrapped_by_tracer__'):
+            delattr(obj, name)
@@ -0,0 +1,169 @@
+import ctypes
+import ctypes.util
+import logging
+import time
+
+logger = logging.getLogger('andropilot')
+
+DEFAULT_INTERVAL = 0.2  # 200 mseconds
+DEFAULT_MAX_INTERVAL = 1.0
+DEFAULT_BACKOFF = 1.5
+
+CLOCK_MONOTONIC = 1
+
+
+def _system_monotonic():
+    """
+    Return the monotonic clock of the system (Python 2 does not expose it),
+    or None if it is not available.
+    """
+    class _timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    try:
+        library = ctypes.CDLL(ctypes.util.find_library('rt') or
+                              ctypes.util.find_library('c'), use_errno=True)
+        clock_gettime = library.clock_gettime
+    except (OSError, AttributeError):
+        return None
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+
+    def _monotonic():
+        t = _timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+            raise OSError(ctypes.get_errno(), 'clock_gettime failed')
+        return t.tv_sec + t.tv_nsec * 1e-9
+
+    try:
+        _monotonic()
+    except OSError:
+        return None
+    return _monotonic
+
+monotonic = getattr(time, 'monotonic', None) or _system_monotonic() or \
+    time.time
+
+
+class WaitResult(object):
+
+    """
+    The outcome of a wait: it evaluates to True if the wait succeeded and
+    reports the values returned by the conditions, how many times they
+    have been polled and how long it took.
+    """
+
+    def __init__(self, name, satisfied, values, polls, elapsed):
+        self.name = name
+        self.satisfied = satisfied
+        # one entry for each condition, None if it was not satisfied
+        self.values = values
+        self.polls = polls
+        self.elapsed = elapsed
+
+    def __nonzero__(self):
+        return self.satisfied
+
+    __bool__ = __nonzero__
+
+    @property
+    def value(self):
+        """
+        The value of the first satisfied condition.
+        """
+        return next((v for v in self.values if v), None)
+
+    def __repr__(self):
+        return '<WaitResult %s %s after %d polls in %.3fs>' % (
+            self.name, 'satisfied' if self.satisfied else 'timed out',
+            self.polls, self.elapsed)
+
+
+class Condition(object):
+
+    """
+    Something to wait for: check is a function returning a true value when
+    the condition is met. Conditions with refresh set need an up to date
+    view tree, which is refreshed once per poll for all of them.
+    """
+
+    def __init__(self, check, refresh=False, name=None):
+        self.check = check
+        self.refresh = refresh
+        self.name = name or getattr(check, '__name__', 'condition')
+
+
+def _as_condition(condition):
+    if isinstance(condition, Condition):
+        return condition
+    return Condition(condition)
+
+
+def poll(conditions, timeout, require_all=False, refresh=None,
+         interval=DEFAULT_INTERVAL, max_interval=DEFAULT_MAX_INTERVAL,
+         backoff=DEFAULT_BACKOFF, name=None, probe=None):
+    """
+    Poll the conditions until any (or all, if require_all is set) of them
+    are met in the same poll, or the timeout expires.
+
+    The deadline is computed on the monotonic clock. The interval between
+    polls starts at interval and grows by the backoff factor up to
+    max_interval. refresh, if given, is called once before each poll in
+    which some condition needs it. The wait is measured by probe (see
+    AndroPilot.probe), if given.
+    """
+    conditions = [_as_condition(c) for c in conditions]
+    if name is None:
+        name = ', '.join(c.name for c in conditions)
+    needs_refresh = refresh is not None and any(c.refresh for c in conditions)
+
+    if probe is None:
+        result = _poll(conditions, timeout, require_all, refresh,
+                       needs_refresh, interval, max_interval, backoff, name)
+    else:
+        with probe('wait', 'wait', condition=name) as measure:
+            result = _poll(conditions, timeout, require_all, refresh,
+                           needs_refresh, interval, max_interval, backoff,
+                           name)
+            measure.set(polls=result.polls)
+    logger.debug("Wait %r", result)
+    return result
+
+
+def _poll(conditions, timeout, require_all, refresh, needs_refresh,
+          interval, max_interval, backoff, name):
+    start_time = monotonic()
+    deadline = start_time + timeout
+    polls = 0
+    while True:
+        if needs_refresh:
+            refresh()
+        polls += 1
+        values = [c.check() or None for c in conditions]
+        met = [v is not None for v in values]
+        if all(met) if require_all else any(met):
+            result = WaitResult(name, True, values, polls,
+                                monotonic() - start_time)
+            break
+
+        now = monotonic()
+        if now >= deadline:
+            result = WaitResult(name, False, values, polls, now - start_time)
+            break
+        time.sleep(min(interval, deadline - now))
+        interval = min(interval * backoff, max_interval)
+    return result
+
+
+def wait_for(condition, timeout, **options):
+    """
+    Wait for a single condition (a Condition or a function), see poll().
+    """
+    return poll([condition], timeout, **options)
+
+
+def wait_any(conditions, timeout, **options):
+    return poll(conditions, timeout, require_all=False, **options)
+
+
+def wait_all(conditions, timeout, **options):
+    return poll(conditions, timeout, require_all=True, **options)